@@ -8,7 +8,7 @@ from .models import db
 
 # by importing controllers you expose the actions defined in it
 #from . import controllers
-from .controllers import zauth, public, channel, topic
+from .controllers import zauth, public, channel, topic, search, image
 
 # optional parameters
 __version__ = "0.0.0"
@@ -0,0 +1,228 @@
+"""
+Recent activity feed (latest postings and system announcements).
+Every new topic/response adds a row to the activity_feed table (pruned on
+insert to the newest settings.ACTIVITY_FEED_SIZE of its kind, public and
+non public rows apart), along with
+what the sidebar displays and whether the channel is public, so reading
+the feed is an index range scan, never a scan of the topic table.
+Each process keeps the public entries in bounded ring buffers (deque),
+reloaded every ACTIVITY_FEED_TTL seconds to pick up the posts made thru
+other processes, the sidebar reads the newest k of them from memory.
+"""
+import hashlib
+import threading
+import time
+from collections import deque
+from itertools import islice
+from py4web import URL
+from py4web.core import Fixture
+from .common import db, session, auth
+from .forumhelper import forumhelper as fh
+from . import settings
+
+KINDS = ('posting', 'announcement')
+
+
+def is_public_channel(channel):
+    """ Postings of the channel can be shown to everybody """
+    return not channel.is_private and not channel.requires_membership
+
+
+class ActivityFeed:
+    """ Materialized latest postings/announcements """
+
+    def __init__(self, size=50, ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self._entries = {}
+        self._loaded_on = {}
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _entry(self, row):
+        return {
+            'id': row.id,
+            'title': row.title,
+            'username': row.username,
+            'channel_tag': row.channel_tag,
+            'created_on': row.created_on,
+            'url': URL(f'c/{row.channel_tag}/t/{row.topic_id}')
+        }
+
+    def _load(self, kind):
+        """ Newest public entries of kind, from the table """
+        rows = db((db.activity_feed.kind == kind) &
+                  (db.activity_feed.is_public == True)).select(
+                      orderby=~db.activity_feed.id,
+                      limitby=(0, self.size))
+        entries = deque((self._entry(row) for row in rows), maxlen=self.size)
+        with self._lock:
+            self._entries[kind] = entries
+            self._loaded_on[kind] = time.monotonic()
+            self._version = None
+        return entries
+
+    def _prune(self, kind, is_public):
+        """ Drops the entries of kind (public or not) older than the newest
+        size ones, so postings in non public channels never push the
+        public ones out """
+        query = (db.activity_feed.kind == kind) & \
+            (db.activity_feed.is_public == is_public)
+        oldest_kept = db(query).select(
+            db.activity_feed.id, orderby=~db.activity_feed.id,
+            limitby=(self.size - 1, self.size)).first()
+        if oldest_kept is not None:
+            db(query & (db.activity_feed.id < oldest_kept.id)).delete()
+
+    def post_added(self, channel, topic_id, title, user, post_id=None,
+                   is_system=False):
+        """ Call after inserting a topic (post_id = topic_id) or a response
+        (post_id, topic_id its parent and title the topic's), channel is
+        the channel row and user the author (auth.get_user()).
+        Announcements (is_system) are only listed as such.
+        """
+        kind = 'announcement' if is_system else 'posting'
+        is_public = is_public_channel(channel)
+        db.activity_feed.insert(
+            kind=kind,
+            topic_id=topic_id,
+            post_id=post_id or topic_id,
+            channel_id=channel.id,
+            channel_tag=channel.tag,
+            title=title,
+            username=user.get('username'),
+            is_public=is_public)
+        self._prune(kind, is_public)
+        if is_public:
+            # Reloaded on next read, not added in memory: the request may
+            # still roll back
+            self.reset()
+
+    def posts_removed(self, post_ids):
+        """ Call when deleting topics/responses, drops their entries """
+        db(db.activity_feed.post_id.belongs(post_ids)).delete()
+        self.reset()
+
+    def channel_changed(self, channel):
+        """ Call after changing the visibility of a channel """
+        db(db.activity_feed.channel_id == channel.id).update(
+            is_public=is_public_channel(channel))
+        self.reset()
+
+    def _current(self, kind):
+        """ The in-memory entries of kind, reloaded when expired """
+        with self._lock:
+            entries = self._entries.get(kind)
+            expired = entries is None or \
+                time.monotonic() - self._loaded_on[kind] > self.ttl
+        if expired:
+            entries = self._load(kind)
+        return entries
+
+    def latest(self, kind, limit):
+        """ The newest (up to) limit public entries of kind """
+        entries = self._current(kind)
+        with self._lock:
+            return list(islice(entries, max(0, limit)))
+
+    def version(self):
+        """ Digest of the ids of the entries shown, the same for every
+        process holding the same entries (and across reloads), changes
+        when they change """
+        for kind in KINDS:
+            self._current(kind)
+        with self._lock:
+            if self._version is None:
+                ids = [[entry['id'] for entry in self._entries.get(kind, ())]
+                       for kind in KINDS]
+                self._version = hashlib.sha1(
+                    repr(ids).encode('utf-8')).hexdigest()[:16]
+            return self._version
+
+    def reset(self):
+        """ Forgets the in-memory entries, they are reloaded on next read """
+        with self._lock:
+            self._entries.clear()
+            self._loaded_on.clear()
+            self._version = None
+
+    def rebuild(self):
+        """ Recreates the table from the topic table (e.g. after seeding),
+        returns the number of entries.
+        """
+        db(db.activity_feed).delete()
+        parent = db.topic.with_alias('parent_topic')
+        count = 0
+        for kind in KINDS:
+            if kind == 'announcement':
+                query = (db.topic.is_system == True) & \
+                    (db.topic.is_parent == True)
+            else:
+                query = (db.topic.is_system == False) | \
+                    (db.topic.is_system == None)
+            rows = db(query & (db.topic.is_visible == True)).select(
+                db.topic.id, db.topic.parent_id, db.topic.title,
+                db.topic.created_on, parent.title, db.channel.id,
+                db.channel.tag, db.channel.is_private,
+                db.channel.requires_membership, db.auth_user.username,
+                left=[parent.on(parent.id == db.topic.parent_id),
+                      db.channel.on(db.channel.id == db.topic.channel_id),
+                      db.auth_user.on(db.auth_user.id == db.topic.created_by)],
+                orderby=~db.topic.created_on|~db.topic.id,
+                limitby=(0, self.size))
+            # Oldest first, ids follow the order of the postings
+            for row in reversed(rows):
+                db.activity_feed.insert(
+                    kind=kind,
+                    topic_id=row.topic.parent_id or row.topic.id,
+                    post_id=row.topic.id,
+                    channel_id=row.channel.id,
+                    channel_tag=row.channel.tag,
+                    title=row.parent_topic.title or row.topic.title,
+                    username=row.auth_user.username,
+                    is_public=is_public_channel(row.channel),
+                    created_on=row.topic.created_on)
+                count += 1
+        self.reset()
+        return count
+
+
+# Expose a single instance
+activity_feed = ActivityFeed(
+    size=settings.ACTIVITY_FEED_SIZE, ttl=settings.ACTIVITY_FEED_TTL)
+
+
+class ActivitySidebar(Fixture):
+    """ Adds activity ({'postings', 'announcements'}, newest first, up to
+    the zfss_latest_postings_max/zfss_system_announcement_max settings) to
+    the output of the actions it is used in, for the right nav of
+    zlayout.html. Declare it after the template.
+    """
+
+    def __init__(self):
+        self.__prerequisites__ = [session, auth]
+
+    def on_success(self, context=None):
+        output = context.get('output') if context else None
+        if not isinstance(output, dict) or 'activity' in output:
+            return
+        limits = fh.get_system_properties(
+            ['zfss_latest_postings_max', 'zfss_system_announcement_max'])
+        output['activity'] = {
+            'postings': activity_feed.latest(
+                'posting', _as_limit(limits['zfss_latest_postings_max'])),
+            'announcements': activity_feed.latest(
+                'announcement',
+                _as_limit(limits['zfss_system_announcement_max']))
+        }
+
+
+def _as_limit(value):
+    """ Invalid values show no entries (see the system settings) """
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+activity_sidebar = ActivitySidebar()
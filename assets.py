@@ -0,0 +1,204 @@
+"""
+Fingerprinted static assets.
+build() copies the files of static/ to settings.ASSETS_FOLDER with the
+(sha256) hash of their content in the name, css/zforum.css becomes
+css/zforum.<hash>.css, next to precompressed .gz (and .br, when the brotli
+module is installed) siblings, and writes a manifest of the names.
+References between stylesheets and the files they load (fonts, images)
+are rewritten to the fingerprinted names as well.
+
+Templates link assets with asset('css/zforum.css') (available thru the
+assets fixture), served by the assets/<path> action with a long lived,
+immutable Cache-Control: a new build yields new URLs, so browsers never
+need to revalidate them.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+from py4web import URL
+from py4web.utils.factories import Inject
+from . import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+# Files that are fingerprinted, and those that are worth compressing
+EXTENSIONS = {'.css', '.js', '.map', '.svg', '.woff', '.woff2', '.ttf',
+              '.eot', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.ico'}
+COMPRESSIBLE = {'.css', '.js', '.map', '.svg', '.ttf', '.eot', '.ico'}
+# Folders of static/ that are not assets (uploads, the build itself)
+EXCLUDED = {'.ext_images', os.path.basename(settings.ASSETS_FOLDER)}
+CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def fingerprint(path, content):
+    """ css/zforum.css -> css/zforum.<hash>.css """
+    base, ext = os.path.splitext(path)
+    return f'{base}.{hashlib.sha256(content).hexdigest()[:12]}{ext}'
+
+
+class Assets:
+    """ Builds and resolves fingerprinted assets """
+
+    def __init__(self, static_folder, assets_folder):
+        self.static_folder = static_folder
+        self.assets_folder = assets_folder
+        self._manifest = None
+        self._lock = threading.Lock()
+
+    def _sources(self):
+        """ Logical (static relative, / separated) paths of the assets """
+        for root, folders, files in os.walk(self.static_folder):
+            folders[:] = [folder for folder in folders
+                          if folder not in EXCLUDED]
+            for fname in files:
+                if os.path.splitext(fname)[1].lower() in EXTENSIONS:
+                    path = os.path.relpath(
+                        os.path.join(root, fname), self.static_folder)
+                    yield path.replace(os.sep, '/')
+
+    def _rewrite_css(self, path, content, manifest):
+        """ Points the url() references of a stylesheet to the
+        fingerprinted files, relative to the stylesheet's new location
+        """
+        css_folder = os.path.dirname(path)
+        static_prefix = f'/{settings.APP_NAME}/static/'
+
+        def replace(match):
+            quote, ref = match.groups()
+            if ref.startswith(('data:', 'http:', 'https:', '//', '#')):
+                return match.group(0)
+            target = re.split(r'[?#]', ref, maxsplit=1)[0]
+            if target.startswith(static_prefix):
+                target = target[len(static_prefix):]
+            elif target.startswith('/'):
+                return match.group(0)
+            else:
+                target = os.path.normpath(
+                    os.path.join(css_folder, target)).replace(os.sep, '/')
+            if target not in manifest:
+                return match.group(0)
+            new_ref = os.path.relpath(
+                manifest[target], css_folder or '.').replace(os.sep, '/')
+            return f'url({quote}{new_ref}{quote})'
+
+        text = content.decode('utf-8')
+        return CSS_URL.sub(replace, text).encode('utf-8')
+
+    def _write(self, fingerprinted, content):
+        """ Writes an asset and its compressed siblings (once) """
+        target = os.path.join(self.assets_folder, fingerprinted)
+        if os.path.exists(target):
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        ext = os.path.splitext(target)[1].lower()
+        if ext in COMPRESSIBLE and len(content) > 1024:
+            self._replace(target + '.gz',
+                          gzip.compress(content, compresslevel=9))
+            if brotli is not None:
+                self._replace(target + '.br', brotli.compress(content))
+        # Last, so an interrupted build does not leave a partial asset
+        self._replace(target, content)
+
+    def _replace(self, path, content):
+        """ Writes path thru a temporary file, other processes building at
+        the same time (or serving it) never see it partially written """
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as asset_file:
+            asset_file.write(content)
+        os.replace(tmp_path, path)
+
+    def build(self, clean=False):
+        """ Fingerprints every asset and writes the manifest, returns it
+        ({logical path: fingerprinted path}). clean=True removes the
+        previous builds first.
+        """
+        if clean and os.path.isdir(self.assets_folder):
+            shutil.rmtree(self.assets_folder)
+        os.makedirs(self.assets_folder, exist_ok=True)
+        manifest = {}
+        stylesheets = []
+        # Stylesheets last, they reference the other assets
+        for path in self._sources():
+            if path.endswith('.css'):
+                stylesheets.append(path)
+                continue
+            with open(os.path.join(self.static_folder, path), 'rb') as source:
+                content = source.read()
+            manifest[path] = fingerprint(path, content)
+            self._write(manifest[path], content)
+        for path in stylesheets:
+            with open(os.path.join(self.static_folder, path), 'rb') as source:
+                content = self._rewrite_css(path, source.read(), manifest)
+            manifest[path] = fingerprint(path, content)
+            self._write(manifest[path], content)
+        manifest_file = os.path.join(self.assets_folder, MANIFEST)
+        tmp_manifest = f'{manifest_file}.{os.getpid()}.tmp'
+        with open(tmp_manifest, 'w', encoding='utf-8') as output:
+            json.dump(manifest, output, indent=1, sort_keys=True)
+        os.replace(tmp_manifest, manifest_file)
+        with self._lock:
+            self._manifest = manifest
+        return manifest
+
+    def manifest(self):
+        """ The current manifest, loaded once ({} if there is no build) """
+        if self._manifest is None:
+            with self._lock:
+                if self._manifest is None:
+                    try:
+                        with open(os.path.join(self.assets_folder, MANIFEST),
+                                  encoding='utf-8') as manifest_file:
+                            self._manifest = json.load(manifest_file)
+                    except (OSError, ValueError):
+                        self._manifest = {}
+        return self._manifest
+
+    def version(self):
+        """ Short hash of the manifest, changes with any asset """
+        return hashlib.sha256(json.dumps(
+            self.manifest(), sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+    def url(self, path):
+        """ URL of an asset, the plain static file when it is not built """
+        fingerprinted = self.manifest().get(path)
+        if fingerprinted is None:
+            return URL('static', path)
+        return URL('assets', fingerprinted)
+
+    def resolve(self, path, accept_encoding=''):
+        """ (file, content encoding) to serve for a fingerprinted path,
+        the precompressed sibling when the client accepts it, or None
+        """
+        folder = os.path.abspath(self.assets_folder)
+        target = os.path.abspath(os.path.join(folder, path))
+        if not target.startswith(folder + os.sep) or \
+                not os.path.isfile(target):
+            return None
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if encoding in accept_encoding and \
+                    os.path.isfile(target + suffix):
+                return target + suffix, encoding
+        return target, None
+
+
+# Expose a single instance
+assets = Assets(settings.STATIC_FOLDER, settings.ASSETS_FOLDER)
+if settings.ASSETS_BUILD_ON_STARTUP:
+    assets.build()
+
+
+def asset(path):
+    """ Template helper, URL of a (fingerprinted) static asset """
+    return assets.url(path)
+
+
+# Makes asset() available to the templates of the actions using it
+asset_fixture = Inject(asset=asset)
@@ -0,0 +1,6 @@
+""" Commands
+Maintenance commands (backfills, repairs, seeding) that run outside of the
+web server. From the py4web root folder (the one containing apps/):
+
+    python -m apps.zforum.commands.<command> --help
+"""
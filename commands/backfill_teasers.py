@@ -0,0 +1,26 @@
+"""
+Generates the stored teaser of existing topics (topics created before the
+teaser column existed, or imported in bulk).
+
+Usage (from the py4web root folder):
+
+    python -m apps.zforum.commands.backfill_teasers [--batch-size 500]
+"""
+import argparse
+from ..models import db
+from ..forumhelper import forumhelper as fh
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Backfill topic teasers for the topic listings.')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='Topics updated per transaction.')
+    args = parser.parse_args()
+    updated = fh.backfill_topic_teasers(batch_size=args.batch_size)
+    db.commit()
+    print(f'{updated} topic teaser(s) generated.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+"""
+Benchmark harness for the hot endpoints.
+
+For every requested scale a SQLite database (databases/bench_<scale>.db)
+is seeded with commands/seed.py (once, reused by later runs), then the
+actions are driven in-process thru the py4web WSGI application, measuring
+per endpoint the latency percentiles, the number of queries, the time
+spent in the database and the rows fetched. Results are saved as JSON so
+two runs (e.g. two commits) can be compared.
+
+Usage (from the py4web root folder):
+
+    python -m apps.zforum.commands.benchmark --scales small,medium
+    python -m apps.zforum.commands.benchmark --compare old.json new.json
+"""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from urllib.parse import urlencode
+from wsgiref.util import setup_testing_defaults
+
+# Seeding options (see commands/seed.py) of each scale
+SCALES = {
+    'small': ['--scale', '0.1', '--topics', '20', '--max-replies', '10'],
+    'medium': ['--scale', '0.5', '--topics', '50', '--max-replies', '25'],
+    'large': ['--scale', '1', '--topics', '50', '--max-replies', '50'],
+}
+BENCH_PASSWORD = 'zforum-bench-password'
+# Name of the app, apps.<app_name>.commands.benchmark
+APP_NAME = __package__.split('.')[1]
+APP_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Worker process entry point. As py4web's loader does, action.app_name is
+# set before the app (and its controllers) is imported, so the routes are
+# mounted under /<app_name> where Client sends the requests
+WORKER = (
+    'from py4web.core import action\n'
+    f'action.app_name = {APP_NAME!r}\n'
+    f'from {__spec__.name} import main\n'
+    'main()\n')
+
+
+def percentile(values, pct):
+    """ Nearest rank percentile of a list of numbers """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = max(0, math.ceil(pct / 100.0 * len(values)) - 1)
+    return values[rank]
+
+
+class QueryMeter:
+    """ Counts queries, database time and rows fetched thru a DAL """
+
+    def __init__(self, db):
+        self.reset()
+        adapter = db._adapter
+        execute, parse = adapter.execute, adapter.parse
+
+        def metered_execute(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return execute(*args, **kwargs)
+            finally:
+                self.queries += 1
+                self.db_time += time.perf_counter() - started
+
+        def metered_parse(rows, *args, **kwargs):
+            self.rows += len(rows)
+            return parse(rows, *args, **kwargs)
+
+        adapter.execute = metered_execute
+        adapter.parse = metered_parse
+
+    def reset(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+
+
+class Client:
+    """ Minimal in-process WSGI client keeping the session cookie """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.cookies = {}
+
+    def request(self, path, method='GET', data=None):
+        path, _, query = path.partition('?')
+        environ = {}
+        setup_testing_defaults(environ)
+        body = urlencode(data or {}).encode('utf-8')
+        environ.update({
+            'REQUEST_METHOD': method,
+            'PATH_INFO': f'/{APP_NAME}/{path}',
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': io.BytesIO(body),
+            'HTTP_COOKIE': '; '.join(
+                f'{name}={value}' for name, value in self.cookies.items()),
+        })
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split()[0])
+            response['headers'] = headers
+
+        chunks = self.wsgi_app(environ, start_response)
+        payload = b''.join(chunks)
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        for name, value in response['headers']:
+            if name.lower() == 'set-cookie':
+                cookie_name, _, rest = value.partition('=')
+                self.cookies[cookie_name] = rest.split(';', 1)[0]
+        return response['status'], payload
+
+
+def prepare_dataset(scale, reseed):
+    """ Seeds the database of the scale if needed, returns the dataset
+    counts and the (sysadmin) benchmark user email
+    """
+    from ..common import db
+    from ..forumhelper import forumhelper as fh
+    from . import seed
+    if reseed or db(db.channel).isempty():
+        seed.seed(seed.parse_options(
+            SCALES[scale] + ['--workers', str(os.cpu_count() or 1)]))
+    email = f'bench@{APP_NAME}.local'
+    user = db(db.auth_user.email == email).select().first()
+    if user is None:
+        from pydal.validators import CRYPT
+        user_id = db.auth_user.insert(
+            username='zforum-bench', email=email, first_name='zForum',
+            last_name='Bench', password=str(CRYPT()(BENCH_PASSWORD)[0]))
+        fh.add_user_group(user_id, 'manager')
+    db.commit()
+    return {
+        'users': db(db.auth_user).count(),
+        'channels': db(db.channel).count(),
+        'topics': db(db.topic.is_parent == True).count(),
+        'responses': db(db.topic.is_parent == False).count(),
+    }, email
+
+
+def endpoints(db):
+    """ (name, path, authenticated) of every endpoint to measure """
+    channel = db(db.channel.is_private == False).select(
+        db.channel.tag, orderby=~db.channel.rank, limitby=(0, 1)).first()
+    tag = channel.tag if channel else 'missing'
+    # The topic of that channel with the most responses
+    responses = db.topic.id.count()
+    thread = db((db.topic.channel_id == db.channel.id) &
+                (db.channel.tag == tag) &
+                (db.topic.is_parent == False)).select(
+        db.topic.parent_id, responses, groupby=db.topic.parent_id,
+        orderby=~responses, limitby=(0, 1)).first()
+    topic_id = thread.topic.parent_id if thread else 0
+    return [
+        ('index', 'index', False),
+        ('index[auth]', 'index', True),
+        ('channel_index', f'c/{tag}', False),
+        ('channel_index[auth]', f'c/{tag}', True),
+        ('channels', 'channel/all', False),
+        ('view_topic', f'c/{tag}/t/{topic_id}', False),
+        ('topic_replies', f'topic/replies/{topic_id}', False),
+        ('new_topic', f'c/{tag}/topic/new', True),
+        ('profile', 'zauth/profile', True),
+        ('system_admin', 'zauth/system_admin', True),
+    ]
+
+
+def run_scale(scale, requests, warmup, reseed):
+    """ Worker side, benchmarks the current database (see DB_URI) """
+    from py4web.core import action, bottle
+    from ..common import db
+    if action.app_name != APP_NAME:
+        # The routes would be under / and every request a 404
+        sys.exit(f'The app must be imported with action.app_name set to '
+                 f'{APP_NAME}, see WORKER')
+    dataset, email = prepare_dataset(scale, reseed)
+    wsgi_app = bottle.default_app()
+    meter = QueryMeter(db)
+    anonymous, member = Client(wsgi_app), Client(wsgi_app)
+    status, _ = member.request('zauth/login', 'POST',
+                               {'email': email, 'passwd': BENCH_PASSWORD})
+    if not 200 <= status < 400:
+        sys.exit(f'Login of {email} failed with status {status}')
+    results = {}
+    for name, path, authenticated in endpoints(db):
+        client = member if authenticated else anonymous
+        for _ in range(warmup):
+            client.request(path)
+        latencies, queries, db_times, rows, statuses = [], [], [], [], set()
+        for _ in range(requests):
+            meter.reset()
+            started = time.perf_counter()
+            status, _ = client.request(path)
+            latencies.append((time.perf_counter() - started) * 1000)
+            queries.append(meter.queries)
+            db_times.append(meter.db_time * 1000)
+            rows.append(meter.rows)
+            statuses.add(status)
+        failed = sorted(status for status in statuses
+                        if not 200 <= status < 400)
+        if failed:
+            # Timings of error pages are meaningless, fail the whole run
+            sys.exit(f'{name} ({path}) answered {failed}')
+        results[name] = {
+            'path': path,
+            'status': sorted(statuses),
+            'requests': requests,
+            'latency_ms': {
+                'mean': statistics.mean(latencies),
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': max(latencies),
+            },
+            'queries': statistics.mean(queries),
+            'db_time_ms': statistics.mean(db_times),
+            'rows': statistics.mean(rows),
+        }
+    return {'dataset': dataset, 'endpoints': results}
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_FOLDER,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(options):
+    """ Parent side, runs every scale in its own process (each one with its
+    own database) and saves the results
+    """
+    from ..settings import DB_FOLDER
+    report = {
+        'revision': git_revision(),
+        'created_on': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'scales': {}
+    }
+    for scale in options.scales.split(','):
+        if scale not in SCALES:
+            sys.exit(f'Unknown scale {scale}, use any of {", ".join(SCALES)}')
+        env = dict(os.environ)
+        env.update({
+            'DB_URI': f'sqlite://bench_{scale}.db',
+            'DB_MIGRATE': 'true',
+        })
+        if options.reseed:
+            db_file = os.path.join(DB_FOLDER, f'bench_{scale}.db')
+            if os.path.exists(db_file):
+                os.unlink(db_file)
+        args = [sys.executable, '-c', WORKER, '--worker', scale,
+                '--requests', str(options.requests),
+                '--warmup', str(options.warmup)]
+        print(f'Benchmarking {scale}...', file=sys.stderr)
+        completed = subprocess.run(
+            args, env=env, capture_output=True, text=True)
+        if completed.returncode:
+            sys.stderr.write(completed.stderr)
+            sys.exit(f'Benchmark of {scale} failed.')
+        # The worker prints its results as the last line
+        report['scales'][scale] = json.loads(
+            completed.stdout.strip().splitlines()[-1])
+    output = options.output or os.path.join(
+        DB_FOLDER, 'benchmarks',
+        f"{report['created_on'].replace(':', '')}-{report['revision']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as output_file:
+        json.dump(report, output_file, indent=2)
+    print_report(report)
+    print(f'Results saved to {output}')
+
+
+def print_report(report):
+    for scale, result in report['scales'].items():
+        print(f"\n[{scale}] {result['dataset']}")
+        print(f"{'endpoint':<22}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}"
+              f"{'queries':>9}{'db ms':>9}{'rows':>9}")
+        for name, stats in result['endpoints'].items():
+            latency = stats['latency_ms']
+            print(f"{name:<22}{latency['p50']:>9.1f}{latency['p90']:>9.1f}"
+                  f"{latency['p99']:>9.1f}{stats['queries']:>9.1f}"
+                  f"{stats['db_time_ms']:>9.1f}{stats['rows']:>9.0f}")
+
+
+def compare(old_file, new_file):
+    """ Prints the p50/queries/rows changes between two result files """
+    with open(old_file, encoding='utf-8') as old_f, \
+            open(new_file, encoding='utf-8') as new_f:
+        old, new = json.load(old_f), json.load(new_f)
+    print(f"{old['revision']} -> {new['revision']}")
+    for scale, result in new['scales'].items():
+        previous = old['scales'].get(scale)
+        if not previous:
+            continue
+        print(f'\n[{scale}]')
+        print(f"{'endpoint':<22}{'p50 ms':>18}{'queries':>14}{'rows':>16}")
+        for name, stats in result['endpoints'].items():
+            before = previous['endpoints'].get(name)
+            if not before:
+                continue
+            p50_old = before['latency_ms']['p50']
+            p50_new = stats['latency_ms']['p50']
+            change = (p50_new - p50_old) / p50_old * 100 if p50_old else 0
+            print(f"{name:<22}{p50_old:>7.1f} {p50_new:>7.1f}"
+                  f"{change:>+7.0f}%  {before['queries']:>5.0f} "
+                  f"{stats['queries']:>5.0f}   {before['rows']:>6.0f} "
+                  f"{stats['rows']:>6.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the zForum hot endpoints.')
+    parser.add_argument('--scales', default='small,medium',
+                        help=f'Comma separated, any of {", ".join(SCALES)}.')
+    parser.add_argument('--requests', type=int, default=50,
+                        help='Measured requests per endpoint.')
+    parser.add_argument('--warmup', type=int, default=5,
+                        help='Unmeasured requests per endpoint.')
+    parser.add_argument('--reseed', action='store_true',
+                        help='Drop and seed the benchmark databases again.')
+    parser.add_argument('--output', help='Results file (JSON).')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two results files and exit.')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.compare:
+        compare(*options.compare)
+    elif options.worker:
+        result = run_scale(options.worker, options.requests,
+                           options.warmup, reseed=False)
+        print(json.dumps(result))
+    else:
+        run(options)
+
+
+if __name__ == '__main__':
+    main()
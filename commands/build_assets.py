@@ -0,0 +1,25 @@
+"""
+Fingerprints and precompresses the static assets (see assets.py), run it
+as part of a deployment when ASSETS_BUILD_ON_STARTUP is false.
+
+Usage (from the py4web root folder):
+
+    python -m apps.zforum.commands.build_assets [--clean]
+"""
+import argparse
+from ..assets import assets, brotli
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Fingerprint and precompress the static assets.')
+    parser.add_argument('--clean', action='store_true',
+                        help='Remove the previous builds first.')
+    args = parser.parse_args()
+    manifest = assets.build(clean=args.clean)
+    print(f'{len(manifest)} asset(s) built in {assets.assets_folder}'
+          f'{"" if brotli else " (brotli not installed, gzip only)"}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+"""
+Rebuilds the channel/topic search index from scratch (see search.py).
+
+Usage (from the py4web root folder):
+
+    python -m apps.zforum.commands.rebuild_search
+"""
+import argparse
+from ..models import db
+from ..search import search_index
+
+
+def main():
+    argparse.ArgumentParser(
+        description='Rebuild the channel/topic search index.').parse_args()
+    count = search_index.rebuild()
+    db.commit()
+    backend = 'FTS5' if search_index.uses_fts() else 'in-memory'
+    print(f'{count} document(s) indexed ({backend}).')
+
+
+if __name__ == '__main__':
+    main()
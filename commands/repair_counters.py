@@ -0,0 +1,37 @@
+"""
+Recomputes the denormalized post counters (topic.reply_count/
+last_reply_on/last_reply_by, channel.topic_count/response_count/
+last_activity_on), the channel ranks, the member post/reply counters
+(zfmp_posts/zfmp_replies) and the activity feed, e.g. after importing
+topics in bulk or deleting them outside the app.
+
+Usage (from the py4web root folder):
+
+    python -m apps.zforum.commands.repair_counters [--batch-size 500]
+"""
+import argparse
+from ..models import db
+from ..forumhelper import forumhelper as fh
+from ..postcounters import post_counters
+from ..rankengine import rank_engine
+from ..activityfeed import activity_feed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Recompute the topic and channel post counters.')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='Topics updated per transaction.')
+    args = parser.parse_args()
+    topics, channels = post_counters.repair(batch_size=args.batch_size)
+    ranks = rank_engine.reconcile()
+    members = fh.recount_member_postings(batch_size=args.batch_size)
+    entries = activity_feed.rebuild()
+    db.commit()
+    print(f'{topics} topic(s), {channels} channel(s), {ranks} channel '
+          f'rank(s) and {members} member counter(s) repaired, {entries} '
+          f'activity feed entries rebuilt.')
+
+
+if __name__ == '__main__':
+    main()
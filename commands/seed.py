@@ -0,0 +1,324 @@
+"""
+Bulk seeding of users, channels, topics and responses, for development
+and benchmarking (replaces the old fakepopulate action).
+
+Text is generated with Faker once into a pool and reused, rows are written
+with executemany in chunks, and the topics/responses of the channels are
+generated by several processes in parallel, each one writing its own
+partition of channels. The same --seed always produces the same dataset.
+
+Usage (from the py4web root folder):
+
+    python -m apps.zforum.commands.seed --scale 0.1 --workers 4
+
+Defaults match the old fakepopulate action: 100 users, 100 channels,
+50 topics per channel and 1 to 50 responses per topic.
+"""
+import argparse
+import multiprocessing
+import random
+import time
+from datetime import date, datetime, timedelta
+from faker import Faker
+from pydal.validators import CRYPT
+from ..models import db
+from ..forumhelper import forumhelper as fh
+from ..rankengine import rank_engine
+from ..postcounters import post_counters
+from ..activityfeed import activity_feed
+from ..search import search_index
+
+# Size of the generated text pools
+SENTENCE_POOL = 500
+BODY_POOL = 200
+# Seeded data is spread over this period (ending now)
+DATA_PERIOD = timedelta(days=365)
+
+
+def _sql_value(value):
+    """ Python value to the representation pyDAL stores """
+    if isinstance(value, bool):
+        return 'T' if value else 'F'
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+def insert_many(table, fieldnames, rows):
+    """ Inserts rows (tuples ordered as fieldnames) with a single
+    executemany, bypassing the one INSERT per row of bulk_insert. The
+    fields not listed get their default, as a pyDAL insert would.
+    """
+    if not rows:
+        return
+    defaults = {}
+    for field in table:
+        if field.type == 'id' or field.name in fieldnames or \
+                field.default is None:
+            continue
+        defaults[field.name] = field.default() if callable(field.default) \
+            else field.default
+    fieldnames = list(fieldnames) + list(defaults)
+    adapter = db._adapter
+    mark = '?' if adapter.driver.paramstyle == 'qmark' else '%s'
+    sql = 'INSERT INTO %s (%s) VALUES (%s);' % (
+        table._rname,
+        ', '.join(table[fieldname]._rname for fieldname in fieldnames),
+        ', '.join([mark] * len(fieldnames)))
+    adapter.cursor.executemany(
+        sql, [tuple(_sql_value(value)
+                    for value in tuple(row) + tuple(defaults.values()))
+              for row in rows])
+
+
+def text_pool(seed):
+    """ Generates (deterministically) the text reused by every row """
+    Faker.seed(seed)
+    fake = Faker()
+    sentences = [fake.sentence(10) for _ in range(SENTENCE_POOL)]
+    bodies = ['\n'.join(fake.paragraphs(10)) for _ in range(BODY_POOL)]
+    return {
+        'fake': fake,
+        'sentences': sentences,
+        'bodies': bodies,
+        # Teasers of the pool, rendered once instead of once per topic
+        'teasers': [fh.make_topic_teaser(body) for body in bodies]
+    }
+
+
+def seed_until(options):
+    """ End of the seeded period, fixed so the same seed gives the same
+    dates
+    """
+    return datetime.strptime(options.until, '%Y-%m-%d')
+
+
+def random_moment(rnd, now):
+    return now - timedelta(
+        seconds=rnd.randint(0, int(DATA_PERIOD.total_seconds())))
+
+
+def seed_users(options, pool, rnd):
+    """ Creates the users, every one shares the same password (hashed only
+    once), returns the ids of all users
+    """
+    fake = pool['fake']
+    password = str(CRYPT()(options.password)[0])
+    first_id = (db().select(db.auth_user.id.max()).first()[
+        db.auth_user.id.max()] or 0) + 1
+    rows = []
+    for idx in range(options.users):
+        user_id = first_id + idx
+        rows.append((
+            f'{fake.user_name()}{user_id}',
+            f'seed{user_id}@{fake.free_email_domain()}',
+            password,
+            fake.first_name(),
+            fake.last_name()))
+        if len(rows) >= options.chunk:
+            insert_many(db.auth_user, ['username', 'email', 'password',
+                                       'first_name', 'last_name'], rows)
+            rows = []
+    insert_many(db.auth_user, ['username', 'email', 'password',
+                               'first_name', 'last_name'], rows)
+    db.commit()
+    return [row.id for row in db().select(db.auth_user.id)]
+
+
+def seed_channels(options, pool, rnd, user_ids):
+    """ Creates the channels (and makes their creators channel admins),
+    returns the ids of the new channels
+    """
+    fake = pool['fake']
+    now = seed_until(options)
+    first_id = (db().select(db.channel.id.max()).first()[
+        db.channel.id.max()] or 0) + 1
+    channel_rows = []
+    admin_rows = []
+    for idx in range(options.channels):
+        channel_id = first_id + idx
+        user_id = rnd.choice(user_ids)
+        created_on = random_moment(rnd, now)
+        tag = ''.join(word.title() for word in fake.words(2)) + \
+            str(channel_id)
+        channel_rows.append((
+            channel_id, tag, rnd.choice(pool['sentences']),
+            ' '.join(rnd.sample(pool['sentences'], 10)),
+            user_id, created_on, user_id, created_on,
+            rnd.random() < 0.2, rnd.random() < 0.2))
+        admin_rows.append((user_id, channel_id, True))
+    for start in range(0, len(channel_rows), options.chunk):
+        insert_many(db.channel, [
+            'id', 'tag', 'title', 'content', 'created_by', 'created_on',
+            'modified_by', 'modified_on', 'is_private',
+            'requires_membership'],
+            channel_rows[start:start + options.chunk])
+        insert_many(db.channel_admin, ['user_id', 'channel_id', 'is_active'],
+                    admin_rows[start:start + options.chunk])
+    db.commit()
+    return [row[0] for row in channel_rows]
+
+
+def _seed_partition(args):
+    """ Worker: creates the topics and responses of a partition of
+    channels, args = (options, partition, [(channel_id, first_id)],
+    user_ids), the ids of each channel (see seed_topics) are its topics
+    first and then its responses
+    """
+    options, partition, channels, user_ids = args
+    db._adapter.reconnect()
+    pool = text_pool(options.seed)
+    rnd = random.Random(options.seed * 1000 + partition)
+    now = seed_until(options)
+    topic_fields = [
+        'id', 'channel_id', 'title', 'content', 'teaser', 'is_parent',
+        'view', 'upvote', 'created_on', 'modified_on', 'created_by',
+        'modified_by']
+    reply_fields = [
+        'id', 'channel_id', 'parent_id', 'title', 'content', 'is_parent',
+        'view', 'upvote', 'created_on', 'modified_on', 'created_by',
+        'modified_by']
+    topics = []
+    replies = []
+    counts = {'topics': 0, 'responses': 0}
+
+    def write(force=False):
+        if topics and (force or len(topics) >= options.chunk):
+            insert_many(db.topic, topic_fields, topics)
+            counts['topics'] += len(topics)
+            topics.clear()
+            db.commit()
+        if replies and (force or len(replies) >= options.chunk):
+            insert_many(db.topic, reply_fields, replies)
+            counts['responses'] += len(replies)
+            replies.clear()
+            db.commit()
+
+    for channel_id, first_id in channels:
+        reply_id = first_id + options.topics
+        for idx in range(options.topics):
+            topic_id = first_id + idx
+            user_id = rnd.choice(user_ids)
+            created_on = random_moment(rnd, now)
+            body = rnd.randrange(len(pool['bodies']))
+            topics.append((
+                topic_id, channel_id, rnd.choice(pool['sentences']),
+                pool['bodies'][body], pool['teasers'][body], True,
+                rnd.randint(0, 1000), rnd.randint(0, 100), created_on,
+                created_on, user_id, user_id))
+            for _ in range(rnd.randint(1, options.max_replies)
+                           if options.max_replies else 0):
+                reply_user_id = rnd.choice(user_ids)
+                replied_on = created_on + (now - created_on) * rnd.random()
+                replies.append((
+                    reply_id, channel_id, topic_id, rnd.choice(pool['sentences']),
+                    rnd.choice(pool['bodies']), False, rnd.randint(0, 1000),
+                    rnd.randint(0, 100), replied_on, replied_on,
+                    reply_user_id, reply_user_id))
+                reply_id += 1
+            write()
+    write(force=True)
+    return counts
+
+
+def seed_topics(options, channel_ids, user_ids):
+    """ Splits the channels in partitions and seeds their topics and
+    responses in parallel, returns the total counts
+    """
+    # Ids are allocated up front so responses can reference their parent
+    # without reading the ids back: every channel gets a block large
+    # enough for its topics and their most possible responses, so the
+    # partitions never take each other's ids (whatever order they write)
+    first_id = (db().select(db.topic.id.max()).first()[
+        db.topic.id.max()] or 0) + 1
+    block = options.topics * (1 + options.max_replies)
+    allocation = [(channel_id, first_id + idx * block)
+                  for idx, channel_id in enumerate(channel_ids)]
+    workers = max(1, min(options.workers, len(allocation)))
+    partitions = [(options, partition, allocation[partition::workers],
+                   user_ids) for partition in range(workers)]
+    totals = {'topics': 0, 'responses': 0}
+    if workers == 1:
+        results = [_seed_partition(partitions[0])]
+    else:
+        # Release the SQLite write lock before the workers start writing
+        db.commit()
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(workers) as worker_pool:
+            results = worker_pool.map(_seed_partition, partitions)
+        db._adapter.reconnect()
+    for result in results:
+        for key in totals:
+            totals[key] += result[key]
+    if db._dbname == 'postgres':
+        # Explicit ids do not move the sequences
+        for tablename in ('auth_user', 'channel', 'topic'):
+            db.executesql(
+                "SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+                "(SELECT MAX(id) FROM %s));" % (tablename, tablename))
+        db.commit()
+    return totals
+
+
+def build_parser():
+    """ Command line options, also used by the benchmark harness """
+    parser = argparse.ArgumentParser(
+        description='Seed the zForum database with generated data.')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiplier applied to users/channels counts.')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--channels', type=int, default=100)
+    parser.add_argument('--topics', type=int, default=50,
+                        help='Topics per channel.')
+    parser.add_argument('--max-replies', type=int, default=50,
+                        help='Each topic gets 1 to max-replies responses.')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Random seed, same seed same dataset.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Processes generating topics in parallel.')
+    parser.add_argument('--chunk', type=int, default=1000,
+                        help='Rows per executemany/transaction.')
+    parser.add_argument('--password', default='zforum-seed-password',
+                        help='Password of every seeded user.')
+    parser.add_argument('--until', default=date.today().isoformat(),
+                        help='Seeded dates end on this day (YYYY-MM-DD).')
+    return parser
+
+
+def parse_options(argv=None):
+    """ Parses the command line (or argv) and applies --scale """
+    options = build_parser().parse_args(argv)
+    options.users = max(1, int(options.users * options.scale))
+    options.channels = max(1, int(options.channels * options.scale))
+    return options
+
+
+def seed(options):
+    """ Runs the whole seeding process, returns the counts created """
+    started = time.monotonic()
+    pool = text_pool(options.seed)
+    rnd = random.Random(options.seed)
+    user_ids = seed_users(options, pool, rnd)
+    channel_ids = seed_channels(options, pool, rnd, user_ids)
+    totals = seed_topics(options, channel_ids, user_ids)
+    # Derived data: post counters, channel ranks, member counters, the
+    # activity feed and the search index
+    post_counters.repair()
+    rank_engine.reconcile()
+    fh.recount_member_postings()
+    activity_feed.rebuild()
+    search_index.rebuild()
+    db.commit()
+    totals.update({'users': options.users, 'channels': len(channel_ids)})
+    print('Seeded %(users)d users, %(channels)d channels, %(topics)d '
+          'topics and %(responses)d responses' % totals +
+          ' in %.1fs.' % (time.monotonic() - started))
+    return totals
+
+
+def main():
+    seed(parse_options())
+
+
+if __name__ == '__main__':
+    main()
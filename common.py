@@ -32,13 +32,43 @@ for item in settings.LOGGERS:
 
 # Main DB connection.
 
+def sqlite_pragmas(adapter):
+    """ Applies settings.DB_SQLITE_PRAGMAS to every new SQLite connection """
+    if adapter.dbengine == 'sqlite':
+        for pragma, value in settings.DB_SQLITE_PRAGMAS.items():
+            adapter.execute(f'PRAGMA {pragma}={value};')
+
 db = DAL(
     settings.DB_URI,
     folder=settings.DB_FOLDER,
     pool_size=settings.DB_POOL_SIZE,
-    migrate=settings.DB_MIGRATE
+    migrate=settings.DB_MIGRATE,
+    after_connection=sqlite_pragmas
 )
 
+# Read replica connection (tables are mirrored from db in models.py),
+# db itself when no replica is configured. Actions that read from it must
+# add db_read_fixtures to their @action.uses.
+if settings.DB_READ_URI:
+    db_read = DAL(
+        settings.DB_READ_URI,
+        folder=settings.DB_FOLDER,
+        pool_size=settings.DB_READ_POOL_SIZE,
+        migrate=False,
+        after_connection=sqlite_pragmas
+    )
+    db_read_fixtures = (db_read,)
+else:
+    db_read = db
+    db_read_fixtures = ()
+
+# Per-request query counters and slow-query log of both connections, add
+# sql_profiler (first) to the @action.uses of the actions to profile.
+from .sqlprofiler import SQLProfiler
+from .assets import asset
+
+sql_profiler = SQLProfiler(db, db_read, slow_ms=settings.SQL_SLOW_QUERY_MS)
+
 # #######################################################
 # define global objects that may or may not be used by the actions
 # #######################################################
@@ -143,10 +173,23 @@ if settings.OAUTH2FACEBOOK_CLIENT_ID:  # Untested
         )
     )
 
+# #######################################################
+# Optionally configure celery
+# #######################################################
+if settings.USE_CELERY:
+    from celery import Celery
+
+    # to use "from .common import scheduler" and then use it according
+    # to celery docs, examples in tasks.py
+    scheduler = Celery(
+        "apps.%s.tasks" % settings.APP_NAME, broker=settings.CELERY_BROKER
+    )
+
 # #######################################################
 # Enable authentication
 # #######################################################
-auth.enable(uses=(session, T, db), env={'T': T})
+# The auth pages extend zlayout.html as well, which links its assets
+auth.enable(uses=(session, T, db), env={'T': T, 'asset': asset})
 
 # #######################################################
 # Define convenience decorators
@@ -0,0 +1,87 @@
+"""
+Conditional GET (ETag / Last-Modified).
+Actions call not_modified() with the values their output is built from
+(cheap to read, like channel.last_activity_on and the post counters)
+before running the expensive queries and templates: the validators are
+added to the response and, when the client already has that version,
+304 Not Modified is answered right away.
+"""
+import hashlib
+import json
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from py4web import request, response
+from py4web.core import HTTP
+from .activityfeed import activity_feed
+from .assets import assets
+from .common import auth
+from .forumhelper import forumhelper as fh
+
+
+def _as_utc(value):
+    """ Timestamps are stored in UTC (see models.now), naive once read """
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).replace(microsecond=0)
+
+
+def etag_matches(etag, if_none_match):
+    """ True if the If-None-Match header lists etag (weak comparison) """
+    if if_none_match.strip() == '*':
+        return True
+    def opaque(tag):
+        tag = tag.strip()
+        return tag[2:] if tag.startswith('W/') else tag
+    return any(opaque(candidate) == opaque(etag)
+               for candidate in if_none_match.split(','))
+
+
+def is_fresh(headers, etag, last_modified=None):
+    """ True if the request headers show the client has etag/last_modified
+    (If-None-Match takes precedence over If-Modified-Since) """
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match:
+        return etag_matches(etag, if_none_match)
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return last_modified <= since
+    return False
+
+
+def not_modified(*parts, last_modified=None, personal=True):
+    """ Sets ETag/Last-Modified from parts (json serializable values the
+    output depends on) and last_modified (the newest change, a datetime),
+    raises 304 Not Modified if the client's copy is current. personal
+    outputs (html pages, with the header of the logged in user) depend on
+    the user as well.
+    """
+    parts = list(parts) + [assets.version()]
+    if personal:
+        # The header of the user and the activity sidebar of the layout
+        parts += [auth.user_id, fh.get_user_info(), activity_feed.version()]
+    digest = hashlib.sha1(json.dumps(
+        parts, default=str, sort_keys=True).encode('utf-8')).hexdigest()
+    etag = f'W/"{digest[:20]}"'
+    response.headers['ETag'] = etag
+    if last_modified is not None:
+        last_modified = _as_utc(last_modified)
+        response.headers['Last-Modified'] = format_datetime(
+            last_modified, usegmt=True)
+    # Cached, but always revalidated
+    response.headers['Cache-Control'] = \
+        'private, no-cache' if personal and auth.user_id else 'no-cache'
+    if request.method in ('GET', 'HEAD') and \
+            is_fresh(request.headers, etag, last_modified):
+        raise HTTP(304)
+
+
+def newest(*values):
+    """ The latest of the (possibly None) datetimes, or None """
+    values = [_as_utc(value) for value in values if value is not None]
+    return max(values) if values else None
@@ -28,15 +28,23 @@ else your app will result in undefined behavior
 
 import os, random, re
 from better_profanity import profanity
-from markdown import markdown
 from py4web import action, request, response, abort, redirect, URL
-from yatl.helpers import A, XML
-from ..common import db, T, auth
-from ..forumhelper import forumhelper as fh
+from yatl.helpers import A
+from ..common import db, db_read, db_read_fixtures, T, auth, sql_profiler
+from ..activityfeed import activity_feed, activity_sidebar
+from ..forumhelper import forumhelper as fh, user_info
+from ..imagejobs import image_jobs
+from ..assets import asset_fixture
+from ..conditional import not_modified, newest
+from ..pagecache import page_cache
+from ..rendercache import render_cache
+from ..viewcounter import view_counter
+from ..search import search_index
 from ..settings import Z_EXTERNAL_IMAGES, Z_INTERNAL_IMAGES
 
 @action('channel/new', method=['get', 'post'])
-@action.uses('channel/new.html', auth, T)
+@action.uses('channel/new.html', asset_fixture, user_info, activity_sidebar,
+             auth, T, image_jobs)
 def channel_new():
     """ New Channel Page - Authenticated Users """
     errors = []
@@ -104,12 +112,16 @@ def channel_new():
                     banner=banner,
                     is_private=is_private,
                     requires_membership=requires_membership)
-                # Store image if available
-                if channel_banner is not None:
-                    fh.store_channel_banner(channel_id, channel_banner)
                 # Make the logged in user the channel admin by default
                 fh.grant_channel_admin(channel_id, user['id'])
-                return redirect(URL(f'c/{tag}', vars={'new': 'true'}))
+                search_index.index_channel(channel_id, title, content)
+                page_cache.bump('channels')
+                # Store image if available, processed in the background
+                redirect_vars = {'new': 'true'}
+                if channel_banner is not None:
+                    redirect_vars['image_job'] = fh.store_channel_banner(
+                        channel_id, channel_banner, user['id'])
+                return redirect(URL(f'c/{tag}', vars=redirect_vars))
         else:
             return redirect(URL('index'))
 
@@ -117,7 +129,8 @@ def channel_new():
 
 # Admin a channel
 @action('channel/admin/<channel_id>', method=['get', 'post'])
-@action.uses('channel/admin.html', auth, T)
+@action.uses('channel/admin.html', asset_fixture, user_info,
+             activity_sidebar, auth, T, image_jobs)
 def channel_admin(channel_id):
     """ Channel Administration via Sys Admin Or Channel Admin """
     errors = []
@@ -125,9 +138,7 @@ def channel_admin(channel_id):
     if user is None:
         redirect(URL('exception'))
     # User must be a system admin or a channel_admin
-    c_admin = fh.is_channel_admin(user['id'], channel_id)
-    s_admin = fh.is_sysadmin(user['id'])
-    if c_admin or s_admin:
+    if fh.can_admin_channel(channel_id, user['id']):
         form_submitted = request.method == 'POST'
         channel = db(db.channel.id==channel_id).select().first()
         if channel:
@@ -137,9 +148,9 @@ def channel_admin(channel_id):
                 'id': str(channel.id),
                 'tag': channel.tag,
                 'title': channel.title,
-                'title_marked': markdown(channel.title),
+                'title_marked': render_cache.render(channel.title),
                 'content': channel.content,
-                'content_marked': markdown(channel.content),
+                'content_marked': render_cache.render(channel.content),
                 'banner': channel_banner,
                 'banner_naked': channel.banner,
                 'is_private': channel.is_private,
@@ -189,6 +200,10 @@ def channel_admin(channel_id):
                             banner=banner_name,
                             is_private=is_private,
                             requires_membership=requires_membership)
+                        search_index.index_channel(channel.id, title, content)
+                        activity_feed.channel_changed(channel)
+                        page_cache.bump('channel', channel.id)
+                        page_cache.bump('channels')
                         # Store/Replace banner image if available
                         # Remove an existing banner only if you select a new
                         # image and there is an exiting one already or user
@@ -204,9 +219,13 @@ def channel_admin(channel_id):
                             if os.path.isfile(cur_banner_filename):
                                 os.unlink(cur_banner_filename)
                         if new_channel_banner is not None:
-                            fh.store_channel_banner(
+                            # Processed in the background
+                            image_job = fh.store_channel_banner(
                                 channel_id,
-                                new_channel_banner)
+                                new_channel_banner,
+                                user['id'])
+                            redirect(URL(f'c/{channel.tag}',
+                                         vars={'image_job': image_job}))
                     if errors:
                         return {
                             'channel_info': channel_info,
@@ -227,20 +246,24 @@ def channel_admin(channel_id):
 
 # Main Channel Index
 @action('c/<tag>')
-@action.uses('channel/index.html', auth, T)
+@action.uses(sql_profiler, page_cache, 'channel/index.html', asset_fixture,
+             user_info, activity_sidebar, auth, T, *db_read_fixtures)
 def channel_index(tag):
-    """ Main Index for a channel """
+    """ Main Index for a channel, served from the page cache to anonymous
+    visitors, logged in users share the cached topics """
     # Does it exist
-    channel = db(db.channel.tag==tag).select(db.channel.ALL).first()
+    channel = db_read(db_read.channel.tag==tag).select(
+        db_read.channel.ALL).first()
     if channel:
-        # Update the channel "views"
-        channel.view += 1
-        channel.update_record()
+        page_cache.depends('channel', channel.id)
+        # Update the channel "views", buffered, see viewcounter.py, cached
+        # pages count theirs as well
+        view_counter.hit('channel', channel.id)
+        page_cache.on_hit(view_counter.hit, 'channel', channel.id)
         user = auth.get_user()
         can_admin_channel = False
         if 'id' in user:
-            can_admin_channel = fh.is_channel_admin(
-                user['id'], channel.id) or fh.is_sysadmin(user['id'])
+            can_admin_channel = fh.can_admin_channel(channel.id, user['id'])
         # TODO Handle considerations for private/membership channels
         is_private = channel.is_private
         requires_membership = channel.requires_membership
@@ -248,16 +271,24 @@ def channel_index(tag):
         if requires_membership:
             # If membership is required, see if you are a member of the channel
             membership_status = fh.get_channel_membership(channel['id'])
+        # 304 if the client has this version of the page already, the
+        # topics of the channel are summed up by its counters
+        not_modified(
+            channel.id, channel.modified_on, channel.last_activity_on,
+            channel.topic_count, channel.response_count, channel.hot_version,
+            can_admin_channel, membership_status,
+            last_modified=newest(channel.modified_on,
+                                 channel.last_activity_on))
         channel_banner = fh.retrieve_channel_banner(
             channel.id, channel.banner)
         channel_info = {
             'id': str(channel.id),
             'tag': channel.tag,
             'title': channel.title,
-            'title_marked': markdown(XML(channel.title, sanitize=True).xml()),
+            'title_marked': render_cache.render(channel.title, sanitize=True),
             'content': channel.content,
-            'content_marked': markdown(
-                XML(channel.content, sanitize=True).xml()),
+            'content_marked': render_cache.render(
+                channel.content, sanitize=True),
             'banner': channel_banner,
             'is_private': is_private,
             'is_channel_member': membership_status['has_membership'] and not \
@@ -266,29 +297,84 @@ def channel_index(tag):
             'requires_membership': requires_membership,
             'can_admin_channel': can_admin_channel
         }
-        topic_qry = db.topic.channel_id == channel.id
-        topic_qry &= db.topic.is_parent == True
-        topics = db(topic_qry).select(
-            db.topic.title,
-            db.topic.content,
-            db.auth_user.username,
-            left=db.auth_user.on(db.topic.created_by == db.auth_user.id),
-            orderby=db.topic.is_promoted|~db.topic.modified_on)
+        # Only the first page is rendered, the rest is lazy loaded via
+        # channel/topics/<tag> using the returned cursor.
+        cursor = request.query.get('cursor')
+        topics_body = page_cache.fragment(
+            ('channel-topics', channel.id, cursor),
+            [('channel', channel.id)],
+            lambda: _render_channel_topics(channel, cursor))
+        # Set after a banner/images upload, the page polls the job status
+        image_job = request.query.get('image_job', '')
         payload = {
             'tag': tag,
             'channel_info': channel_info,
-            'topics': topics
+            'topics_body': topics_body,
+            'image_job': int(image_job) if image_job.isdigit() else None
         }
         return payload
     return redirect(URL('ex/tagnotfound'))
 
+def _render_channel_topics(channel, cursor):
+    """ {'html', 'has_topics'} of a page of topics of the channel, the
+    same for every user (see pagecache.py) """
+    topics, next_cursor = fh.get_channel_topics(channel.id, cursor)
+    return {
+        'html': page_cache.render(
+            'channel/topics.html', tag=channel.tag, topics=topics,
+            next_cursor=next_cursor),
+        'has_topics': bool(topics)
+    }
+
+@action('channel/topics/<tag>')
+@action.uses(sql_profiler, auth, *db_read_fixtures)
+def channel_topics(tag):
+    """ JSON endpoint, returns a page of topics for a channel starting at
+    the (optional) cursor query variable, used to lazy load topics from
+    the channel index page.
+    """
+    channel = db_read(db_read.channel.tag==tag).select(
+        db_read.channel.id, db_read.channel.requires_membership,
+        db_read.channel.modified_on, db_read.channel.last_activity_on,
+        db_read.channel.topic_count, db_read.channel.response_count,
+        db_read.channel.hot_version).first()
+    if not channel:
+        abort(404)
+    if channel.requires_membership:
+        membership_status = fh.get_channel_membership(channel.id)
+        if not membership_status['has_membership'] or \
+            membership_status['is_pending']:
+            abort(403)
+    not_modified(
+        channel.id, channel.modified_on, channel.last_activity_on,
+        channel.topic_count, channel.response_count, channel.hot_version,
+        last_modified=newest(channel.modified_on, channel.last_activity_on),
+        personal=False)
+    topics, next_cursor = fh.get_channel_topics(
+        channel.id, request.query.get('cursor'))
+    return {
+        'topics': [{
+            'id': row.topic.id,
+            'url': URL(f'c/{tag}/t/{row.topic.id}'),
+            'title': row.topic.title,
+            'teaser': row.topic.teaser or '',
+            'username': row.auth_user.username,
+            'is_promoted': row.topic.is_promoted,
+            'reply_count': row.topic.reply_count or 0,
+            'last_reply_on': row.topic.last_reply_on.isoformat() \
+                if row.topic.last_reply_on else None
+        } for row in topics],
+        'next_cursor': next_cursor
+    }
+
 @action('c/<tag>/<channel_action>')
 def channel_action(tag, channel_action):
     """ GET actions for channel """
     redirect(URL(f'c/{tag}', vars={'subscribed': 'true'}))
 
 @action('channel/all')
-@action.uses('channel/all.html', auth, T)
+@action.uses(sql_profiler, page_cache, 'channel/all.html', asset_fixture,
+             user_info, activity_sidebar, auth, T, *db_read_fixtures)
 def channels():
     """ Retrieves all channels that the user is allowed to
     access, channels that are returned are those in which:
@@ -299,21 +385,51 @@ def channels():
     those channels with more topic views and upvotes should be moved higher,
     another option is to order by the last date any of its topics were 
     """
-    qry = db.channel.is_private == False
+    page_cache.depends('channels')
+    qry = db_read.channel.is_private == False
     if fh.is_sysadmin():
         # Don't hide private channels from sysadmins..
-        qry = db.channel.id > 0
-    all_channels = db(qry).select(db.channel.ALL, orderby=(
-        ~db.channel.view | ~db.channel.modified_on))
+        qry = db_read.channel.id > 0
+    # Only a page of channels is rendered, searching goes thru the server
+    # side index (see controllers/search.py)
+    try:
+        page = max(int(request.query.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    page_size = fh.get_page_size()
+    # 304 if none of the listed channels changed (rank included, it orders
+    # the list) since the client's copy
+    channel_count = db_read.channel.id.count()
+    last_modified = db_read.channel.modified_on.max()
+    last_activity = db_read.channel.last_activity_on.max()
+    rank_total = db_read.channel.rank.sum()
+    topic_total = db_read.channel.topic_count.sum()
+    response_total = db_read.channel.response_count.sum()
+    summary = db_read(qry).select(
+        channel_count, last_modified, last_activity, rank_total, topic_total,
+        response_total).first()
+    not_modified(
+        summary[channel_count], summary[rank_total], summary[topic_total],
+        summary[response_total], summary[last_modified],
+        summary[last_activity], page_size,
+        last_modified=newest(summary[last_modified], summary[last_activity]))
+    # channel.rank is maintained by the rank engine (rankengine.py)
+    all_channels = db_read(qry).select(
+        db_read.channel.ALL,
+        orderby=(~db_read.channel.rank | ~db_read.channel.modified_on |
+                 ~db_read.channel.id),
+        limitby=((page - 1) * page_size, page * page_size + 1))
     channel_list = []
-    for c in all_channels:
+    for c in all_channels[:page_size]:
         channel_list.append({
             'channel': c,
-            'title_marked': markdown(c.title),
-            'content_marked': markdown(c.content)
+            'title_marked': render_cache.render(c.title),
+            'content_marked': render_cache.render(c.content)
         })
     return {
         'channels': channel_list,
+        'page': page,
+        'has_more': len(all_channels) > page_size,
         'channel_desc': 'Available Channels.'
     }
 
@@ -0,0 +1,48 @@
+"""
+This file defines actions, i.e. functions the URLs are mapped into
+The @action(path) decorator exposed the function at URL:
+
+    http://127.0.0.1:8000/{app_name}/{path}
+
+If app_name == '_default' then simply
+
+    http://127.0.0.1:8000/{path}
+
+If path == 'index' it can be omitted:
+
+    http://127.0.0.1:8000/
+
+The path follows the bottlepy syntax.
+
+@action.uses('generic.html')  indicates that the action uses generic.html
+@action.uses(session)         indicates that the action uses the session
+@action.uses(db)              indicates that the action uses the db
+@action.uses(T)               indicates that the action uses the i18n
+@action.uses(auth.user)       indicates that the action requires logged in user
+@action.uses(auth)            indicates that the action requires auth object
+
+session, db, T, auth, and tempates are examples of Fixtures.
+Warning: Fixtures MUST be declared with @action.uses({fixtures})
+else your app will result in undefined behavior
+"""
+
+from py4web import action, abort
+from ..common import auth
+from ..forumhelper import forumhelper as fh
+from ..imagejobs import image_jobs
+
+@action('image/job/<job_id:int>')
+@action.uses(auth)
+def image_job(job_id):
+    """ JSON endpoint, status (pending, done, failed) of an image job,
+    polled by the pages waiting for uploaded images to be processed.
+    Only the user that submitted the job (or a system admin) can see it.
+    """
+    user_id = auth.user_id
+    status = image_jobs.status(job_id)
+    if status is None:
+        abort(404)
+    if not user_id or (status.pop('created_by') != user_id and
+                       not fh.is_sysadmin()):
+        abort(403)
+    return status
@@ -0,0 +1,51 @@
+"""
+This file defines actions, i.e. functions the URLs are mapped into
+The @action(path) decorator exposed the function at URL:
+
+    http://127.0.0.1:8000/{app_name}/{path}
+
+If app_name == '_default' then simply
+
+    http://127.0.0.1:8000/{path}
+
+If path == 'index' it can be omitted:
+
+    http://127.0.0.1:8000/
+
+The path follows the bottlepy syntax.
+
+@action.uses('generic.html')  indicates that the action uses generic.html
+@action.uses(session)         indicates that the action uses the session
+@action.uses(db)              indicates that the action uses the db
+@action.uses(T)               indicates that the action uses the i18n
+@action.uses(auth.user)       indicates that the action requires logged in user
+@action.uses(auth)            indicates that the action requires auth object
+
+session, db, T, auth, and tempates are examples of Fixtures.
+Warning: Fixtures MUST be declared with @action.uses({fixtures})
+else your app will result in undefined behavior
+"""
+
+from py4web import action, request
+from ..common import auth, sql_profiler
+from ..forumhelper import forumhelper as fh
+from ..search import search_index
+
+@action('search')
+@action.uses(sql_profiler, auth)
+def search():
+    """ JSON endpoint, ranked and paginated search over channels and
+    topics, query variables: q (search terms) and page (1 based).
+    Private channels are only searched by system admins, the topics of
+    channels requiring membership by their (accepted) members.
+    """
+    query = request.query.get('q', '').strip()[:128]
+    try:
+        page = max(int(request.query.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    permissions = fh.get_permissions()
+    return search_index.search(
+        query, page=page, page_size=fh.get_page_size(),
+        include_private=permissions.is_sysadmin,
+        member_channels=permissions.member_channels)
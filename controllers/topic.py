@@ -26,13 +26,24 @@ Warning: Fixtures MUST be declared with @action.uses({fixtures})
 else your app will result in undefined behavior
 """
 
-from markdown import markdown
-from py4web import action, redirect, URL, request
-from ..common import db, session, T, auth
-from ..forumhelper import forumhelper as fh
+from py4web import action, abort, redirect, URL, request
+from ..common import db, db_read, db_read_fixtures, session, T, auth, \
+    sql_profiler
+from ..activityfeed import activity_feed, activity_sidebar
+from ..forumhelper import forumhelper as fh, user_info
+from ..imagejobs import image_jobs
+from ..imagestore import ImageError
+from ..assets import asset_fixture
+from ..conditional import not_modified, newest
+from ..rendercache import render_cache
+from ..postcounters import post_counters
+from ..search import search_index
+from ..trending import trending
+from ..viewcounter import view_counter
 
 @action('c/<channel_tag>/topic/new', method=['get', 'post'])
-@action.uses('topic/new.html', auth, session, T)
+@action.uses(sql_profiler, 'topic/new.html', asset_fixture, user_info,
+             activity_sidebar, auth, session, T, image_jobs)
 def new_topic(channel_tag):
     """ New Topic form, only allowed if the user is authenticated,
     and either The channel is public
@@ -43,58 +54,312 @@ def new_topic(channel_tag):
     """
     user = auth.get_user()
     channel = db(db.channel.tag==channel_tag).select(db.channel.ALL).first()
-    is_admin = fh.is_sysadmin()
-    is_channel_admin = fh.is_channel_admin(user['id'], channel['id'])
     if not user:
         redirect(URL('ex/unauthorized'))
     if not channel:
         redirect(URL('ex/tagnotfound'))
+    # Resolved once for the request, see permissions.py
+    permissions = fh.get_permissions(user['id'])
+    is_admin = permissions.is_sysadmin
+    is_channel_admin = permissions.is_channel_admin(channel.id)
     # TODO Handle considerations for private/membership channels
     is_private = channel.is_private
     requires_membership = channel.requires_membership
+    errors = []
     if request.method == 'POST':
         # Allow post if channel is public, or channel requires embership and
         # user has membership, or user is admin.
         # private channels are still accessible, they just are not advertised
-        user_membership_info = fh.get_channel_membership(channel['id'])
+        user_membership_info = permissions.channel_membership(channel.id)
         if not requires_membership or (requires_membership and \
             user_membership_info.get('has_membership')) or is_admin:
             form = request.forms
             if 'submit-topic' in form:
                 t_title = form.get('topic-title', '')
                 t_content = form.get('topic-content', '')
-                t_images = request.files.get('topic-images', None)
-                # Create the topic
-                topic_id = db.topic.insert(
-                    is_parent = True,
-                    channel_id=channel.id,
-                    title = t_title,
-                    content = t_content,
-                    created_by = user['id'],
-                    modified_by = user['id']
-                )
-                fh.add_topic_images(topic_id, t_images)
-            redirect(URL(f'c/{channel.tag}'))
+                # Images are streamed to the image store before creating
+                # the topic, so a rejected image does not leave a topic
+                # behind (see imagestore.py)
+                try:
+                    t_images = fh.store_topic_images(
+                        request.files.getall('topic-images'))
+                except ImageError as error:
+                    errors.append(str(error))
+                # System admins can post system announcements
+                is_system = is_admin and bool(form.get('is-system'))
+                if not errors:
+                    # Create the topic
+                    topic_id = db.topic.insert(
+                        is_parent = True,
+                        channel_id=channel.id,
+                        title = t_title,
+                        content = t_content,
+                        teaser = fh.make_topic_teaser(t_content),
+                        is_system = is_system,
+                        created_by = user['id'],
+                        modified_by = user['id']
+                    )
+                    image_job = fh.add_topic_images(
+                        topic_id, t_images, user['id'])
+                    post_counters.topic_added(
+                        channel.id, topic_id, user_id=user['id'])
+                    activity_feed.post_added(
+                        channel, topic_id, t_title, user,
+                        is_system=is_system)
+                    search_index.index_topic(
+                        topic_id, channel.id, t_title, t_content)
+                    if image_job:
+                        # Thumbnails are generated in the background
+                        redirect(URL(f'c/{channel.tag}',
+                                     vars={'image_job': image_job}))
+            if not errors:
+                redirect(URL(f'c/{channel.tag}'))
         else:
             redirect(URL('ex/unauthorized'))
-    else:
-        channel_banner = fh.retrieve_channel_banner(
-            channel.id, channel.banner)
-        channel_info = {
-            'id': str(channel.id),
-            'tag': channel.tag,
-            'title': channel.title,
-            'title_marked': markdown(channel.title),
-            'content': channel.content,
-            'content_marked': markdown(channel.content),
-            'banner': channel_banner,
-            'is_private': is_private,
-            'requires_membership': requires_membership,
-            'can_admin_channel': is_channel_admin or is_admin
-        }
-        return {'channel_info': channel_info}
+    channel_banner = fh.retrieve_channel_banner(
+        channel.id, channel.banner)
+    channel_info = {
+        'id': str(channel.id),
+        'tag': channel.tag,
+        'title': channel.title,
+        'title_marked': render_cache.render(channel.title),
+        'content': channel.content,
+        'content_marked': render_cache.render(channel.content),
+        'banner': channel_banner,
+        'is_private': is_private,
+        'requires_membership': requires_membership,
+        'can_admin_channel': is_channel_admin or is_admin
+    }
+    return {
+        'channel_info': channel_info,
+        'can_announce': is_admin,
+        'errors': errors
+    }
+
 
+def _reply_info(reply, authors, images):
+    """ Display payload of a response, see view_topic/topic_replies """
+    author = authors.get(reply.created_by) or {
+        'username': '', 'display_name': '', 'avatar_url': None,
+        'postings': 0, 'rank': None}
+    return {
+        'id': reply.id,
+        'content_marked': render_cache.render(reply.content, sanitize=True),
+        'upvote': reply.upvote or 0,
+        'created_on': reply.created_on.isoformat() \
+            if reply.created_on else None,
+        'author': author,
+        'images': images.get(reply.id, [])
+    }
+
+def _can_read_channel(channel):
+    """ Membership channels are only readable by (accepted) members """
+    if not channel.requires_membership:
+        return True
+    membership_status = fh.get_channel_membership(channel.id)
+    return membership_status['has_membership'] and \
+        not membership_status['is_pending']
 
 # View Topic and responses to the topic, optionally allow adding a reply
-# Eg. /c/WoodWorkingMistakes/25
-# TODO
\ No newline at end of file
+# Eg. /c/WoodWorkingMistakes/t/25
+@action('c/<channel_tag>/t/<topic_id:int>', method=['get', 'post'])
+@action.uses(sql_profiler, 'topic/view.html', asset_fixture, user_info,
+             activity_sidebar, auth, session, T, image_jobs,
+             *db_read_fixtures)
+def view_topic(channel_tag, topic_id):
+    """ Topic and the first page of its responses, further pages are lazy
+    loaded thru topic/replies/<topic_id>. Posting reply-content adds a
+    response (authenticated users allowed to read the channel).
+    """
+    channel = db_read(db_read.channel.tag==channel_tag).select(
+        db_read.channel.ALL).first()
+    if not channel:
+        redirect(URL('ex/tagnotfound'))
+    topic = db_read(
+        (db_read.topic.id==topic_id) &
+        (db_read.topic.channel_id==channel.id) &
+        (db_read.topic.is_parent==True)).select(db_read.topic.ALL).first()
+    if not topic or (not topic.is_visible and not fh.is_sysadmin()):
+        redirect(URL('ex/topicnotfound'))
+    if not _can_read_channel(channel) and not fh.is_sysadmin():
+        redirect(URL('ex/unauthorized'))
+    user = auth.get_user()
+
+    errors = []
+    if request.method == 'POST':
+        if not user or topic.is_readonly:
+            redirect(URL('ex/unauthorized'))
+        content = request.forms.get('reply-content', '').strip()
+        if 'submit-reply' in request.forms and content:
+            try:
+                images = fh.store_topic_images(
+                    request.files.getall('reply-images'))
+            except ImageError as error:
+                errors.append(str(error))
+            if not errors:
+                reply_id = db.topic.insert(
+                    is_parent=False,
+                    parent_id=topic.id,
+                    channel_id=channel.id,
+                    content=content,
+                    created_by=user['id'],
+                    modified_by=user['id']
+                )
+                fh.add_topic_images(reply_id, images, user['id'])
+                post_counters.topic_added(
+                    channel.id, reply_id, parent_id=topic.id,
+                    user_id=user['id'])
+                activity_feed.post_added(
+                    channel, topic.id, topic.title, user, post_id=reply_id)
+        if not errors:
+            redirect(URL(f'c/{channel.tag}/t/{topic.id}'))
+
+    # Update the topic "views", buffered, see viewcounter.py. Counted
+    # before the 304 below on purpose: a client revalidating its copy is
+    # viewing the topic again (as cached channel pages count, see
+    # page_cache.on_hit)
+    view_counter.hit('topic', topic.id)
+    if request.method == 'GET':
+        # 304 if the client has this version of the thread already. Not
+        # the view count, it changes with every flush and would void the
+        # ETag of a thread nobody posted to, the count shown is approximate
+        # anyway
+        not_modified(
+            channel.modified_on, topic.id, topic.modified_on,
+            topic.reply_count, topic.last_reply_on, topic.is_readonly,
+            last_modified=newest(channel.modified_on, topic.modified_on,
+                                 topic.last_reply_on))
+    replies, next_cursor = fh.get_topic_replies(
+        topic.id, request.query.get('cursor'))
+    # Authors of the topic and of the whole page in a single query
+    authors = fh.get_authors(
+        [topic.created_by] + [reply.created_by for reply in replies])
+    # Images (thumbnails) of the topic and of the page, also in one query
+    images = fh.get_topic_images(
+        [topic.id] + [reply.id for reply in replies])
+    channel_info = {
+        'id': str(channel.id),
+        'tag': channel.tag,
+        'title': channel.title,
+        'title_marked': render_cache.render(channel.title, sanitize=True),
+        'content': channel.content,
+        'content_marked': render_cache.render(channel.content, sanitize=True),
+        'banner': fh.retrieve_channel_banner(channel.id, channel.banner)
+    }
+    topic_info = {
+        'id': topic.id,
+        'title': topic.title,
+        'content_marked': render_cache.render(topic.content, sanitize=True),
+        'created_on': topic.created_on,
+        'view': topic.view or 0,
+        'reply_count': topic.reply_count or 0,
+        'is_readonly': topic.is_readonly,
+        'author': authors.get(topic.created_by) or {
+            'username': '', 'display_name': '', 'avatar_url': None,
+            'postings': 0, 'rank': None},
+        'images': images.get(topic.id, [])
+    }
+    return {
+        'channel_info': channel_info,
+        'topic_info': topic_info,
+        'replies': [_reply_info(reply, authors, images) for reply in replies],
+        'next_cursor': next_cursor,
+        'can_reply': bool(user) and not topic.is_readonly,
+        'can_delete': bool(user) and fh.can_admin_channel(channel.id),
+        'errors': errors
+    }
+
+@action('c/<channel_tag>/t/<post_id:int>/delete', method=['post'])
+@action.uses(sql_profiler, auth, session)
+def delete_post(channel_tag, post_id):
+    """ Deletes a topic (along with its responses) or a response, channel
+    admins and system admins only. The counters (see postcounters.py), the
+    search index, the activity feed and the images follow.
+    """
+    channel = db(db.channel.tag==channel_tag).select(
+        db.channel.id, db.channel.tag).first()
+    if not channel:
+        redirect(URL('ex/tagnotfound'))
+    post = db((db.topic.id==post_id) &
+              (db.topic.channel_id==channel.id)).select(
+        db.topic.id, db.topic.channel_id, db.topic.is_parent,
+        db.topic.parent_id, db.topic.reply_count,
+        db.topic.created_by).first()
+    if not post:
+        redirect(URL('ex/topicnotfound'))
+    if not auth.user_id or not fh.can_admin_channel(channel.id):
+        redirect(URL('ex/unauthorized'))
+    post_ids = [post.id]
+    if post.is_parent:
+        post_ids += [row.id for row in db(
+            db.topic.parent_id==post.id).select(db.topic.id)]
+    post_counters.topic_removed(post)
+    activity_feed.posts_removed(post_ids)
+    fh.remove_topic_images(post_ids)
+    if post.is_parent:
+        search_index.remove_topic(post.id)
+    db(db.topic.id.belongs(post_ids)).delete()
+    if post.is_parent:
+        redirect(URL(f'c/{channel.tag}'))
+    redirect(URL(f'c/{channel.tag}/t/{post.parent_id}'))
+
+@action('topic/hot')
+@action.uses(sql_profiler, auth, *db_read_fixtures)
+def hot_topics():
+    """ JSON endpoint, the trending topics (see trending.py) site-wide or
+    of the channel query variable (tag), hottest first
+    """
+    channel_id = None
+    tag = request.query.get('channel')
+    if tag:
+        channel = db_read(db_read.channel.tag==tag).select(
+            db_read.channel.id, db_read.channel.requires_membership).first()
+        if not channel:
+            abort(404)
+        if not _can_read_channel(channel):
+            abort(403)
+        channel_id = channel.id
+    return {
+        'topics': [{
+            'id': row.topic.id,
+            'url': URL(f'c/{row.channel.tag}/t/{row.topic.id}'),
+            'title': row.topic.title,
+            'teaser': row.topic.teaser or '',
+            'channel': row.channel.tag,
+            'reply_count': row.topic.reply_count or 0,
+            'hot_score': row.topic.hot_score,
+            'is_hot': row.topic.is_hot
+        } for row in trending.hot_topics(channel_id)]
+    }
+
+@action('topic/replies/<topic_id:int>')
+@action.uses(sql_profiler, auth, *db_read_fixtures)
+def topic_replies(topic_id):
+    """ JSON endpoint, returns a page (zfss_responses_per_page) of responses
+    to a topic starting at the (optional) cursor query variable, used to
+    lazy load responses from the topic page.
+    """
+    topic = db_read(
+        (db_read.topic.id==topic_id) & (db_read.topic.is_parent==True) &
+        (db_read.topic.is_visible==True)).select(
+            db_read.topic.id, db_read.topic.channel_id,
+            db_read.topic.modified_on, db_read.topic.reply_count,
+            db_read.topic.last_reply_on).first()
+    if not topic:
+        abort(404)
+    channel = db_read(db_read.channel.id==topic.channel_id).select(
+        db_read.channel.id, db_read.channel.requires_membership).first()
+    if not channel or not _can_read_channel(channel):
+        abort(403)
+    not_modified(
+        topic.id, topic.modified_on, topic.reply_count, topic.last_reply_on,
+        last_modified=newest(topic.modified_on, topic.last_reply_on),
+        personal=False)
+    replies, next_cursor = fh.get_topic_replies(
+        topic.id, request.query.get('cursor'))
+    authors = fh.get_authors([reply.created_by for reply in replies])
+    images = fh.get_topic_images([reply.id for reply in replies])
+    return {
+        'replies': [_reply_info(reply, authors, images) for reply in replies],
+        'next_cursor': next_cursor
+    }
\ No newline at end of file
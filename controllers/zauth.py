@@ -26,15 +26,20 @@ Warning: Fixtures MUST be declared with @action.uses({fixtures})
 else your app will result in undefined behavior
 """
 
+import base64
 import random
-from py4web import action, request, redirect, URL
+from py4web import action, request, response, abort, redirect, URL
 from py4web.utils.grid import Grid
-from ..common import db, session, T, auth
-from ..forumhelper import forumhelper as fh
+from ..common import db, session, T, auth, sql_profiler
+from ..activityfeed import activity_sidebar
+from ..forumhelper import forumhelper as fh, user_info
+from ..assets import asset_fixture
+from ..pagecache import page_cache
+from ..rendercache import render_cache
 from pydal.validators import CRYPT
 
 @action('zauth/login', method=['get', 'post'])
-@action.uses('zauth/login.html', auth, session)
+@action.uses('zauth/login.html', asset_fixture, auth, session)
 def auth_login():
     """ Custom Login Page """
     req = request
@@ -64,7 +69,7 @@ def auth_login():
     return redirect(URL('index'))
 
 @action('zauth/register', method=['get', 'post'])
-@action.uses('zauth/register.html')
+@action.uses('zauth/register.html', asset_fixture)
 def auth_register():
     """ Register override """
     req = request
@@ -111,7 +116,7 @@ def auth_register():
     return redirect(URL('index', vars={'action': '' if is_cancel else 'reg'}))
 
 @action('zauth/request_reset_password', method=['get', 'post'])
-@action.uses('zauth/reset.html', auth)
+@action.uses('zauth/reset.html', asset_fixture, auth)
 def auth_request_reset_password():
     """ Custom Request Password Reset """
     req = request
@@ -134,7 +139,8 @@ def auth_request_reset_password():
 
 @action('zauth/profile/<user_id>', method=['get', 'post'])
 @action('zauth/profile', method=['get', 'post'])
-@action.uses('zauth/profile.html', auth, db, session, T)
+@action.uses(sql_profiler, 'zauth/profile.html', asset_fixture, user_info,
+             activity_sidebar, auth, db, session, T)
 def profile(user_id=None):
     """ Main user profile, not entirely similar to OOB """
     errors = []
@@ -254,7 +260,8 @@ def profile(user_id=None):
     }
 
 @action('zauth/system_admin', method=['get', 'post'])
-@action.uses('zauth/system_admin.html', auth, db, session, T)
+@action.uses(sql_profiler, 'zauth/system_admin.html', asset_fixture,
+             user_info, activity_sidebar, auth, db, session, T)
 def system_admin():
     """ System Administration Page """
     errors = {}
@@ -282,6 +289,11 @@ def system_admin():
                     rec = db(db.system_setting.name==setting['name']).select().first()
                     rec.update_record(value=form.get(setting['name']))
                     payload_updated = 'System Updated'
+            if payload_updated == 'System Updated':
+                # Settings are served from an in-memory snapshot, commit
+                # first so a concurrent reload can't cache the old values
+                db.commit()
+                fh.invalidate_system_properties()
         else: # Cancel
             redirect(URL('index'))
 
@@ -291,6 +303,47 @@ def system_admin():
 
     return payload
 
+@action('zauth/sql_stats', method=['get', 'post'])
+@action.uses('zauth/sql_stats.html', asset_fixture, user_info,
+             activity_sidebar, auth, session, T)
+def sql_stats():
+    """ Query counters per action and slow queries (see sqlprofiler.py),
+    posting reset-button clears them
+    """
+    if not fh.is_sysadmin():
+        redirect(URL('ex/unauthorized'))
+
+    if request.method == 'POST' and 'reset-button' in request.forms:
+        sql_profiler.reset()
+        redirect(URL('zauth/sql_stats'))
+
+    return {
+        'actions': sql_profiler.stats(),
+        'slow_queries': sql_profiler.slow_queries(),
+        'slow_ms': sql_profiler.slow_ms,
+        'render_cache': render_cache.stats(),
+        'page_cache': page_cache.stats()
+    }
+
+@action('zauth/avatar/<user_id:int>')
+@action.uses(db)
+def avatar(user_id):
+    """ Serves the (base64 encoded) avatar of a member """
+    if not fh.get_system_property('zfss_allow_member_avatars', ''):
+        abort(404)
+    member_avatar = db(db.member_avatar.user_id==user_id).select(
+        db.member_avatar.avatar, db.member_avatar.content_type).first()
+    if not member_avatar or not member_avatar.avatar:
+        abort(404)
+    try:
+        payload = base64.b64decode(member_avatar.avatar)
+    except ValueError:
+        abort(404)
+    response.headers['Content-Type'] = member_avatar.content_type or \
+        'application/octet-stream'
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return payload
+
 # Generate own tokens, users can generate their own auth tokens, 
 # they must be authenticated to use this feature.
 @action('zauth/token')
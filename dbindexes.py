@@ -0,0 +1,87 @@
+"""
+Managed database indexes.
+pyDAL does not create indexes from the model, the indexes needed by the
+hot query paths are listed here and created (idempotently, using
+CREATE INDEX IF NOT EXISTS) at startup on SQLite and PostgreSQL.
+"""
+from .common import logger
+
+# Engines known to support CREATE [UNIQUE] INDEX IF NOT EXISTS and
+# expression indexes
+SUPPORTED_ENGINES = ('sqlite', 'postgres')
+
+# (index name, table, columns, unique), a column may be an expression with
+# {field} placeholders, e.g. 'LOWER({tag})'
+INDEXES = [
+    # c/<tag> lookups, and tag uniqueness regardless of capitalization
+    ('zf_channel_tag_idx', 'channel', ['tag'], False),
+    ('zf_channel_tag_lower_uidx', 'channel', ['LOWER({tag})'], True),
+    # channel/all ordering
+    ('zf_channel_rank_idx', 'channel', ['rank', 'modified_on'], False),
+    # Channel topic listing (keyset pagination)
+    ('zf_topic_channel_listing_idx', 'topic',
+     ['channel_id', 'is_parent', 'is_promoted', 'modified_on', 'id'], False),
+    # Responses of a topic
+    ('zf_topic_parent_idx', 'topic', ['parent_id', 'created_on', 'id'], False),
+    ('zf_topic_created_by_idx', 'topic', ['created_by'], False),
+    ('zf_topic_image_topic_idx', 'topic_image', ['topic_id'], False),
+    # Hot listings (see trending.py), per channel and site-wide
+    ('zf_topic_channel_hot_idx', 'topic',
+     ['channel_id', 'is_parent', 'hot_score'], False),
+    ('zf_topic_hot_idx', 'topic', ['is_parent', 'hot_score'], False),
+    ('zf_topic_activity_bucket_idx', 'topic_activity_bucket',
+     ['bucket_start', 'topic_id'], False),
+    # Activity feed reads (newest public entries) and pruning
+    ('zf_activity_feed_kind_idx', 'activity_feed',
+     ['kind', 'is_public', 'id'], False),
+    ('zf_activity_feed_channel_idx', 'activity_feed', ['channel_id'], False),
+    # (user, channel) / (user, template) pairs are unique
+    ('zf_channel_admin_user_channel_uidx', 'channel_admin',
+     ['user_id', 'channel_id'], True),
+    ('zf_channel_membership_user_channel_uidx', 'channel_membership',
+     ['user_id', 'channel_id'], True),
+    ('zf_channel_subscription_user_channel_idx', 'channel_subscription',
+     ['user_id', 'channel_id'], False),
+    ('zf_member_setting_user_template_uidx', 'member_setting',
+     ['user_id', 'template_id'], True),
+    ('zf_system_setting_name_uidx', 'system_setting', ['name'], True),
+    # groups.get(user_id) (see common.py)
+    ('zf_auth_user_tag_groups_record_idx', 'auth_user_tag_groups',
+     ['record_id'], False),
+]
+
+
+def _index_sql(db, name, tablename, columns, unique):
+    table = db[tablename]
+    rnames = {field.name: field._rname for field in table}
+    expressions = []
+    for column in columns:
+        if '{' in column:
+            expressions.append(column.format(**rnames))
+        else:
+            expressions.append(rnames[column])
+    return 'CREATE %sINDEX IF NOT EXISTS %s ON %s (%s);' % (
+        'UNIQUE ' if unique else '', name, table._rname,
+        ', '.join(expressions))
+
+
+def ensure_indexes(db, indexes=None):
+    """ Creates the missing indexes, returns the names of those that could
+    not be created (e.g. a unique index over existing duplicates).
+    """
+    if db._dbname not in SUPPORTED_ENGINES:
+        logger.warning('Index management not supported on %s, skipped.',
+                       db._dbname)
+        return []
+    failed = []
+    for name, tablename, columns, unique in (indexes or INDEXES):
+        if tablename not in db.tables:
+            continue
+        try:
+            db.executesql(_index_sql(db, name, tablename, columns, unique))
+            db.commit()
+        except Exception as exc:
+            db.rollback()
+            logger.warning('Unable to create index %s: %s', name, exc)
+            failed.append(name)
+    return failed
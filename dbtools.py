@@ -0,0 +1,57 @@
+"""
+Helpers for writes racing with other processes (web workers, tasks).
+insert_if_absent() inserts a row guarded by a unique index, the loser of
+a race gets None instead of an IntegrityError aborting its transaction.
+acquire_lease() elects the single process running a periodic job (see
+the job_lease table) when every web process has a thread for it.
+"""
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+
+# Identifies this process as the holder of leases
+LEASE_HOLDER = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+def is_integrity_error(db, exc):
+    """ True if exc is the IntegrityError of the driver of db """
+    return isinstance(exc, getattr(db._adapter.driver, 'IntegrityError', ()))
+
+
+def insert_if_absent(table, **fields):
+    """ Inserts a row, returns its id, or None if a unique index already
+    has it (inserted by another process in the meantime). The insert runs
+    in a savepoint, so the rest of the transaction is kept either way.
+    """
+    db = table._db
+    savepoint = f'zf_{uuid.uuid4().hex[:12]}'
+    db.executesql(f'SAVEPOINT {savepoint};')
+    try:
+        row_id = table.insert(**fields)
+    except Exception as exc:
+        db.executesql(f'ROLLBACK TO SAVEPOINT {savepoint};')
+        db.executesql(f'RELEASE SAVEPOINT {savepoint};')
+        if is_integrity_error(db, exc):
+            return None
+        raise
+    db.executesql(f'RELEASE SAVEPOINT {savepoint};')
+    return row_id
+
+
+def acquire_lease(db, name, seconds, holder=LEASE_HOLDER):
+    """ True if holder has the lease name for the next seconds: it held
+    it already, or the previous holder let it expire. Commits.
+    """
+    now = datetime.now(timezone.utc)
+    lease = db.job_lease
+    acquired = db((lease.name == name) & (
+        (lease.holder == holder) | (lease.expires_on == None) |
+        (lease.expires_on < now))).update(
+            holder=holder, expires_on=now + timedelta(seconds=seconds))
+    if not acquired and db(lease.name == name).isempty():
+        acquired = insert_if_absent(
+            lease, name=name, holder=holder,
+            expires_on=now + timedelta(seconds=seconds)) is not None
+    db.commit()
+    return bool(acquired)
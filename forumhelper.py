@@ -1,29 +1,375 @@
 """
 Utilities for forum actions.
 """
+import base64
+import bisect
 import hashlib
+import html
+import json
+import re
+import threading
+import time
 import uuid
 import os
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from markdown import markdown
 from py4web import URL
-from .settings import Z_EXTERNAL_IMAGES, Z_INTERNAL_IMAGES
-from .common import db, groups, auth, session
+from py4web.core import Fixture
+from .settings import Z_EXTERNAL_IMAGES, Z_INTERNAL_IMAGES, \
+    SYSTEM_SETTINGS_TTL, MEMBER_PROPERTIES_CACHE_SIZE, \
+    MEMBER_PROPERTIES_TTL, USER_INFO_TTL, USER_INFO_STAMP_TTL, \
+    BANNER_MAX_WIDTH
+from .common import db, db_read, groups, auth, session
+from .imagestore import image_store, sniff_image, ImageError
+from .imagejobs import image_jobs
+from .pagecache import page_cache
+from .permissions import get_permissions, invalidate_permissions
+from .dbtools import insert_if_absent
 
 # Use imghdr (imghdr.what(fname[,stream])) to find out image type
 
+def _as_count(value):
+    """ Member counters are stored as text, invalid values count as 0 """
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+
 class ForumHelper:
     """ Helper methods for different forum related actions """
 
+    def __init__(self):
+        # In-memory snapshot of the system_setting table:
+        # {'version': n, 'loaded_on': time.monotonic(), 'values': {...}},
+        # the version counts the invalidations
+        self._settings_lock = threading.Lock()
+        self._settings_version = 0
+        self._settings_snapshot = None
+        # LRU of member properties: {user_id: (loaded_on, {name: value})}
+        self._member_props_lock = threading.Lock()
+        self._member_props = OrderedDict()
+        # LRU of the user info versions read from user_info_version:
+        # {user_id: (read_on, version)}, user_id 0 is everybody's
+        self._user_info_lock = threading.Lock()
+        self._user_info_versions = OrderedDict()
+        # Rank ladder sorted by min_value: {'loaded_on', 'min_values',
+        # 'names'}, plus the ids of the counter member setting templates
+        self._ranks = None
+        self._counter_templates = {}
+
+    def _get_settings_snapshot(self):
+        """ Returns the current system settings snapshot, (re)loading the
+        whole system_setting table in a single query when there is no
+        snapshot yet, it was invalidated, or it is older than
+        SYSTEM_SETTINGS_TTL seconds (so changes made by other processes
+        are eventually picked up).
+        """
+        with self._settings_lock:
+            snapshot = self._settings_snapshot
+            version = self._settings_version
+        if snapshot is not None and \
+            time.monotonic() - snapshot['loaded_on'] < SYSTEM_SETTINGS_TTL:
+            return snapshot
+        rows = db(db.system_setting).select(
+            db.system_setting.name, db.system_setting.value)
+        snapshot = {
+            'version': version,
+            'loaded_on': time.monotonic(),
+            'values': {row.name: row.value for row in rows}
+        }
+        with self._settings_lock:
+            # Not if it was invalidated while reading, the rows may predate
+            # the change (the next read loads them again)
+            if self._settings_version == version:
+                self._settings_snapshot = snapshot
+        return snapshot
+
+    def invalidate_system_properties(self):
+        """ Drops the system settings snapshot, the next read reloads it,
+        call after updating the system_setting table.
+        """
+        with self._settings_lock:
+            self._settings_version += 1
+            self._settings_snapshot = None
+        page_cache.bump('settings')
+
     def get_system_property(self, prop, prop_default=None):
         """ retrieves a system properly value, returns property default
         if not found, if property_defult itself is not provided,
         return an empty string if none found
         """
         prop_default = '' if prop_default is None else prop_default
-        db_prop = db(db.system_setting.name==prop).select(
-            db.system_setting.value).first()
-        return db_prop.value if db_prop is not None else prop_default
+        value = self._get_settings_snapshot()['values'].get(prop)
+        return value if value is not None else prop_default
+
+    def get_system_properties(self, props, prop_defaults=None):
+        """ Bulk version of get_system_property, receives a list of
+        property names and returns a {name: value} dictionary, defaults
+        can be passed as a {name: default} dictionary.
+        """
+        prop_defaults = prop_defaults or {}
+        values = self._get_settings_snapshot()['values']
+        result = {}
+        for prop in props:
+            value = values.get(prop)
+            result[prop] = value if value is not None else \
+                prop_defaults.get(prop, '')
+        return result
+
+    def _get_rank_ladder(self):
+        """ The rank table sorted by min_value, (re)loaded in a single
+        query when older than SYSTEM_SETTINGS_TTL seconds """
+        ranks = self._ranks
+        if ranks is not None and \
+            time.monotonic() - ranks['loaded_on'] < SYSTEM_SETTINGS_TTL:
+            return ranks
+        rows = db(db.rank).select(
+            db.rank.name, db.rank.min_value,
+            orderby=db.rank.min_value|db.rank.id)
+        ranks = {
+            'loaded_on': time.monotonic(),
+            'min_values': [row.min_value or 0 for row in rows],
+            'names': [row.name for row in rows]
+        }
+        self._ranks = ranks
+        return ranks
+
+    def invalidate_ranks(self):
+        """ Drops the rank ladder, call after updating the rank table """
+        self._ranks = None
+
+    def get_rank(self, postings):
+        """ Name of the rank reached with a number of postings (the
+        highest min_value not above it), '' if none applies """
+        ranks = self._get_rank_ladder()
+        index = bisect.bisect_right(ranks['min_values'], postings) - 1
+        return ranks['names'][index] if index >= 0 else ''
+
+    def get_page_size(self):
+        """ Number of topics/responses to show per page (lazy loading
+        chunk), based on the zfss_responses_per_page system setting
+        """
+        try:
+            page_size = int(self.get_system_property(
+                'zfss_responses_per_page', '15'))
+        except ValueError:
+            page_size = 15
+        return page_size if page_size > 0 else 15
+
+    def encode_topic_cursor(self, topic):
+        """ Given the last topic row of a page, returns an opaque
+        (url-safe) cursor pointing to the next page
+        """
+        raw = '%s|%s|%s' % (
+            'T' if topic.is_promoted else 'F',
+            topic.modified_on.isoformat(),
+            topic.id)
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+    def decode_topic_cursor(self, cursor):
+        """ Reverses encode_topic_cursor, returns a tuple of
+        (is_promoted, modified_on, id) or None if the cursor is invalid
+        """
+        try:
+            raw = base64.urlsafe_b64decode(
+                cursor.encode('ascii')).decode('utf-8')
+            promoted, modified_on, topic_id = raw.split('|')
+            return (promoted == 'T', datetime.fromisoformat(modified_on),
+                    int(topic_id))
+        except (ValueError, UnicodeError):
+            return None
+
+    def get_channel_topics(self, channel_id, cursor=None, page_size=None):
+        """ Retrieves a single page of parent topics for a channel using
+        keyset pagination on (is_promoted, modified_on, id), so the cost of
+        a page does not depend on how deep into the channel the reader is.
+        Returns a tuple (topics, next_cursor), next_cursor is None when
+        there are no more topics to show.
+        Reads from the read replica (db_read) when one is configured.
+        """
+        page_size = page_size or self.get_page_size()
+        qry = (db_read.topic.channel_id == channel_id) & \
+            (db_read.topic.is_parent == True)
+        position = self.decode_topic_cursor(cursor) if cursor else None
+        if position:
+            is_promoted, modified_on, topic_id = position
+            # Everything "after" the cursor in the descending ordering
+            older = (db_read.topic.modified_on < modified_on) | \
+                ((db_read.topic.modified_on == modified_on) &
+                 (db_read.topic.id < topic_id))
+            if is_promoted:
+                qry &= ((db_read.topic.is_promoted == True) & older) | \
+                    (db_read.topic.is_promoted != True)
+            else:
+                qry &= (db_read.topic.is_promoted != True) & older
+        # Fetch one extra row to find out if there is a next page
+        topics = db_read(qry).select(
+            db_read.topic.id,
+            db_read.topic.title,
+            db_read.topic.teaser,
+            db_read.topic.is_promoted,
+            db_read.topic.modified_on,
+            db_read.topic.reply_count,
+            db_read.topic.last_reply_on,
+            db_read.topic.is_hot,
+            db_read.auth_user.username,
+            left=db_read.auth_user.on(db_read.topic.created_by == db_read.auth_user.id),
+            orderby=~db_read.topic.is_promoted|~db_read.topic.modified_on|~db_read.topic.id,
+            limitby=(0, page_size + 1))
+        next_cursor = None
+        if len(topics) > page_size:
+            topics = topics[:page_size]
+            next_cursor = self.encode_topic_cursor(topics[-1].topic)
+        return topics, next_cursor
+
+    def encode_reply_cursor(self, reply):
+        """ Opaque cursor of the last response shown, see get_topic_replies
+        """
+        raw = '%s|%s' % (reply.created_on.isoformat(), reply.id)
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+    def decode_reply_cursor(self, cursor):
+        """ Reverses encode_reply_cursor, returns a tuple of
+        (created_on, id) or None if the cursor is invalid
+        """
+        try:
+            raw = base64.urlsafe_b64decode(
+                cursor.encode('ascii')).decode('utf-8')
+            created_on, reply_id = raw.split('|')
+            return datetime.fromisoformat(created_on), int(reply_id)
+        except (ValueError, UnicodeError):
+            return None
+
+    def get_topic_replies(self, topic_id, cursor=None, page_size=None):
+        """ Retrieves a single page of the (visible) responses to a topic,
+        oldest first, using keyset pagination on (parent_id, created_on, id)
+        (see the zf_topic_parent_idx index).
+        Returns a tuple (replies, next_cursor), next_cursor is None when
+        there are no more responses to show.
+        """
+        page_size = page_size or self.get_page_size()
+        qry = (db_read.topic.parent_id == topic_id) & \
+            (db_read.topic.is_parent == False) & \
+            (db_read.topic.is_visible == True)
+        position = self.decode_reply_cursor(cursor) if cursor else None
+        if position:
+            created_on, reply_id = position
+            qry &= (db_read.topic.created_on > created_on) | \
+                ((db_read.topic.created_on == created_on) &
+                 (db_read.topic.id > reply_id))
+        replies = db_read(qry).select(
+            db_read.topic.id,
+            db_read.topic.content,
+            db_read.topic.upvote,
+            db_read.topic.created_on,
+            db_read.topic.created_by,
+            orderby=db_read.topic.created_on|db_read.topic.id,
+            limitby=(0, page_size + 1))
+        next_cursor = None
+        if len(replies) > page_size:
+            replies = replies[:page_size]
+            next_cursor = self.encode_reply_cursor(replies[-1])
+        return replies, next_cursor
+
+    def get_authors(self, user_ids):
+        """ Display information of the authors of a page of topics or
+        responses, loaded in a single query (plus one for the display names
+        missing from the member properties cache):
+        {user_id: {'username', 'display_name', 'avatar_url', 'postings',
+        'rank'}}
+        avatar_url is None if the member has no avatar or avatars are
+        disabled (zfss_allow_member_avatars), rank is None unless the
+        ranking system is enabled (zfss_use_ranking_system).
+        """
+        user_ids = {user_id for user_id in user_ids if user_id}
+        if not user_ids:
+            return {}
+        allow_avatars = bool(
+            self.get_system_property('zfss_allow_member_avatars', ''))
+        rows = db_read(db_read.auth_user.id.belongs(user_ids)).select(
+            db_read.auth_user.id,
+            db_read.auth_user.username,
+            db_read.member_avatar.id,
+            left=db_read.member_avatar.on(
+                db_read.member_avatar.user_id == db_read.auth_user.id))
+        # Display names and post counters come from the (cached) member
+        # properties, ranks from the (cached) rank ladder
+        properties = self.get_member_properties(
+            user_ids, ['zfmp_display_name', 'zfmp_posts', 'zfmp_replies'])
+        use_ranks = bool(
+            self.get_system_property('zfss_use_ranking_system', ''))
+        authors = {}
+        for row in rows:
+            has_avatar = allow_avatars and row.member_avatar.id is not None
+            member = properties[row.auth_user.id]
+            postings = _as_count(member['zfmp_posts']) + \
+                _as_count(member['zfmp_replies'])
+            authors[row.auth_user.id] = {
+                'username': row.auth_user.username,
+                'display_name': member['zfmp_display_name'] or \
+                    row.auth_user.username,
+                'avatar_url': URL('zauth/avatar', row.auth_user.id) \
+                    if has_avatar else None,
+                'postings': postings,
+                'rank': self.get_rank(postings) if use_ranks else None
+            }
+        return authors
+
+    def get_teaser_length(self):
+        """ Number of characters shown for a topic in the listings, based
+        on the zfss_topic_teaser_length system setting
+        """
+        try:
+            teaser_length = int(self.get_system_property(
+                'zfss_topic_teaser_length', '300'))
+        except ValueError:
+            teaser_length = 300
+        return teaser_length if teaser_length > 0 else 300
+
+    def make_topic_teaser(self, content, teaser_length=None):
+        """ Renders the (markdown) content of a topic and reduces it to a
+        plain text excerpt of at most teaser_length characters, cutting at
+        a word boundary. The result contains no markup at all so it is safe
+        to store and display as-is.
+        """
+        teaser_length = teaser_length or self.get_teaser_length()
+        text = re.sub(r'<[^>]*>', ' ', markdown(content or ''))
+        text = ' '.join(html.unescape(text).split())
+        if len(text) > teaser_length:
+            text = text[:teaser_length].rsplit(' ', 1)[0].rstrip(' .,;:')
+            text += '...'
+        return text
+
+    def backfill_topic_teasers(self, batch_size=500):
+        """ Generates the teaser of those (parent) topics that do not have
+        one, in batches of batch_size, committing after each batch.
+        Returns the number of topics updated.
+        """
+        teaser_length = self.get_teaser_length()
+        updated = 0
+        last_id = 0
+        while True:
+            rows = db(
+                (db.topic.id > last_id) &
+                (db.topic.is_parent == True) &
+                (db.topic.teaser == None)).select(
+                    db.topic.id,
+                    db.topic.content,
+                    orderby=db.topic.id,
+                    limitby=(0, batch_size))
+            if not rows:
+                break
+            for row in rows:
+                # Update thru the set, so modified_on is left untouched
+                db(db.topic.id == row.id).update(
+                    teaser=self.make_topic_teaser(row.content, teaser_length),
+                    modified_on=db.topic.modified_on)
+            last_id = rows.last().id
+            updated += len(rows)
+            db.commit()
+        return updated
 
     def _generate_filename_hash(self, fname):
         """ Given a filename (fname), generate a safely unique
@@ -40,7 +386,8 @@ class ForumHelper:
             (db.channel_admin.user_id==user_id) & \
                 (db.channel_admin.channel_id==channel_id),
             user_id=user_id, channel_id=channel_id, is_active=True)
-        
+        invalidate_permissions(int(user_id))
+
     def revoke_channel_admin(self, channel_id, user_id):
         """ Given a channel id and user id, upsert a record in
         channel admin table with is_active=False """
@@ -48,7 +395,7 @@ class ForumHelper:
             (db.channel_admin.user_id==user_id) & \
                 (db.channel_admin.channel_id==channel_id), 
             user_id=user_id, channel_id=channel_id, is_active=False)
-
+        invalidate_permissions(int(user_id))
 
     def generate_file_location(self, fname):
         """ Generates a path location where to store a file """
@@ -61,130 +408,254 @@ class ForumHelper:
 
     def verify_channel_banner(self, payload):
         """ Receives a payload (or None) and verifies it is a valid
-            image to use """
+            image to use, based on its content (magic bytes) rather than
+            the content type declared by the client. The image is fully
+            decoded later on, by the banner job. """
         # Move to System Setings?
-        available_content_types = ['image/jpeg', 'image/png']
-        if payload is not None and \
-            payload.content_type.value in available_content_types:
+        available_image_types = ['jpg', 'png']
+        if payload is not None:
             # payload is in instance of
             # <ombott.request_pkg.helpers.FileUpload object at 0x107ecfc40>
-            return True
+            payload.file.seek(0)
+            image_type = sniff_image(payload.file.read(16))
+            payload.file.seek(0)
+            return image_type is not None and \
+                image_type[0] in available_image_types
         return False
 
     def retrieve_channel_banner(self, channel_id, banner_name):
-        """ Given a channel id, retrieve the banner for it or None """
+        """ Given a channel id, retrieve the banner for it or None. The
+        URL is versioned with the file's modification time, a replaced
+        banner gets a new URL instead of a stale cached image """
         if banner_name:
             img_path = os.path.join(
                 Z_EXTERNAL_IMAGES, 'channels', str(channel_id), banner_name)
             if os.path.isfile(img_path):
                 return URL(
                     'static', Z_INTERNAL_IMAGES, 'channels',
-                    str(channel_id), banner_name)
+                    str(channel_id), banner_name,
+                    vars={'v': int(os.stat(img_path).st_mtime)})
         return None
 
-    def store_channel_banner(self, channel_id, payload):
-        """ receives a valid payload and creates a filesystem file """
+    def store_channel_banner(self, channel_id, payload, user_id=None):
+        """ receives a valid payload and saves it aside, the banner job
+        (see imagejobs.py) decodes and re-encodes it as the channel banner
+        file. Returns the id of the job.
+        """
         # <ombott.request_pkg.helpers.FileUpload object at 0x107ecfc40>
         os.makedirs(os.path.join(Z_EXTERNAL_IMAGES, 'channels',
                                  str(channel_id)), exist_ok=True)
         fn = os.path.join(Z_EXTERNAL_IMAGES, 'channels', str(channel_id),
                           payload.filename)
-        payload.save(fn, overwrite=True)
+        upload_fn = f'{fn}.{uuid.uuid4().hex}.upload'
+        payload.save(upload_fn, overwrite=True)
+        return image_jobs.submit(
+            'channel_banner', channel_id,
+            {'upload_path': upload_fn, 'banner_path': fn,
+             'max_width': BANNER_MAX_WIDTH},
+            self._current_user_id(user_id))
 
 
-    def store_topic_images(self, topic_id, payload):
-        """ Retrieves a collection of images to add to a specific topic """
+    def get_image_limits(self):
+        """ (max images per post, max bytes per image) from the
+        zfsp_max_images_per_post and zfsp_max_image_size system settings
+        """
+        limits = self.get_system_properties(
+            ['zfsp_max_images_per_post', 'zfsp_max_image_size'],
+            {'zfsp_max_images_per_post': '5',
+             'zfsp_max_image_size': '5000000'})
+        try:
+            max_images = int(limits['zfsp_max_images_per_post'])
+        except ValueError:
+            max_images = 5
+        try:
+            max_size = int(limits['zfsp_max_image_size'])
+        except ValueError:
+            max_size = 5000000
+        return max_images, max_size
+
+    def store_topic_images(self, payload):
+        """ Streams a collection of uploaded images to the image store (see
+        imagestore.py), before the topic they belong to is created. Raises
+        ImageError (nothing is kept) if there are more images than allowed
+        or any of them is not a valid image or too large.
+        Returns the stored images to pass on to add_topic_images.
+        """
         # Image payload received as a collection of:
         # # <ombott.request_pkg.helpers.FileUpload object at 0x107ecfc40>
-        
+        uploads = [upload for upload in payload or [] if upload.filename]
+        max_images, max_size = self.get_image_limits()
+        if len(uploads) > max_images:
+            raise ImageError(
+                f'Only {max_images} image(s) can be added to a post.')
+        stored = []
+        try:
+            for upload in uploads:
+                stored.append(image_store.store(upload, max_size))
+        except ImageError:
+            for image in stored:
+                image_store.discard(image)
+            raise
+        return stored
 
-    def is_sysadmin(self, user_id=None):
-        """ Returns true if the user is in the Managers group,
-        (See common.py for the definition of the groups table)
+    def add_topic_images(self, topic_id, images, user_id=None):
+        """ Links images stored by store_topic_images to a topic (or
+        response), the same image is only linked once per topic. Decoding
+        and thumbnails are left to a background job (see imagejobs.py),
+        returns its id (None if there were no images).
+        """
+        user_id = self._current_user_id(user_id)
+        linked = {}
+        for image in images or []:
+            if image['hash'] in linked:
+                continue
+            metadata = {
+                'ext': image['ext'],
+                'content_type': image['content_type'],
+                'size': image['size'],
+                'filename': image['filename'],
+                'width': None,
+                'height': None,
+                'thumbnails': []
+            }
+            linked[image['hash']] = {
+                'id': db.topic_image.insert(
+                    user_id=user_id,
+                    topic_id=topic_id,
+                    image_hash=image['hash'],
+                    metadata=json.dumps(metadata)),
+                'hash': image['hash'],
+                'ext': image['ext']
+            }
+        if not linked:
+            return None
+        return image_jobs.submit(
+            'topic_images', topic_id, {'images': list(linked.values())},
+            user_id)
+
+    def remove_topic_images(self, topic_ids):
+        """ Deletes the images of posts (call before deleting them), the
+        files no other post references are removed from the store
+        """
+        query = db.topic_image.topic_id.belongs(topic_ids)
+        rows = db(query).select(
+            db.topic_image.image_hash, db.topic_image.metadata)
+        db(query).delete()
+        files = {(row.image_hash, json.loads(row.metadata).get('ext'))
+                 for row in rows}
+        for image_hash, ext in files:
+            if db(db.topic_image.image_hash == image_hash).isempty():
+                image_store.discard(
+                    {'hash': image_hash, 'ext': ext, 'created': True})
+
+    def get_topic_images(self, topic_ids):
+        """ Images of several topics/responses in a single query:
+        {topic_id: [{'url', 'thumbnail_url', 'filename', 'width',
+        'height'}]}
+        """
+        topic_ids = {topic_id for topic_id in topic_ids if topic_id}
+        images = {topic_id: [] for topic_id in topic_ids}
+        if not topic_ids:
+            return images
+        rows = db_read(db_read.topic_image.topic_id.belongs(topic_ids)).select(
+            db_read.topic_image.topic_id,
+            db_read.topic_image.image_hash,
+            db_read.topic_image.metadata,
+            orderby=db_read.topic_image.id)
+        for row in rows:
+            try:
+                metadata = json.loads(row.metadata)
+            except ValueError:
+                continue
+            image = image_store.variants(
+                row.image_hash, metadata['ext'],
+                metadata.get('thumbnails') or ())
+            image.update({
+                'filename': metadata.get('filename', ''),
+                'width': metadata.get('width'),
+                'height': metadata.get('height')
+            })
+            images[row.topic_id].append(image)
+        return images
+
+    def _current_user_id(self, user_id=None):
+        """ Returns user_id, or the id of the logged in user (or None)
+        if user_id is not passed
         """
         if user_id is None:
             # If userid is not passed, attempt to ge the current user.
             user_id = auth.get_user().get('id', None)
-            if user_id is None:
-                return False
-        return 'manager' in groups.get(user_id)
+        return int(user_id) if user_id else None
+
+    def get_permissions(self, user_id=None):
+        """ Returns the (request scoped) PermissionContext of the user,
+        see permissions.py, all authorization checks go thru it so they
+        are resolved once per request.
+        """
+        return get_permissions(self._current_user_id(user_id))
+
+    def is_sysadmin(self, user_id=None):
+        """ Returns true if the user is in the Managers group,
+        (See common.py for the definition of the groups table)
+        """
+        return self.get_permissions(user_id).is_sysadmin
 
     def is_channel_admin(self, user_id, channel_id):
         """ A channel Admin is any authenticated user that creates
         an own channel, however, a channel admin (or a sysadmin) can make
         any user administrative rights to any channel they control.
         """
-        return db(
-            (db.channel_admin.channel_id==channel_id) &
-            (db.channel_admin.is_active==True) &
-            (db.channel_admin.user_id==user_id)).count() > 0
-    
+        return self.get_permissions(user_id).is_channel_admin(channel_id)
+
+    def can_admin_channel(self, channel_id, user_id=None):
+        """ True if the user is a channel admin or a system admin """
+        return self.get_permissions(user_id).can_admin_channel(channel_id)
+
     def get_channel_membership(self, channel_id, user_id=None):
         """ Given a channel that requires membership, return True if the
         user is member of the channel, also return True if the user
         is either a System Admin, or one of the channel's administratos
         returns {'has_membership': True/False, 'is_pending': True/False}
         """
-        membership_state = {
-            'has_membership': False,
-            'is_pending': False,
-            'is_expired': False
-        }
-        # If user_id not passed, get it from auth
-        user_id = user_id or auth.get_user().get('id', None)
-        if user_id:
-            # Admins and Channel Admins are _always_ members..
-            if self.is_sysadmin(user_id) or \
-                self.is_channel_admin(user_id, channel_id):
-                membership_state['has_membership'] = True
-            else:
-                # Valid user, but not admin,
-                # check if there is a membership record
-                membership = db(
-                    (db.channel_membership.user_id==user_id) &
-                    (db.channel_membership.channel_id==channel_id)).select(
-                        db.channel_membership.expires_on,
-                        db.channel_membership.is_new_request).first()
-                if membership and membership['is_new_request']:
-                    membership_state['has_membership'] = True
-                    membership_state['is_pending'] = True
-                elif membership and (membership.expires_on >= datetime.now()):
-                    membership_state['has_membership'] = True
-                elif membership and (membership.expires_on < datetime.now()):
-                    membership_state['is_expired'] = True
-        return membership_state
-    
+        return self.get_permissions(user_id).channel_membership(channel_id)
+
     def grant_channel_membership(self, channel_id, user_id=None):
         """ Creates or updates a channel membership, returns True
         if success, False otherwise
         """
         granted_membership = False
-        user_id = user_id or auth.get_user().get('id', None)
+        user_id = self._current_user_id(user_id)
         if user_id:
-            new_exp = datetime.now() + timedelta(years=10)
+            new_exp = datetime.now() + timedelta(days=3650)
             # Update the expires on the table and use the combination of user and
             # channel for uniqueness..
             db.channel_membership.update_or_insert(
                 (db.channel_membership.user_id==user_id) &
-                (db.channel_membership,
-                 db.channel_membership.channel_id==channel_id),
+                (db.channel_membership.channel_id==channel_id),
+                user_id=user_id,
+                channel_id=channel_id,
+                is_new_request=False,
                 expires_on=new_exp)
+            invalidate_permissions(user_id)
             granted_membership = True
         return granted_membership
 
     def revoke_channel_membership(self, channel_id, user_id=None):
         """ Revokes a channel membership, True if success, False otherwise """
         revoked_membership = False
-        user_id = user_id or auth.get_user().get('id', None)
+        user_id = self._current_user_id(user_id)
         if user_id:
-            new_exp = datetime.now() + timedelta(years=-10)
+            new_exp = datetime.now() - timedelta(days=3650)
             # Update the expires on the table and use the combination of user and
             # channel for uniqueness..
             db.channel_membership.update_or_insert(
                 (db.channel_membership.user_id==user_id) &
-                (db.channel_membership,
-                 db.channel_membership.channel_id==channel_id),
+                (db.channel_membership.channel_id==channel_id),
+                user_id=user_id,
+                channel_id=channel_id,
+                is_new_request=False,
                 expires_on=new_exp)
+            invalidate_permissions(user_id)
             revoked_membership = True
         return revoked_membership
     
@@ -193,14 +664,16 @@ class ForumHelper:
         request_flag set only. To grant/revoke actual membership, 
         use the appropriate grant/revoke methods.
         """
-        user_id = user_id or auth.get_user().get('id', None)
+        user_id = self._current_user_id(user_id)
         if user_id:
             db.channel_membership.update_or_insert(
                 (db.channel_membership.user_id==user_id) &
-                (db.channel_membership,
-                 db.channel_membership.channel_id==channel_id),
+                (db.channel_membership.channel_id==channel_id),
+                user_id=user_id,
+                channel_id=channel_id,
                 is_new_request=True,
                 expires_on=None)
+            invalidate_permissions(user_id)
 
     def get_member_property(self, prop, user_id=None):
         """ Reads the member value of a property """
@@ -210,17 +683,158 @@ class ForumHelper:
             if user_id is None:
                 return ''
         # get_member_property('zfmp_display_name') -> 'CapricaSOS'
-        prop = db().select(
-            db.member_setting_template.id,
-            db.member_setting.value,
-            left=db.member_setting.on(
-                (db.member_setting_template.id==db.member_setting.template_id) & \
-                (db.member_setting_template.name==prop) & \
-                (db.member_setting.user_id==user_id)))
-        prop_value = ''
-        if prop:
-            prop_value = prop[0].member_setting.value or ''
-        return prop_value
+        user_id = int(user_id)
+        return self.get_member_properties([user_id], [prop])[user_id][prop]
+
+    def get_member_properties(self, user_ids, names=None):
+        """ Member property values of several users at once:
+        {user_id: {name: value}} (value is '' when the member has not set
+        it), names=None returns every property the members have set.
+        Properties are kept in an LRU (MEMBER_PROPERTIES_CACHE_SIZE users,
+        refreshed after MEMBER_PROPERTIES_TTL seconds so changes made by
+        other processes are picked up), the users missing from it are
+        loaded in a single query.
+        """
+        user_ids = [int(user_id) for user_id in user_ids if user_id]
+        found, missing = {}, []
+        expired = time.monotonic() - MEMBER_PROPERTIES_TTL
+        with self._member_props_lock:
+            for user_id in set(user_ids):
+                entry = self._member_props.get(user_id)
+                if entry and entry[0] > expired:
+                    self._member_props.move_to_end(user_id)
+                    found[user_id] = entry[1]
+                else:
+                    missing.append(user_id)
+        if missing:
+            loaded = {user_id: {} for user_id in missing}
+            rows = db(
+                db.member_setting.user_id.belongs(missing) &
+                (db.member_setting.template_id ==
+                 db.member_setting_template.id)).select(
+                    db.member_setting.user_id,
+                    db.member_setting.value,
+                    db.member_setting_template.name)
+            for row in rows:
+                loaded[row.member_setting.user_id][
+                    row.member_setting_template.name] = \
+                    row.member_setting.value or ''
+            loaded_on = time.monotonic()
+            with self._member_props_lock:
+                for user_id, values in loaded.items():
+                    self._member_props[user_id] = (loaded_on, values)
+                    self._member_props.move_to_end(user_id)
+                while len(self._member_props) > MEMBER_PROPERTIES_CACHE_SIZE:
+                    self._member_props.popitem(last=False)
+            found.update(loaded)
+        if names is None:
+            return {user_id: dict(found[user_id]) for user_id in user_ids}
+        return {user_id: {name: found[user_id].get(name, '')
+                          for name in names}
+                for user_id in user_ids}
+
+    def invalidate_member_properties(self, user_id=None):
+        """ Drops the cached properties of a member (or of everybody) """
+        with self._member_props_lock:
+            if user_id is None:
+                self._member_props.clear()
+            else:
+                self._member_props.pop(int(user_id), None)
+
+    def _counter_template_id(self, name):
+        """ Id of the member setting template of a counter (zfmp_posts or
+        zfmp_replies), the templates never change once seeded """
+        template_id = self._counter_templates.get(name)
+        if template_id is None:
+            template = db(db.member_setting_template.name == name).select(
+                db.member_setting_template.id).first()
+            template_id = template.id if template else None
+            if template_id is not None:
+                self._counter_templates[name] = template_id
+        return template_id
+
+    def add_member_posting(self, user_id, is_reply=False, count=1):
+        """ Adds count (negative to remove) to the zfmp_posts (or
+        zfmp_replies) counter of the author, call after inserting a topic
+        (or a response), or before deleting it, in the same transaction.
+        The cached member properties are updated in place. Returns the new
+        count.
+        """
+        user_id = int(user_id)
+        name = 'zfmp_replies' if is_reply else 'zfmp_posts'
+        template_id = self._counter_template_id(name)
+        if template_id is None:
+            return None
+        setting = db.member_setting
+        query = (setting.user_id == user_id) & \
+            (setting.template_id == template_id)
+        while True:
+            row = db(query).select(
+                setting.id, setting.value, limitby=(0, 1)).first()
+            if row is None:
+                total = max(0, count)
+                # Unless a concurrent first posting inserted it, read again
+                if insert_if_absent(setting, user_id=user_id,
+                                    template_id=template_id,
+                                    value=str(total)) is not None:
+                    break
+                continue
+            total = max(0, _as_count(row.value) + count)
+            # Only if nobody changed it since it was read, else read again
+            if db((setting.id == row.id) &
+                  (setting.value == row.value)).update(value=str(total)):
+                break
+        with self._member_props_lock:
+            entry = self._member_props.get(user_id)
+            if entry:
+                entry[1][name] = str(total)
+        return total
+
+    def recount_member_postings(self, batch_size=500):
+        """ Recomputes the zfmp_posts/zfmp_replies counters of every member
+        from the topic table (one aggregate query), only the settings whose
+        values are off are written. Returns the number of settings fixed.
+        """
+        template_ids = {
+            True: self._counter_template_id('zfmp_posts'),
+            False: self._counter_template_id('zfmp_replies')}
+        template_ids = {is_parent: template_id for is_parent, template_id
+                        in template_ids.items() if template_id is not None}
+        if not template_ids:
+            return 0
+        total = db.topic.id.count()
+        counts = {}
+        for row in db(db.topic.created_by != None).select(
+                db.topic.created_by, db.topic.is_parent, total,
+                groupby=db.topic.created_by|db.topic.is_parent):
+            template_id = template_ids.get(bool(row.topic.is_parent))
+            if template_id is not None:
+                key = (row.topic.created_by, template_id)
+                counts[key] = counts.get(key, 0) + row[total]
+        setting = db.member_setting
+        current = {}
+        for row in db(setting.template_id.belongs(
+                list(template_ids.values()))).iterselect(
+                    setting.id, setting.user_id, setting.template_id,
+                    setting.value):
+            current.setdefault((row.user_id, row.template_id), row)
+        fixed = 0
+        for key in set(counts) | set(current):
+            value = str(counts.get(key, 0))
+            row = current.get(key)
+            if row is None:
+                setting.insert(user_id=key[0], template_id=key[1],
+                               value=value)
+            elif row.value != value:
+                db(setting.id == row.id).update(value=value)
+            else:
+                continue
+            fixed += 1
+            if fixed % batch_size == 0:
+                db.commit()
+        db.commit()
+        self.invalidate_member_properties()
+        return fixed
 
     def put_member_properties(self, props, user_id=None):
         """ receives a list of property values and creates/updates
@@ -243,6 +857,8 @@ class ForumHelper:
                 user_id=user_id,
                 template_id=prop['prop_id'],
                 value=prop['prop_value'])
+        self.invalidate_member_properties(user_id)
+        self.bump_user_info(user_id)
         return True
 
     def get_user_properties(self, user_id=None):
@@ -284,32 +900,124 @@ class ForumHelper:
                     'value': user_prop_map.get(prop.id, prop.value)}})
         return all_props
 
+    def _user_info_stamp(self, user_id):
+        """ Version stamp the cached user info must match to be used,
+        [everybody's version, the member's version]. Versions are read in
+        one query from the user_info_version table (shared by every
+        process) and reused for USER_INFO_STAMP_TTL seconds.
+        """
+        expired = time.monotonic() - USER_INFO_STAMP_TTL
+        with self._user_info_lock:
+            entries = [self._user_info_versions.get(0),
+                       self._user_info_versions.get(user_id)]
+        if all(entry and entry[0] > expired for entry in entries):
+            return [entry[1] for entry in entries]
+        versions = {row.user_id: row.version or 0 for row in db(
+            db.user_info_version.user_id.belongs([0, user_id])).select(
+                db.user_info_version.user_id, db.user_info_version.version)}
+        stamp = [versions.get(0, 0), versions.get(user_id, 0)]
+        read_on = time.monotonic()
+        with self._user_info_lock:
+            for key, version in zip((0, user_id), stamp):
+                self._user_info_versions[key] = (read_on, version)
+                self._user_info_versions.move_to_end(key)
+            while len(self._user_info_versions) > \
+                    MEMBER_PROPERTIES_CACHE_SIZE:
+                self._user_info_versions.popitem(last=False)
+        return stamp
+
+    def bump_user_info(self, user_id=None):
+        """ Invalidates the (session) cached user info of a member, or of
+        everybody when user_id is None, in every process.
+        """
+        user_id = 0 if user_id is None else int(user_id)
+        version = db.user_info_version
+        query = version.user_id == user_id
+        if not db(query).update(version=version.version.coalesce_zero() + 1):
+            if insert_if_absent(version, user_id=user_id, version=1) is None:
+                # Inserted by another process in the meantime
+                db(query).update(version=version.version.coalesce_zero() + 1)
+        # This process reads the new version right away
+        with self._user_info_lock:
+            if user_id == 0:
+                self._user_info_versions.clear()
+            else:
+                self._user_info_versions.pop(user_id, None)
+
     def get_user_info(self, user_id=None):
         """
         Compiles basic user information to be used on header/footer
         or other areas of the system, primarily information once the
         user is logged in.
+        The info of the logged in user is cached in the session (along with
+        a version stamp, see bump_user_info) so rendering the header needs
+        no query while the stamp is fresh (see _user_info_stamp).
         """
         session_info = {}
+        current_user_id = auth.user_id
         if user_id is None:
-            user_id = auth.get_user().get('id', None)
+            user_id = current_user_id
         if user_id:
+            user_id = int(user_id)
+            is_current_user = user_id == current_user_id
+            if is_current_user:
+                stamp = self._user_info_stamp(user_id)
+                cached = session.get('zf_user_info') or {}
+                if cached.get('user_id') == user_id and \
+                    cached.get('stamp') == stamp and \
+                    time.time() - cached.get('loaded_on', 0) < USER_INFO_TTL:
+                    return cached['info']
             # Only mess with the info gathering if there is an auth user
             # Add some basic relevant user information to be available
             # on different parts of the system:
+            user = db(db.auth_user.id == user_id).select(
+                db.auth_user.email).first()
             session_info = {
                 'zf_is_admin': self.is_sysadmin(user_id),
                 'zf_profile_name': self.get_member_property(
                     'zfmp_display_name', user_id),
-                'zf_email': auth.get_user().get('email')
+                'zf_email': user.email if user else ''
             }
             session_info['zf_display_name'] = session_info[
                 'zf_profile_name'] or session_info['zf_email']
+            if is_current_user:
+                session['zf_user_info'] = {
+                    'user_id': user_id,
+                    'stamp': stamp,
+                    'loaded_on': time.time(),
+                    'info': session_info
+                }
         return session_info
-    
-    def add_topic_images(self, topic_id, images):
-        if images:
-            x = 1
 
+    def add_user_group(self, user_id, group):
+        """ Adds the user to a group (e.g. 'manager', system admins) """
+        groups.add(user_id, group)
+        invalidate_permissions(user_id)
+        self.bump_user_info(user_id)
+
+    def remove_user_group(self, user_id, group):
+        """ Removes the user from a group """
+        groups.remove(user_id, group)
+        invalidate_permissions(user_id)
+        self.bump_user_info(user_id)
+    
 # Expose a single instance
 forumhelper = ForumHelper()
+
+
+class UserInfo(Fixture):
+    """ Adds user_info (see ForumHelper.get_user_info) to the output of
+    the actions it is used in, for the header of zlayout.html. Declare it
+    after the template: @action.uses('page.html', user_info, ...)
+    """
+
+    def __init__(self):
+        self.__prerequisites__ = [session, auth]
+
+    def on_success(self, context=None):
+        output = context.get('output') if context else None
+        if isinstance(output, dict) and 'user_info' not in output:
+            output['user_info'] = forumhelper.get_user_info()
+
+
+user_info = UserInfo()
@@ -0,0 +1,255 @@
+"""
+Background image jobs.
+CPU bound image work (full decoding, re-encoding, thumbnails) is recorded
+in the image_job table and run outside of the request, in a local process
+pool or, when settings.USE_CELERY, by the tasks.process_image_job task.
+The UI polls the job status thru image/job/<id> (controllers/image.py).
+Jobs submitted by an action using the image_jobs fixture are dispatched
+once the request committed (the worker needs the job and image rows).
+Jobs still pending after settings.IMAGE_JOB_TIMEOUT seconds were lost (the
+worker restarted, the pool crashed) and are failed by expire().
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from py4web.core import Fixture
+from .common import db, logger
+from .pagecache import page_cache
+from .imagestore import image_store, process_topic_images, \
+    process_channel_banner
+from . import settings
+
+# Worker function of every kind of job, receives the decoded job payload
+WORKERS = {
+    'topic_images': lambda payload: process_topic_images(payload['images']),
+    'channel_banner': lambda payload: process_channel_banner(
+        payload['upload_path'], payload['banner_path'],
+        payload['max_width']),
+}
+
+
+class ImageJobs(Fixture):
+    """ Submits image jobs and applies their results, declare it in the
+    actions submitting jobs:
+    @action.uses(image_jobs, ...)
+    """
+
+    def __init__(self, workers=2, timeout=600):
+        # db first, so its on_success (commit) runs after this one's
+        self.__prerequisites__ = [db]
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._expired_on = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers)
+        return self._executor
+
+    def on_request(self, context=None):
+        self._local.pending = []
+
+    def on_success(self, context=None):
+        pending, self._local.pending = \
+            getattr(self._local, 'pending', None), None
+        if pending:
+            # Everything the action wrote (job and image rows included)
+            db.commit()
+            for job in pending:
+                self._dispatch(*job)
+
+    def on_error(self, context=None):
+        pending, self._local.pending = \
+            getattr(self._local, 'pending', None), None
+        # The job rows are rolled back, only the uploads are left
+        for job_id, kind, payload in pending or []:
+            upload_path = payload.get('upload_path')
+            if upload_path and os.path.exists(upload_path):
+                os.unlink(upload_path)
+
+    def submit(self, kind, target_id, payload, user_id=None):
+        """ Records a job and returns its id. Within an action using this
+        fixture the job is dispatched once the request succeeds (and
+        commits), elsewhere it is committed and dispatched right away.
+        """
+        job_id = db.image_job.insert(
+            kind=kind, target_id=target_id, payload=json.dumps(payload),
+            created_by=user_id)
+        pending = getattr(self._local, 'pending', None)
+        if pending is not None:
+            pending.append((job_id, kind, payload))
+        else:
+            db.commit()
+            self._dispatch(job_id, kind, payload)
+        return job_id
+
+    def _dispatch(self, job_id, kind, payload):
+        """ Hands a committed job to celery or the process pool """
+        if not settings.USE_CELERY and \
+                time.monotonic() - self._expired_on > self.timeout:
+            # No beat to run tasks.expire_image_jobs, sweep from here
+            self._expired_on = time.monotonic()
+            self.expire()
+        if settings.USE_CELERY:
+            from .tasks import process_image_job
+            process_image_job.delay(job_id)
+        else:
+            future = self._get_executor().submit(
+                _run_worker, kind, payload)
+            future.add_done_callback(
+                lambda done: self._finish_in_thread(job_id, done))
+
+    def _finish_in_thread(self, job_id, future):
+        """ Done callback of the process pool, runs in the thread of the
+        executor, which needs its own db connection
+        """
+        try:
+            db._adapter.reconnect()
+            error = future.exception()
+            self.finish(job_id, None if error else future.result(), error)
+        except Exception as exc:
+            db.rollback()
+            logger.error('Unable to finish image job %s: %s', job_id, exc)
+
+    def run(self, job_id):
+        """ Runs a pending job in the current process (celery task) """
+        job = db.image_job(job_id)
+        if job is None or job.status != 'pending':
+            return
+        try:
+            result, error = _run_worker(job.kind, json.loads(job.payload)), \
+                None
+        except Exception as exc:
+            result, error = None, exc
+        self.finish(job_id, result, error)
+
+    def finish(self, job_id, result, error=None):
+        """ Applies the result of a job and records its status """
+        job = db.image_job(job_id)
+        if job is None or job.status != 'pending':
+            # Already expired (see expire)
+            return
+        if error is None:
+            apply_result = getattr(self, f'_apply_{job.kind}')
+            apply_result(job, result)
+        else:
+            logger.warning('Image job %s failed: %s', job_id, error)
+            self._failed(job)
+        job.update_record(
+            status='failed' if error else 'done',
+            result=json.dumps(result) if result is not None else None,
+            error=str(error)[:512] if error else None,
+            finished_on=datetime.now())
+        db.commit()
+
+    def _apply_topic_images(self, job, results):
+        for result in results:
+            topic_image = db.topic_image(result['id'])
+            if topic_image is None:
+                continue
+            metadata = json.loads(topic_image.metadata)
+            if not result['valid']:
+                topic_image.delete_record()
+                self._discard_unused(topic_image.image_hash, metadata['ext'])
+                continue
+            metadata.update({
+                'width': result['width'],
+                'height': result['height'],
+                'thumbnails': result['thumbnails']
+            })
+            topic_image.update_record(metadata=json.dumps(metadata))
+        # The post (and the thread showing it) changed, see conditional.py
+        post = db.topic(job.target_id)
+        if post is not None:
+            db(db.topic.id.belongs(
+                [post.id, post.parent_id or post.id])).update(
+                    modified_on=datetime.now(timezone.utc))
+
+    def _apply_channel_banner(self, job, result):
+        # The banner file is in place, the cached pages show the old one
+        db(db.channel.id == job.target_id).update(
+            modified_on=datetime.now(timezone.utc))
+        page_cache.bump('channel', job.target_id)
+
+    def _is_stale(self, job):
+        """ Pending for longer than timeout seconds (created_on is UTC) """
+        created_on = job.created_on
+        if created_on is None:
+            return False
+        if created_on.tzinfo is not None:
+            created_on = created_on.astimezone(timezone.utc).replace(
+                tzinfo=None)
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return now - created_on > timedelta(seconds=self.timeout)
+
+    def expire(self):
+        """ Fails the jobs pending for longer than timeout seconds, their
+        worker is gone, and cleans up what they leave behind. Returns the
+        number of jobs expired.
+        """
+        since = datetime.now(timezone.utc) - timedelta(seconds=self.timeout)
+        job_ids = [row.id for row in db(
+            (db.image_job.status == 'pending') &
+            (db.image_job.created_on < since)).select(db.image_job.id)]
+        for job_id in job_ids:
+            self.finish(job_id, None, TimeoutError(
+                f'Not processed within {self.timeout} seconds'))
+        return len(job_ids)
+
+    def _failed(self, job):
+        """ Undoes what a failed job leaves behind """
+        payload = json.loads(job.payload)
+        if job.kind == 'channel_banner':
+            upload_path = payload.get('upload_path')
+            if upload_path and os.path.exists(upload_path):
+                os.unlink(upload_path)
+            # Only clear the banner if it was not replaced in the meantime
+            banner_name = os.path.basename(payload['banner_path'])
+            db((db.channel.id == job.target_id) &
+               (db.channel.banner == banner_name)).update(
+                   banner=None, modified_on=db.channel.modified_on)
+        elif job.kind == 'topic_images':
+            for image in payload['images']:
+                db(db.topic_image.id == image['id']).delete()
+                self._discard_unused(image['hash'], image['ext'])
+
+    def _discard_unused(self, image_hash, ext):
+        """ Removes an image file no other post references """
+        if db(db.topic_image.image_hash == image_hash).isempty():
+            image_store.discard({'hash': image_hash, 'ext': ext,
+                                 'created': True})
+
+    def status(self, job_id):
+        """ {'id', 'kind', 'status', 'error'} of a job, or None """
+        job = db.image_job(job_id)
+        if job is None:
+            return None
+        if job.status == 'pending' and self._is_stale(job):
+            self.finish(job.id, None, TimeoutError(
+                f'Not processed within {self.timeout} seconds'))
+            job = db.image_job(job_id)
+        return {
+            'id': job.id,
+            'kind': job.kind,
+            'status': job.status,
+            'error': job.error,
+            'created_by': job.created_by
+        }
+
+
+def _run_worker(kind, payload):
+    """ Entry point of the pool processes (must be a module function) """
+    return WORKERS[kind](payload)
+
+
+# Expose a single instance
+image_jobs = ImageJobs(settings.IMAGE_WORKERS, settings.IMAGE_JOB_TIMEOUT)
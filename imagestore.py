@@ -0,0 +1,253 @@
+"""
+Content addressed image storage.
+Uploads are streamed to disk in chunks (never held in memory as a whole)
+while being hashed, the sha256 of the content names the stored file, so
+the same image posted several times is stored once:
+
+    Z_EXTERNAL_IMAGES/topics/<h[:2]>/<h[2:4]>/<h>.<ext>
+    Z_EXTERNAL_IMAGES/topics/<h[:2]>/<h[2:4]>/<h>_<width>.<ext> (thumbnails)
+
+Thumbnails are generated when Pillow is installed, without it the
+original image is served in their place.
+"""
+import hashlib
+import os
+import tempfile
+from py4web import URL
+from . import settings
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Leading bytes of the accepted image formats: (extension, content type)
+SIGNATURES = (
+    (b'\xff\xd8\xff', ('jpg', 'image/jpeg')),
+    (b'\x89PNG\r\n\x1a\n', ('png', 'image/png')),
+    (b'GIF87a', ('gif', 'image/gif')),
+    (b'GIF89a', ('gif', 'image/gif')),
+)
+
+
+class ImageError(ValueError):
+    """ The upload is not an acceptable image, the message can be shown
+    to the user
+    """
+
+
+def sniff_image(header):
+    """ (extension, content type) of an image given its first bytes (at
+    least 12), None when it is not a supported format
+    """
+    for signature, image_type in SIGNATURES:
+        if header.startswith(signature):
+            return image_type
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return ('webp', 'image/webp')
+    return None
+
+
+class ImageStore:
+    """ Stores images under folder (served as URL('static', url_folder)) """
+
+    def __init__(self, folder, url_folder, thumbnail_widths=(240,),
+                 chunk_size=64 * 1024):
+        self.folder = folder
+        self.url_folder = url_folder
+        self.thumbnail_widths = tuple(sorted(thumbnail_widths))
+        self.chunk_size = chunk_size
+
+    def _relative_path(self, image_hash, ext, width=None):
+        name = f'{image_hash}_{width}.{ext}' if width else \
+            f'{image_hash}.{ext}'
+        return ('topics', image_hash[:2], image_hash[2:4], name)
+
+    def path(self, image_hash, ext, width=None):
+        return os.path.join(
+            self.folder, *self._relative_path(image_hash, ext, width))
+
+    def url(self, image_hash, ext, width=None):
+        return URL('static', self.url_folder,
+                   *self._relative_path(image_hash, ext, width))
+
+    def store(self, upload, max_size):
+        """ Streams a (ombott FileUpload) upload to the store, raises
+        ImageError if it is not a supported image or it is larger than
+        max_size bytes. Returns the stored image info:
+        {'hash', 'ext', 'content_type', 'size', 'filename', 'created'}
+        created is False when the same image was already stored.
+        """
+        stream = upload.file
+        stream.seek(0)
+        header = stream.read(self.chunk_size)
+        image_type = sniff_image(header)
+        if image_type is None:
+            raise ImageError(
+                f'{upload.filename} is not a JPEG, PNG, GIF or WEBP image.')
+        ext, content_type = image_type
+        tmp_folder = os.path.join(self.folder, 'topics')
+        os.makedirs(tmp_folder, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        # The temporary file lives in the store so the final rename is atomic
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_folder, suffix='.upload')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                chunk = header
+                while chunk:
+                    size += len(chunk)
+                    if size > max_size:
+                        raise ImageError(
+                            f'{upload.filename} is larger than the '
+                            f'{max_size} bytes allowed.')
+                    digest.update(chunk)
+                    tmp_file.write(chunk)
+                    chunk = stream.read(self.chunk_size)
+            image_hash = digest.hexdigest()
+            final_path = self.path(image_hash, ext)
+            created = not os.path.exists(final_path)
+            if created:
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                os.replace(tmp_path, final_path)
+            else:
+                os.unlink(tmp_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return {
+            'hash': image_hash,
+            'ext': ext,
+            'content_type': content_type,
+            'size': size,
+            'filename': os.path.basename(upload.filename or '')[:128],
+            'created': created
+        }
+
+    def discard(self, image):
+        """ Removes an image stored by store() (only if store created it)
+        along with its thumbnails
+        """
+        if not image.get('created'):
+            return
+        for width in (None,) + self.thumbnail_widths:
+            path = self.path(image['hash'], image['ext'], width)
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def make_thumbnails(self, image_hash, ext):
+        """ Generates the (missing) thumbnails of a stored image, returns
+        {'width', 'height', 'thumbnails': [widths]}, widths only lists the
+        thumbnails actually smaller than the original.
+        """
+        info = {'width': None, 'height': None, 'thumbnails': []}
+        if Image is None:
+            return info
+        with Image.open(self.path(image_hash, ext)) as original:
+            info['width'], info['height'] = original.size
+            for width in self.thumbnail_widths:
+                if width >= original.width:
+                    break
+                info['thumbnails'].append(width)
+                path = self.path(image_hash, ext, width)
+                if os.path.exists(path):
+                    continue
+                height = max(1, round(original.height * width / original.width))
+                thumbnail = original.copy()
+                thumbnail.thumbnail((width, height))
+                if ext == 'jpg' and thumbnail.mode not in ('RGB', 'L'):
+                    thumbnail = thumbnail.convert('RGB')
+                tmp_path = path + '.tmp'
+                thumbnail.save(tmp_path, format=original.format,
+                               optimize=True)
+                os.replace(tmp_path, path)
+        return info
+
+    def variants(self, image_hash, ext, thumbnails=()):
+        """ URLs of an image: {'url', 'thumbnail_url'}, the smallest
+        thumbnail (or the original when there is none)
+        """
+        url = self.url(image_hash, ext)
+        thumbnails = sorted(thumbnails)
+        return {
+            'url': url,
+            'thumbnail_url': self.url(image_hash, ext, thumbnails[0]) \
+                if thumbnails else url
+        }
+
+
+def decode_image(path):
+    """ Fully decodes an image file (not just its header) with Pillow,
+    raises ImageError if it is corrupt or not a supported image. Without
+    Pillow only the magic bytes are checked.
+    """
+    with open(path, 'rb') as image_file:
+        if sniff_image(image_file.read(16)) is None:
+            raise ImageError('Not a JPEG, PNG, GIF or WEBP image.')
+    if Image is None:
+        return
+    try:
+        with Image.open(path) as image:
+            image.verify()
+        # verify() leaves the image unusable, decode the pixels too
+        with Image.open(path) as image:
+            image.load()
+    except Exception as exc:
+        raise ImageError(f'Invalid image: {exc}') from exc
+
+
+# Worker side of the image jobs (see imagejobs.py), these run in a separate
+# process and must not use the database.
+
+def process_topic_images(images):
+    """ Decodes and generates the thumbnails of stored topic images,
+    images = [{'id': topic_image.id, 'hash', 'ext'}], returns
+    [{'id', 'valid', 'error', 'width', 'height', 'thumbnails'}]
+    """
+    results = []
+    for image in images:
+        result = {'id': image['id'], 'valid': True, 'error': None,
+                  'width': None, 'height': None, 'thumbnails': []}
+        try:
+            decode_image(image_store.path(image['hash'], image['ext']))
+            result.update(
+                image_store.make_thumbnails(image['hash'], image['ext']))
+        except (ImageError, OSError) as exc:
+            result.update({'valid': False, 'error': str(exc)})
+        results.append(result)
+    return results
+
+
+def process_channel_banner(upload_path, banner_path, max_width):
+    """ Decodes an uploaded banner and re-encodes it (dropping metadata,
+    scaled down to max_width) as banner_path. The upload is removed.
+    """
+    try:
+        decode_image(upload_path)
+        if Image is None:
+            os.replace(upload_path, banner_path)
+            return {'path': banner_path}
+        with Image.open(upload_path) as original:
+            image_format = original.format
+            banner = original.copy()
+        if banner.width > max_width:
+            banner.thumbnail(
+                (max_width, max(1, round(
+                    banner.height * max_width / banner.width))))
+        if image_format == 'JPEG' and banner.mode not in ('RGB', 'L'):
+            banner = banner.convert('RGB')
+        tmp_path = banner_path + '.tmp'
+        banner.save(tmp_path, format=image_format, optimize=True)
+        os.replace(tmp_path, banner_path)
+        return {'path': banner_path, 'width': banner.width,
+                'height': banner.height}
+    finally:
+        if os.path.exists(upload_path):
+            os.unlink(upload_path)
+
+
+# Expose a single instance
+image_store = ImageStore(
+    settings.Z_EXTERNAL_IMAGES, settings.Z_INTERNAL_IMAGES,
+    thumbnail_widths=settings.IMAGE_THUMBNAIL_WIDTHS)
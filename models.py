@@ -3,7 +3,9 @@ zForum database model.
 """
 
 import datetime
-from .common import db, Field
+from .common import db, db_read, Field
+from .dbindexes import ensure_indexes
+from .settings import DB_CREATE_INDEXES
 
 REF_AUTH_USER = 'reference auth_user'
 REF_CHANNEL = 'reference channel'
@@ -37,7 +39,13 @@ db.define_table(
     Field('modified_on', type='datetime', default=now, update=now),
     Field('is_private', type='boolean', default=False),
     Field('requires_membership', type='boolean', default=False),
-    Field('is_banned', type="boolean", default=False)
+    Field('is_banned', type="boolean", default=False),
+    # Maintained by postcounters.py
+    Field('topic_count', type='integer', default=0),
+    Field('response_count', type='integer', default=0),
+    Field('last_activity_on', type='datetime'),
+    # Bumped by trending.py when hot flags of its topics change (validators)
+    Field('hot_version', type='integer', default=0)
 )
 db.commit()
 
@@ -88,6 +96,9 @@ db.define_table(
     # Title is not required for topic responses, enforce in code/UI
     Field('title', type='string', length=128),
     Field('content', type='text', required=True),
+    # Pre-rendered, plain text (sanitized) excerpt of content used by the
+    # topic listings, see ForumHelper.make_topic_teaser
+    Field('teaser', type='text'),
     Field('is_readonly', type='boolean', default=False),
     # If is_visible = False, then only admins can see it:
     Field('is_visible', type='boolean', default=True),
@@ -98,6 +109,14 @@ db.define_table(
     Field('view', type='integer', default=0),
     Field('upvote', type='integer', default=0),
     Field('parent_id', type='integer'),
+    # Responses to a (parent) topic, maintained by postcounters.py
+    Field('reply_count', type='integer', default=0),
+    Field('last_reply_on', type='datetime'),
+    Field('last_reply_by', REF_AUTH_USER),
+    # Time decayed activity score and hot flag, computed periodically by
+    # trending.py (hot listings)
+    Field('hot_score', type='double', default=0),
+    Field('is_hot', type='boolean', default=False),
     Field('created_on', type='datetime', default=now),
     Field('modified_on', type='datetime', default=now, update=now),
     Field('created_by', REF_AUTH_USER),
@@ -197,8 +216,8 @@ db.commit()
 
 # Images will be stored in the filesystem, a hash will be
 # created to identify the location of the files (https://techfuel.net/story/3)
-# implemented in forumhelper.py
-# settings[Z_EXTERNAL_IMAGES]/users/[user_id]/[topic_id]/hash
+# implemented in imagestore.py (content addressed, sha256 of the image)
+# settings[Z_EXTERNAL_IMAGES]/topics/[hash[:2]]/[hash[2:4]]/hash.ext
 # metadata: json.loads('{"content-type": "image/jpeg", "size": "1700500"}')
 # System will allow up to 5 photos per post, (modifiable via system_setting) -
 # enforceable in code.
@@ -211,6 +230,88 @@ db.define_table(
 )
 db.commit()
 
+# Background image work (decoding, thumbnails, banners), see imagejobs.py
+# kind: topic_images | channel_banner
+# status: pending | done | failed
+db.define_table(
+    'image_job',
+    Field('kind', type='string', length=32, notnull=True),
+    Field('status', type='string', length=16, default='pending'),
+    Field('target_id', type='integer'),
+    Field('payload', type='text'),
+    Field('result', type='text'),
+    Field('error', type='string', length=512),
+    Field('created_by', REF_AUTH_USER),
+    Field('created_on', type='datetime', default=now),
+    Field('finished_on', type='datetime')
+)
+db.commit()
+
+# Hourly activity of the topics (see trending.py), the input of the hot
+# scores, buckets older than TRENDING_WINDOW_HOURS are pruned. A topic may
+# have more than one row per bucket, they are summed up.
+db.define_table(
+    'topic_activity_bucket',
+    Field('topic_id', type='integer', notnull=True),
+    Field('channel_id', type='integer'),
+    Field('bucket_start', type='datetime', notnull=True),
+    Field('views', type='integer', default=0),
+    Field('replies', type='integer', default=0),
+    Field('upvotes', type='integer', default=0)
+)
+db.commit()
+
+# Versions of the session cached user info (see
+# ForumHelper.get_user_info), shared by every process. user_id 0 holds the
+# version of everybody's.
+db.define_table(
+    'user_info_version',
+    Field('user_id', type='integer', notnull=True, unique=True),
+    Field('version', type='integer', default=0)
+)
+db.commit()
+
+# Leases of the periodic jobs run by a single process at a time (see
+# dbtools.py), holder identifies the process, expires_on is UTC
+db.define_table(
+    'job_lease',
+    Field('name', type='string', length=64, notnull=True, unique=True),
+    Field('holder', type='string', length=128),
+    Field('expires_on', type='datetime')
+)
+db.commit()
+
+# Materialized recent activity (latest postings and system announcements,
+# see activityfeed.py), pruned to the newest ACTIVITY_FEED_SIZE per kind.
+# kind: posting | announcement
+# is_public: the channel is neither private nor requires membership
+db.define_table(
+    'activity_feed',
+    Field('kind', type='string', length=16, notnull=True),
+    Field('topic_id', type='integer'),
+    Field('post_id', type='integer'),
+    Field('channel_id', type='integer'),
+    Field('channel_tag', type='string', length=64),
+    Field('title', type='string', length=128),
+    Field('username', type='string', length=128),
+    Field('is_public', type='boolean', default=True),
+    Field('created_on', type='datetime', default=now)
+)
+db.commit()
+
+# Persistent layer of the rendered markdown cache (see rendercache.py),
+# source_hash is the sha256 of the render flavor + the markdown source.
+db.define_table(
+    'render_cache',
+    Field('source_hash', type='string', length=64, notnull=True, unique=True),
+    Field('html', type='text'),
+    Field('created_on', type='datetime', default=now),
+    # Refreshed (at most daily) when read, rows unused for
+    # RENDER_CACHE_MAX_AGE days are pruned (see rendercache.py)
+    Field('used_on', type='datetime', default=now)
+)
+db.commit()
+
 # Miscellaneous error messages
 db.define_table(
     'error_messages',
@@ -223,17 +324,27 @@ db.commit()
 # correctly, verify that this is the case and populate the appropriate
 # tables if needed:
 
-# System Error Messages
-if db(db.error_messages).isempty():
-    error_messages = [
-        {'unauthorized', 'Not authorized to access this resource, please '
-         'contact the forum administrator.'
-        },
-        {'tagnotfound', 'Unable to find the selected channel '
-         'or you do not have the proper access.'
-        }
-    ]
-    db.error_messages.bulk_insert(error_messages)
+# System Error Messages (missing keys are added to existing databases too)
+error_messages = [
+    {'message_key': 'unauthorized',
+     'description': 'Not authorized to access this resource, please '
+     'contact the forum administrator.'
+    },
+    {'message_key': 'tagnotfound',
+     'description': 'Unable to find the selected channel '
+     'or you do not have the proper access.'
+    },
+    {'message_key': 'topicnotfound',
+     'description': 'Unable to find the selected topic '
+     'or you do not have the proper access.'
+    }
+]
+existing_keys = {row.message_key for row in db().select(
+    db.error_messages.message_key)}
+missing_messages = [message for message in error_messages
+                    if message['message_key'] not in existing_keys]
+if missing_messages:
+    db.error_messages.bulk_insert(missing_messages)
     db.commit()
 
 # Personal Messages:
@@ -488,3 +599,15 @@ if db(db.member_setting_template).isempty():
     ]
     db.member_setting_template.bulk_insert(settings)
     db.commit()
+
+# Indexes for the hot query paths (see dbindexes.py)
+if DB_CREATE_INDEXES:
+    ensure_indexes(db)
+
+# Mirror every table on the read replica connection (see common.py)
+if db_read is not db:
+    for table in db:
+        db_read.define_table(
+            table._tablename,
+            *[field.clone() for field in table if field.type != 'id'],
+            migrate=False)
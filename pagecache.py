@@ -0,0 +1,173 @@
+"""
+Page and fragment cache for the read heavy pages, on top of common.cache.
+Pages of the actions using the page_cache fixture are served from memory
+to anonymous visitors, keyed by path, query vars and language. Logged in
+users render their own page (the header is personal) but share the cached
+fragments (see fragment()), like the topics of a channel.
+
+Cached html records the generation of what it shows, declared with
+page_cache.depends('channel', channel_id), and is discarded once a write
+calls page_cache.bump('channel', channel_id). Generations are kept by each
+process, the others pick up the change when their entries expire
+(settings.PAGE_CACHE_TTL seconds). The validators of a cached page (see
+conditional.py) are kept with it, clients holding the same version get
+304 Not Modified from memory as well.
+"""
+import os
+import threading
+from collections import defaultdict
+from email.utils import parsedate_to_datetime
+from py4web import request, response, URL
+from py4web.core import Fixture, HTTP
+from yatl import render
+from yatl.helpers import XML
+from .assets import asset
+from .common import cache, session, auth
+from . import settings
+
+# Response headers replayed with the cached pages
+VALIDATORS = ('ETag', 'Last-Modified', 'Cache-Control')
+
+
+class PageCache(Fixture):
+    """ Caches the rendered pages of anonymous GET requests, declare it
+    before the template so it receives the html:
+    @action.uses(page_cache, 'page.html', ...)
+    """
+
+    def __init__(self, cache, ttl=60):
+        # Not auth: as a prerequisite it would be moved ahead of the
+        # template, so its on_success (which injects user) would run after
+        # the page is rendered. auth.user_id only needs the session.
+        self.__prerequisites__ = [session]
+        self.cache = cache
+        self.ttl = ttl
+        self._generations = defaultdict(int)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {'hits': 0, 'misses': 0,
+                       'fragment_hits': 0, 'fragment_misses': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def bump(self, scope, item_id=None):
+        """ Invalidates what shows scope (item_id), call after writes """
+        with self._lock:
+            self._generations[(scope, item_id)] += 1
+
+    def _snapshot(self, dependencies):
+        with self._lock:
+            return {dependency: self._generations[dependency]
+                    for dependency in dependencies}
+
+    def _is_current(self, cached):
+        if cached is None:
+            return False
+        with self._lock:
+            return all(self._generations[dependency] == generation
+                       for dependency, generation in cached[1].items())
+
+    def _entry(self, key):
+        """ The holder of a key, common.cache drops it after ttl seconds
+        and a new (empty) one is created """
+        return self.cache.get(key, dict, self.ttl)
+
+    def _language(self):
+        accept_language = request.headers.get('Accept-Language', '')
+        return accept_language.split(',')[0].split(';')[0].strip().lower()
+
+    def _query(self):
+        return '&'.join(sorted(
+            part for part in request.query_string.split('&') if part))
+
+    def depends(self, scope, item_id=None):
+        """ Declares that the page being rendered shows scope (item_id),
+        call it before reading the data """
+        pending = getattr(self._local, 'pending', None)
+        if pending is not None:
+            pending['dependencies'].update(
+                self._snapshot([(scope, item_id)]))
+
+    def on_hit(self, callback, *args):
+        """ Registers a call the cached page repeats each time it is
+        served (e.g. counting the view) """
+        pending = getattr(self._local, 'pending', None)
+        if pending is not None:
+            pending['on_hit'].append((callback, args))
+
+    def on_request(self, context=None):
+        self._local.pending = None
+        if request.method != 'GET' or auth.user_id or \
+                'Authorization' in request.headers:
+            return
+        key = ('page', request.path, self._query(), self._language())
+        cached = self._entry(key).get('page')
+        if self._is_current(cached):
+            # Imported here, conditional.py depends on forumhelper.py
+            from .conditional import is_fresh
+            self._count('hits')
+            (html, headers), _, on_hit = cached
+            for callback, args in on_hit:
+                callback(*args)
+            response.headers.update(headers)
+            last_modified = headers.get('Last-Modified')
+            if 'ETag' in headers and is_fresh(
+                    request.headers, headers['ETag'],
+                    parsedate_to_datetime(last_modified) \
+                        if last_modified else None):
+                raise HTTP(304)
+            raise HTTP(200, body=html)
+        self._count('misses')
+        self._local.pending = {'key': key, 'dependencies': {}, 'on_hit': []}
+
+    def on_success(self, context=None):
+        pending, self._local.pending = \
+            getattr(self._local, 'pending', None), None
+        output = context.get('output') if context else None
+        # Only rendered pages, not redirects or other outputs
+        if pending is not None and isinstance(output, str):
+            headers = {name: response.headers[name]
+                       for name in VALIDATORS if name in response.headers}
+            self._entry(pending['key'])['page'] = (
+                (output, headers), pending['dependencies'],
+                pending['on_hit'])
+
+    def on_error(self, context=None):
+        self._local.pending = None
+
+    def fragment(self, name, dependencies, callback):
+        """ Value of callback() shared by every user (logged in or not)
+        until one of its dependencies [(scope, item_id)] changes, name
+        identifies it (e.g. ('channel-topics', channel_id, cursor)).
+        """
+        for dependency in dependencies:
+            self.depends(*dependency)
+        entry = self._entry(('fragment', name, self._language()))
+        cached = entry.get('page')
+        if self._is_current(cached):
+            self._count('fragment_hits')
+            return cached[0]
+        self._count('fragment_misses')
+        generations = self._snapshot(dependencies)
+        value = callback()
+        entry['page'] = (value, generations, [])
+        return value
+
+    def render(self, template, **context):
+        """ Renders a partial template (no layout) to html """
+        path = os.path.join(settings.APP_FOLDER, 'templates')
+        values = {'URL': URL, 'XML': XML, 'asset': asset}
+        values.update(context)
+        return render(filename=os.path.join(path, template), path=path,
+                      context=values, delimiters='[[ ]]')
+
+    def stats(self):
+        """ Returns a copy of the hit/miss counters """
+        with self._lock:
+            return dict(self._stats)
+
+
+# Expose a single instance
+page_cache = PageCache(cache, ttl=settings.PAGE_CACHE_TTL)
@@ -0,0 +1,139 @@
+"""
+Per-request permission context.
+Resolves, once per request and user, whether the user is a system admin,
+which channels the user administers and the user's channel memberships,
+so the several authorization checks an action performs do not each go to
+the database.
+"""
+from datetime import datetime
+from py4web import request
+from .common import db, groups
+
+# Key used to keep the contexts of the current request in its WSGI environ
+ENVIRON_KEY = 'zforum.permissions'
+
+
+class PermissionContext:
+    """ Lazily loaded and memoized authorization facts for one user """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._is_sysadmin = None
+        self._admin_channels = None
+        self._memberships = None
+
+    @property
+    def is_sysadmin(self):
+        """ True if the user is in the Managers group """
+        if self._is_sysadmin is None:
+            self._is_sysadmin = bool(self.user_id) and \
+                'manager' in groups.get(self.user_id)
+        return self._is_sysadmin
+
+    @property
+    def admin_channels(self):
+        """ Set of channel ids the user is an (active) admin of """
+        if self._admin_channels is None:
+            self._admin_channels = set()
+            if self.user_id:
+                rows = db(
+                    (db.channel_admin.user_id == self.user_id) &
+                    (db.channel_admin.is_active == True)).select(
+                        db.channel_admin.channel_id)
+                self._admin_channels = {row.channel_id for row in rows}
+        return self._admin_channels
+
+    @property
+    def memberships(self):
+        """ {channel_id: membership row} of the user's memberships """
+        if self._memberships is None:
+            self._memberships = {}
+            if self.user_id:
+                rows = db(
+                    db.channel_membership.user_id == self.user_id).select(
+                        db.channel_membership.channel_id,
+                        db.channel_membership.expires_on,
+                        db.channel_membership.is_new_request)
+                self._memberships = {row.channel_id: row for row in rows}
+        return self._memberships
+
+    @property
+    def member_channels(self):
+        """ Set of channel ids the user can read the topics of as an
+        accepted (not pending nor expired) member or channel admin """
+        channels = set(self.admin_channels)
+        for channel_id in self.memberships:
+            membership_state = self.channel_membership(channel_id)
+            if membership_state['has_membership'] and \
+                    not membership_state['is_pending']:
+                channels.add(channel_id)
+        return channels
+
+    def is_channel_admin(self, channel_id):
+        """ True if the user administers the channel """
+        return int(channel_id) in self.admin_channels
+
+    def can_admin_channel(self, channel_id):
+        """ System admins can administer any channel """
+        return self.is_sysadmin or self.is_channel_admin(channel_id)
+
+    def channel_membership(self, channel_id):
+        """ Returns the membership state of the user on the channel,
+        {'has_membership': bool, 'is_pending': bool, 'is_expired': bool}
+        Admins and Channel Admins are _always_ members.
+        """
+        membership_state = {
+            'has_membership': False,
+            'is_pending': False,
+            'is_expired': False
+        }
+        if not self.user_id:
+            return membership_state
+        if self.can_admin_channel(channel_id):
+            membership_state['has_membership'] = True
+            return membership_state
+        membership = self.memberships.get(int(channel_id))
+        if membership and membership.is_new_request:
+            membership_state['has_membership'] = True
+            membership_state['is_pending'] = True
+        elif membership and membership.expires_on:
+            if membership.expires_on >= datetime.now():
+                membership_state['has_membership'] = True
+            else:
+                membership_state['is_expired'] = True
+        return membership_state
+
+
+def _request_contexts():
+    """ Returns the {user_id: PermissionContext} dictionary of the current
+    request, or None when running outside of a request (e.g. tasks)
+    """
+    try:
+        return request.environ.setdefault(ENVIRON_KEY, {})
+    except (AttributeError, KeyError, RuntimeError):
+        return None
+
+
+def get_permissions(user_id):
+    """ Returns the permission context of user_id for the current request,
+    creating it on first use.
+    """
+    contexts = _request_contexts()
+    if contexts is None:
+        return PermissionContext(user_id)
+    if user_id not in contexts:
+        contexts[user_id] = PermissionContext(user_id)
+    return contexts[user_id]
+
+
+def invalidate_permissions(user_id=None):
+    """ Forgets the memoized permissions of user_id (or of every user when
+    not given) for the current request, call after changing them.
+    """
+    contexts = _request_contexts()
+    if contexts is None:
+        return
+    if user_id is None:
+        contexts.clear()
+    else:
+        contexts.pop(user_id, None)
@@ -0,0 +1,170 @@
+"""
+Denormalized post counters.
+topic.reply_count/last_reply_on/last_reply_by and channel.topic_count/
+response_count/last_activity_on are maintained as topics and responses are
+added or removed (in the same transaction as the insert/delete, py4web
+commits at the end of the request), so the listings do not have to
+aggregate the topic table. repair() recomputes them all in bulk.
+The zfmp_posts/zfmp_replies member counters of the author are maintained
+along (see ForumHelper.add_member_posting).
+"""
+from collections import defaultdict
+from .common import db
+from .forumhelper import forumhelper as fh
+from .pagecache import page_cache
+from .rankengine import rank_engine
+from .trending import trending
+
+
+class PostCounters:
+    """ Incremental maintenance of the topic/channel counters """
+
+    def topic_added(self, channel_id, topic_id, parent_id=None,
+                    user_id=None, created_on=None):
+        """ Call after inserting a topic, or a response (parent_id) """
+        created_on = created_on or db(db.topic.id == topic_id).select(
+            db.topic.created_on).first().created_on
+        if parent_id:
+            # modified_on reflects edits of the topic itself, keep it
+            db(db.topic.id == parent_id).update(
+                reply_count=db.topic.reply_count.coalesce_zero() + 1,
+                last_reply_on=created_on,
+                last_reply_by=user_id,
+                modified_on=db.topic.modified_on)
+            db(db.channel.id == channel_id).update(
+                response_count=db.channel.response_count.coalesce_zero() + 1,
+                last_activity_on=created_on,
+                modified_on=db.channel.modified_on)
+            trending.reply_added(parent_id)
+        else:
+            db(db.channel.id == channel_id).update(
+                topic_count=db.channel.topic_count.coalesce_zero() + 1,
+                last_activity_on=created_on,
+                modified_on=db.channel.modified_on)
+        rank_engine.topic_added(channel_id, is_parent=not parent_id)
+        if user_id:
+            fh.add_member_posting(user_id, is_reply=bool(parent_id))
+        self._changed(channel_id)
+
+    def _changed(self, channel_id):
+        # Cached pages showing the channel (see pagecache.py)
+        page_cache.bump('channel', channel_id)
+        page_cache.bump('channels')
+
+    def topic_removed(self, topic):
+        """ Call before deleting a topic or a response (same transaction),
+        topic is the row (id, channel_id, is_parent, parent_id, reply_count,
+        created_by). Removing a topic also removes the count of its
+        responses, from the channel and from the counters of their authors.
+        channel.last_activity_on is left as is (it is recomputed by repair)
+        """
+        self._changed(topic.channel_id)
+        if topic.created_by:
+            fh.add_member_posting(
+                topic.created_by, is_reply=not topic.is_parent, count=-1)
+        if topic.is_parent:
+            total = db.topic.id.count()
+            for row in db((db.topic.parent_id == topic.id) &
+                          (db.topic.is_parent == False) &
+                          (db.topic.created_by != None)).select(
+                    db.topic.created_by, total,
+                    groupby=db.topic.created_by):
+                fh.add_member_posting(
+                    row.topic.created_by, is_reply=True, count=-row[total])
+            trending.topic_removed(topic.id)
+            responses = topic.reply_count or 0
+            db(db.channel.id == topic.channel_id).update(
+                topic_count=db.channel.topic_count.coalesce_zero() - 1,
+                response_count=(
+                    db.channel.response_count.coalesce_zero() - responses),
+                modified_on=db.channel.modified_on)
+            rank_engine.topic_removed(topic.channel_id)
+            if responses:
+                rank_engine.topic_removed(
+                    topic.channel_id, is_parent=False, count=responses)
+            return
+        # The latest remaining response becomes the "last reply"
+        last_reply = db(
+            (db.topic.parent_id == topic.parent_id) &
+            (db.topic.is_parent == False) &
+            (db.topic.id != topic.id)).select(
+                db.topic.created_on, db.topic.created_by,
+                orderby=~db.topic.created_on|~db.topic.id,
+                limitby=(0, 1)).first()
+        db(db.topic.id == topic.parent_id).update(
+            reply_count=db.topic.reply_count.coalesce_zero() - 1,
+            last_reply_on=last_reply.created_on if last_reply else None,
+            last_reply_by=last_reply.created_by if last_reply else None,
+            modified_on=db.topic.modified_on)
+        db(db.channel.id == topic.channel_id).update(
+            response_count=db.channel.response_count.coalesce_zero() - 1,
+            modified_on=db.channel.modified_on)
+        rank_engine.topic_removed(topic.channel_id, is_parent=False)
+        trending.reply_removed(topic.parent_id)
+
+    def repair(self, batch_size=500):
+        """ Recomputes every counter from the topic table using aggregate
+        queries, only rows whose values are off are updated. Returns a tuple
+        (topics fixed, channels fixed).
+        """
+        # Topics: one aggregate for the counts/dates of all the threads
+        total = db.topic.id.count()
+        latest = db.topic.created_on.max()
+        replies = {}
+        for row in db((db.topic.is_parent == False) &
+                      (db.topic.parent_id != None)).select(
+                db.topic.parent_id, total, latest,
+                groupby=db.topic.parent_id):
+            replies[row.topic.parent_id] = [row[total], row[latest], None]
+        # Author of the last response of every thread
+        for row in db((db.topic.is_parent == False) &
+                      (db.topic.parent_id != None)).iterselect(
+                db.topic.parent_id, db.topic.created_on,
+                db.topic.created_by,
+                orderby=db.topic.parent_id|db.topic.created_on|db.topic.id):
+            thread = replies.get(row.parent_id)
+            if thread and row.created_on == thread[1]:
+                thread[2] = row.created_by
+        topics_fixed = 0
+        for row in db(db.topic.is_parent == True).iterselect(
+                db.topic.id, db.topic.reply_count, db.topic.last_reply_on,
+                db.topic.last_reply_by):
+            count, last_on, last_by = replies.get(row.id, (0, None, None))
+            if (row.reply_count, row.last_reply_on, row.last_reply_by) != \
+                    (count, last_on, last_by):
+                db(db.topic.id == row.id).update(
+                    reply_count=count, last_reply_on=last_on,
+                    last_reply_by=last_by, modified_on=db.topic.modified_on)
+                topics_fixed += 1
+                if topics_fixed % batch_size == 0:
+                    db.commit()
+        # Channels: one aggregate grouped by channel and kind
+        counts = defaultdict(lambda: {True: 0, False: 0, 'latest': None})
+        for row in db(db.topic.channel_id != None).select(
+                db.topic.channel_id, db.topic.is_parent, total, latest,
+                groupby=db.topic.channel_id|db.topic.is_parent):
+            channel_counts = counts[row.topic.channel_id]
+            channel_counts[bool(row.topic.is_parent)] = row[total]
+            if row[latest] and (channel_counts['latest'] is None or
+                                row[latest] > channel_counts['latest']):
+                channel_counts['latest'] = row[latest]
+        channels_fixed = 0
+        for row in db(db.channel).select(
+                db.channel.id, db.channel.topic_count,
+                db.channel.response_count, db.channel.last_activity_on):
+            channel_counts = counts[row.id]
+            values = (channel_counts[True], channel_counts[False],
+                      channel_counts['latest'])
+            if (row.topic_count, row.response_count,
+                    row.last_activity_on) != values:
+                db(db.channel.id == row.id).update(
+                    topic_count=values[0], response_count=values[1],
+                    last_activity_on=values[2],
+                    modified_on=db.channel.modified_on)
+                channels_fixed += 1
+        db.commit()
+        return topics_fixed, channels_fixed
+
+
+# Expose a single instance
+post_counters = PostCounters()
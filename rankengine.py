@@ -0,0 +1,83 @@
+"""
+Channel rank engine.
+Rank = channel views (15%) + topics in it (50%) + responses to topics (35%)
+(see models.py), the stored channel.rank is kept up to date incrementally
+as topics, responses and (flushed) views are added, reconcile() recomputes
+every channel from scratch.
+"""
+from collections import defaultdict
+from decimal import Decimal
+from .common import db
+from .viewcounter import view_counter
+
+VIEW_WEIGHT = Decimal('0.15')
+TOPIC_WEIGHT = Decimal('0.50')
+RESPONSE_WEIGHT = Decimal('0.35')
+
+
+class RankEngine:
+    """ Incremental maintenance of channel.rank """
+
+    def _increment(self, channel_ids, amount):
+        # modified_on reflects edits/activity on the channel itself, keep it
+        db(db.channel.id.belongs(channel_ids)).update(
+            rank=db.channel.rank + amount,
+            modified_on=db.channel.modified_on)
+
+    def topic_added(self, channel_id, is_parent=True, count=1):
+        """ Call after inserting topics (is_parent) or responses """
+        weight = TOPIC_WEIGHT if is_parent else RESPONSE_WEIGHT
+        self._increment([channel_id], weight * count)
+
+    def topic_removed(self, channel_id, is_parent=True, count=1):
+        """ Call after deleting topics (is_parent) or responses """
+        weight = TOPIC_WEIGHT if is_parent else RESPONSE_WEIGHT
+        self._increment([channel_id], -weight * count)
+
+    def views_added(self, totals):
+        """ view_counter listener, receives {(tablename, id): views} """
+        by_views = defaultdict(list)
+        for (tablename, record_id), views in totals.items():
+            if tablename == 'channel':
+                by_views[views].append(record_id)
+        for views, channel_ids in by_views.items():
+            self._increment(channel_ids, VIEW_WEIGHT * views)
+
+    def compute_rank(self, views, topics, responses):
+        """ The rank formula """
+        return (VIEW_WEIGHT * (views or 0) + TOPIC_WEIGHT * topics +
+                RESPONSE_WEIGHT * responses)
+
+    def reconcile(self):
+        """ Recomputes the rank of every channel, counting topics and
+        responses of all channels in a single aggregate query. Returns the
+        number of channels whose stored rank was off.
+        """
+        counts = defaultdict(lambda: {True: 0, False: 0})
+        total = db.topic.id.count()
+        rows = db(db.topic.channel_id != None).select(
+            db.topic.channel_id,
+            db.topic.is_parent,
+            total,
+            groupby=db.topic.channel_id|db.topic.is_parent)
+        for row in rows:
+            counts[row.topic.channel_id][bool(row.topic.is_parent)] = \
+                row[total]
+        fixed = 0
+        for channel in db(db.channel).select(
+                db.channel.id, db.channel.view, db.channel.rank):
+            channel_counts = counts[channel.id]
+            rank = self.compute_rank(
+                channel.view, channel_counts[True], channel_counts[False])
+            if Decimal(channel.rank or 0) != rank:
+                db(db.channel.id == channel.id).update(
+                    rank=rank, modified_on=db.channel.modified_on)
+                fixed += 1
+        db.commit()
+        return fixed
+
+
+# Expose a single instance
+rank_engine = RankEngine()
+# Flushed channel views move the rank as well
+view_counter.listeners.append(rank_engine.views_added)
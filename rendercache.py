@@ -0,0 +1,158 @@
+"""
+Rendered markdown cache.
+Channel titles/descriptions (and other markdown sources) are rendered on
+almost every page, this module keeps the resulting html keyed by a hash of
+the source text, in an in-process LRU and optionally in the render_cache
+table, so the same text is only parsed once. Rows not used for
+RENDER_CACHE_MAX_AGE days are pruned daily by the prune_render_cache task
+(USE_CELERY) or else by a thread of the web process holding the
+'render_cache' lease (see dbtools.py).
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from markdown import markdown
+from yatl.helpers import XML
+from .common import db, logger
+from .dbtools import acquire_lease, insert_if_absent
+from . import settings
+
+# Seconds between two prunes of the render_cache table
+PRUNE_INTERVAL = 86400
+
+
+class RenderCache:
+    """ Two level (LRU + database) cache of markdown renders """
+
+    def __init__(self, size=1000, persist=False, max_age=30):
+        self.size = size
+        self.persist = persist
+        self.max_age = max_age
+        self._pruner = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'db_hits': 0, 'misses': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _source_hash(self, text, sanitize):
+        """ The flavor of the render is part of the key, the same source
+        rendered with and without sanitization are different entries
+        """
+        flavor = 's' if sanitize else 'r'
+        return hashlib.sha256(
+            (flavor + ':' + text).encode('utf-8')).hexdigest()
+
+    def _remember(self, source_hash, html):
+        with self._lock:
+            self._entries[source_hash] = html
+            self._entries.move_to_end(source_hash)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def _render(self, text, sanitize):
+        if sanitize:
+            text = XML(text, sanitize=True).xml()
+        return markdown(text)
+
+    def render(self, text, sanitize=False):
+        """ Returns the html of the markdown text, when sanitize is True
+        the source is sanitized before it is rendered (same as
+        markdown(XML(text, sanitize=True).xml()))
+        """
+        text = text or ''
+        source_hash = self._source_hash(text, sanitize)
+        with self._lock:
+            html = self._entries.get(source_hash)
+            if html is not None:
+                self._entries.move_to_end(source_hash)
+                self._stats['hits'] += 1
+                return html
+        if self.persist:
+            self._ensure_pruner()
+            row = db(db.render_cache.source_hash == source_hash).select(
+                db.render_cache.id, db.render_cache.html,
+                db.render_cache.used_on).first()
+            if row is not None:
+                self._count('db_hits')
+                self._touch(row)
+                self._remember(source_hash, row.html)
+                return row.html
+        self._count('misses')
+        html = self._render(text, sanitize)
+        if self.persist:
+            # Another process may have stored the same render meanwhile
+            insert_if_absent(
+                db.render_cache, source_hash=source_hash, html=html)
+        self._remember(source_hash, html)
+        return html
+
+    def _touch(self, row):
+        """ Marks a row as used, written at most once a day """
+        now = datetime.now(timezone.utc)
+        used_on = row.used_on
+        if used_on is not None and used_on.tzinfo is None:
+            used_on = used_on.replace(tzinfo=timezone.utc)
+        if used_on is None or now - used_on > timedelta(days=1):
+            db(db.render_cache.id == row.id).update(used_on=now)
+
+    def prune(self):
+        """ Deletes the rows not used for max_age days, returns how many
+        """
+        since = datetime.now(timezone.utc) - timedelta(days=self.max_age)
+        return db((db.render_cache.used_on < since) |
+                  (db.render_cache.used_on == None)).delete()
+
+    def _ensure_pruner(self):
+        """ Starts the daemon thread pruning the table when this process
+        holds the lease, unless the prune_render_cache task does
+        (USE_CELERY)
+        """
+        if self._pruner is not None or settings.USE_CELERY:
+            return
+        with self._lock:
+            if self._pruner is not None:
+                return
+            self._pruner = threading.Thread(
+                target=self._prune_forever, name='zforum-render-cache',
+                daemon=True)
+        self._pruner.start()
+
+    def _prune_forever(self):
+        while True:
+            time.sleep(PRUNE_INTERVAL)
+            try:
+                # this thread needs its own db connection
+                db._adapter.reconnect()
+                # Only one process prunes, for a bit over an interval
+                if not acquire_lease(
+                        db, 'render_cache', PRUNE_INTERVAL * 1.5):
+                    continue
+                self.prune()
+                db.commit()
+            except Exception as exc:
+                db.rollback()
+                logger.error('Unable to prune the render cache: %s', exc)
+
+    def stats(self):
+        """ Returns a copy of the hit/miss counters and the LRU size """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        return stats
+
+    def clear(self):
+        """ Empties the in-process layer and resets the counters """
+        with self._lock:
+            self._entries.clear()
+            self._stats = {'hits': 0, 'db_hits': 0, 'misses': 0}
+
+
+# Expose a single instance
+render_cache = RenderCache(
+    size=settings.RENDER_CACHE_SIZE, persist=settings.RENDER_CACHE_PERSIST,
+    max_age=settings.RENDER_CACHE_MAX_AGE)
@@ -0,0 +1,346 @@
+"""
+Server side full text search over channels and (parent) topics.
+On SQLite with FTS5 available, documents are kept in the zf_search FTS5
+virtual table (inside the same database, so index updates are part of
+the request transaction) and ranked with bm25. Anywhere else a pure python
+inverted index is built in memory and ranked with tf-idf, it is rebuilt
+every SEARCH_REBUILD_INTERVAL seconds to pick up changes made by other
+processes.
+"""
+import math
+import re
+import threading
+import time
+from collections import defaultdict
+from .common import db, logger
+from .settings import SEARCH_REBUILD_INTERVAL
+
+FTS_TABLE = 'zf_search'
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+# Title matches weigh more than content matches
+TITLE_WEIGHT = 5.0
+SNIPPET_LENGTH = 160
+
+
+def tokenize(text):
+    """ Lowercase word tokens (2+ characters) of text """
+    return [tok for tok in TOKEN_RE.findall((text or '').lower())
+            if len(tok) > 1]
+
+
+def make_snippet(text):
+    """ Plain text excerpt shown with a search result """
+    text = ' '.join((text or '').split())
+    if len(text) > SNIPPET_LENGTH:
+        text = text[:SNIPPET_LENGTH].rsplit(' ', 1)[0] + '...'
+    return text
+
+
+class InvertedIndex:
+    """ Minimal in-memory inverted index, documents are keyed by
+    (kind, ref_id)
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(dict)  # token -> {doc_key: weight}
+        self.documents = {}  # doc_key -> {'channel_id', 'title', ...}
+        self.built_on = None
+
+    def add(self, kind, ref_id, channel_id, title, content):
+        key = (kind, ref_id)
+        self.remove(kind, ref_id)
+        weights = defaultdict(float)
+        for tok in tokenize(title):
+            weights[tok] += TITLE_WEIGHT
+        for tok in tokenize(content):
+            weights[tok] += 1.0
+        for tok, weight in weights.items():
+            self.postings[tok][key] = weight
+        self.documents[key] = {
+            'channel_id': channel_id,
+            'title': title or '',
+            'snippet': make_snippet(content),
+            'tokens': list(weights)
+        }
+
+    def remove(self, kind, ref_id):
+        document = self.documents.pop((kind, ref_id), None)
+        if document:
+            for tok in document['tokens']:
+                self.postings[tok].pop((kind, ref_id), None)
+                if not self.postings[tok]:
+                    del self.postings[tok]
+
+    def search(self, query):
+        """ Returns [(score, doc_key)] of the documents containing every
+        token of query (the last token is matched as a prefix), best first
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        total = len(self.documents) or 1
+        scores = None
+        for idx, tok in enumerate(tokens):
+            if idx == len(tokens) - 1:
+                matches = [t for t in self.postings if t.startswith(tok)]
+            else:
+                matches = [tok] if tok in self.postings else []
+            tok_scores = defaultdict(float)
+            for match in matches:
+                postings = self.postings[match]
+                idf = math.log(1 + total / len(postings))
+                for key, weight in postings.items():
+                    tok_scores[key] += (1 + math.log(weight)) * idf
+            if scores is None:
+                scores = tok_scores
+            else:
+                scores = {key: score + tok_scores[key]
+                          for key, score in scores.items()
+                          if key in tok_scores}
+            if not scores:
+                return []
+        return sorted(((score, key) for key, score in scores.items()),
+                      reverse=True)
+
+
+class SearchIndex:
+    """ Channel/topic search, FTS5 backed when available """
+
+    def __init__(self):
+        self._use_fts = None
+        self._memory = None
+        self._lock = threading.Lock()
+
+    # ###################################################################
+    # Backend selection
+    # ###################################################################
+    def uses_fts(self):
+        """ True when the FTS5 virtual table is available """
+        if self._use_fts is None:
+            self._use_fts = False
+            if db._dbname == 'sqlite':
+                try:
+                    db.executesql(
+                        f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} '
+                        'USING fts5(kind UNINDEXED, ref_id UNINDEXED, '
+                        'channel_id UNINDEXED, title, content, '
+                        "tokenize='porter unicode61');")
+                    db.commit()
+                    self._use_fts = True
+                    empty = not db.executesql(
+                        f'SELECT 1 FROM {FTS_TABLE} LIMIT 1;')
+                    if empty and not db(db.channel).isempty():
+                        # First run over an existing database
+                        self.rebuild()
+                except Exception as exc:
+                    db.rollback()
+                    logger.warning('FTS5 not available (%s), using the '
+                                   'in-memory search index.', exc)
+        return self._use_fts
+
+    def _memory_index(self):
+        """ Returns the in-memory index, (re)building it when stale """
+        memory = self._memory
+        if memory is None or \
+            time.monotonic() - memory.built_on > SEARCH_REBUILD_INTERVAL:
+            with self._lock:
+                memory = InvertedIndex()
+                for kind, ref_id, channel_id, title, content in \
+                        self._documents():
+                    memory.add(kind, ref_id, channel_id, title, content)
+                memory.built_on = time.monotonic()
+                self._memory = memory
+        return memory
+
+    def _documents(self):
+        """ Yields every searchable document from the database """
+        for row in db(db.channel).iterselect(
+                db.channel.id, db.channel.title, db.channel.content):
+            yield 'channel', row.id, row.id, row.title, row.content
+        for row in db(
+            (db.topic.is_parent == True) &
+            (db.topic.is_visible == True)).iterselect(
+                db.topic.id, db.topic.channel_id, db.topic.title,
+                db.topic.content):
+            yield 'topic', row.id, row.channel_id, row.title, row.content
+
+    # ###################################################################
+    # Index maintenance
+    # ###################################################################
+    def _add(self, kind, ref_id, channel_id, title, content):
+        if self.uses_fts():
+            self._remove(kind, ref_id)
+            db.executesql(
+                f'INSERT INTO {FTS_TABLE} '
+                '(kind, ref_id, channel_id, title, content) '
+                'VALUES (?, ?, ?, ?, ?);',
+                placeholders=[kind, ref_id, channel_id, title or '',
+                              content or ''])
+        elif self._memory is not None:
+            with self._lock:
+                self._memory.add(kind, ref_id, channel_id, title, content)
+
+    def _remove(self, kind, ref_id):
+        if self.uses_fts():
+            db.executesql(
+                f'DELETE FROM {FTS_TABLE} WHERE kind = ? AND ref_id = ?;',
+                placeholders=[kind, ref_id])
+        elif self._memory is not None:
+            with self._lock:
+                self._memory.remove(kind, ref_id)
+
+    def index_channel(self, channel_id, title, content):
+        """ Call after inserting/updating a channel """
+        self._add('channel', int(channel_id), int(channel_id), title,
+                  content)
+
+    def index_topic(self, topic_id, channel_id, title, content):
+        """ Call after inserting/updating a (parent) topic """
+        self._add('topic', int(topic_id), int(channel_id), title, content)
+
+    def remove_channel(self, channel_id):
+        self._remove('channel', int(channel_id))
+
+    def remove_topic(self, topic_id):
+        self._remove('topic', int(topic_id))
+
+    def rebuild(self):
+        """ Drops and rebuilds the whole index, returns the number of
+        documents indexed
+        """
+        count = 0
+        if self.uses_fts():
+            db.executesql(f'DELETE FROM {FTS_TABLE};')
+            batch = []
+            for document in self._documents():
+                batch.append(document)
+                if len(batch) >= 500:
+                    count += self._insert_batch(batch)
+                    batch = []
+            count += self._insert_batch(batch)
+            db.commit()
+        else:
+            self._memory = None
+            count = len(self._memory_index().documents)
+        return count
+
+    def _insert_batch(self, batch):
+        for kind, ref_id, channel_id, title, content in batch:
+            db.executesql(
+                f'INSERT INTO {FTS_TABLE} '
+                '(kind, ref_id, channel_id, title, content) '
+                'VALUES (?, ?, ?, ?, ?);',
+                placeholders=[kind, ref_id, channel_id, title or '',
+                              content or ''])
+        return len(batch)
+
+    # ###################################################################
+    # Querying
+    # ###################################################################
+    def search(self, query, page=1, page_size=20, include_private=False,
+               member_channels=None):
+        """ Ranked search, returns {'results': [...], 'page': page,
+        'has_more': bool}, each result being
+        {'kind', 'id', 'channel_id', 'tag', 'title', 'snippet'}.
+        Private channels (and their topics) are excluded unless
+        include_private is True (system admins), so are the topics of the
+        channels requiring membership, except those of member_channels
+        (ids of the channels the user is an accepted member of).
+        """
+        member_channels = [int(channel_id)
+                           for channel_id in member_channels or ()]
+        page = max(int(page), 1)
+        offset = (page - 1) * page_size
+        if not tokenize(query):
+            return {'results': [], 'page': page, 'has_more': False}
+        if self.uses_fts():
+            hits = self._search_fts(
+                query, offset, page_size + 1, include_private,
+                member_channels)
+        else:
+            hits = self._search_memory(
+                query, offset, page_size + 1, include_private,
+                member_channels)
+        has_more = len(hits) > page_size
+        hits = hits[:page_size]
+        channel_ids = {hit['channel_id'] for hit in hits}
+        tags = {}
+        if channel_ids:
+            tags = {row.id: row.tag for row in db(
+                db.channel.id.belongs(channel_ids)).select(
+                    db.channel.id, db.channel.tag)}
+        for hit in hits:
+            hit['tag'] = tags.get(hit['channel_id'], '')
+        return {'results': hits, 'page': page, 'has_more': has_more}
+
+    def _search_fts(self, query, offset, limit, include_private,
+                    member_channels):
+        tokens = tokenize(query)
+        # Quote every token (no FTS syntax from users), prefix the last one
+        match = ' '.join('"%s"' % tok for tok in tokens[:-1])
+        match += ' "%s"*' % tokens[-1]
+        channel = db.channel
+        is_private = f'c.{channel.is_private._rname}'
+        requires_membership = f'c.{channel.requires_membership._rname}'
+        # Topics of membership channels only for their members
+        members_only = ''
+        if member_channels:
+            members_only = 'OR s.channel_id IN (%s) ' % ', '.join(
+                '?' * len(member_channels))
+        rows = db.executesql(
+            f'SELECT s.kind, s.ref_id, s.channel_id, s.title, '
+            f"snippet({FTS_TABLE}, 4, '', '', '...', 24) "
+            f'FROM {FTS_TABLE} s JOIN {channel._rname} c '
+            f'ON c.{channel.id._rname} = s.channel_id '
+            f'WHERE {FTS_TABLE} MATCH ? '
+            f'AND (? OR {is_private} IS NULL OR {is_private} = ?) '
+            f"AND (? OR s.kind <> 'topic' OR {requires_membership} IS NULL "
+            f'OR {requires_membership} = ? {members_only}) '
+            f'ORDER BY bm25({FTS_TABLE}, 0, 0, 0, {TITLE_WEIGHT}, 1.0) '
+            'LIMIT ? OFFSET ?;',
+            placeholders=[match.strip(), 1 if include_private else 0,
+                          'F', 1 if include_private else 0, 'F'] +
+                member_channels + [limit, offset])
+        return [{
+            'kind': kind,
+            'id': int(ref_id),
+            'channel_id': int(channel_id),
+            'title': title,
+            'snippet': snippet
+        } for kind, ref_id, channel_id, title, snippet in rows]
+
+    def _search_memory(self, query, offset, limit, include_private,
+                       member_channels):
+        memory = self._memory_index()
+        private, members_only = set(), set()
+        if not include_private:
+            for row in db((db.channel.is_private == True) |
+                          (db.channel.requires_membership == True)).select(
+                    db.channel.id, db.channel.is_private,
+                    db.channel.requires_membership):
+                if row.is_private:
+                    private.add(row.id)
+                if row.requires_membership and \
+                        row.id not in member_channels:
+                    members_only.add(row.id)
+        hits = []
+        for _, (kind, ref_id) in memory.search(query):
+            document = memory.documents[(kind, ref_id)]
+            if document['channel_id'] in private:
+                continue
+            if kind == 'topic' and document['channel_id'] in members_only:
+                continue
+            hits.append({
+                'kind': kind,
+                'id': ref_id,
+                'channel_id': document['channel_id'],
+                'title': document['title'],
+                'snippet': document['snippet']
+            })
+            if len(hits) >= offset + limit:
+                break
+        return hits[offset:]
+
+
+# Expose a single instance
+search_index = SearchIndex()
@@ -0,0 +1,155 @@
+"""
+Per-request SQL instrumentation.
+SQLProfiler is a fixture, actions that include it in their @action.uses
+get their queries counted (number, database time and rows returned), the
+totals are aggregated per action and queries slower than slow_ms are
+logged along with the place in the app code that issued them.
+"""
+import logging
+import os
+import threading
+import time
+import traceback
+from collections import deque
+from py4web import request
+from py4web.core import Fixture
+from . import settings
+
+# Same logger as common.logger (common.py instantiates the profiler)
+logger = logging.getLogger("py4web:" + settings.APP_NAME)
+APP_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def _call_site():
+    """ file:line (function) of the innermost app frame issuing a query """
+    for frame in reversed(traceback.extract_stack()[:-2]):
+        filename = os.path.abspath(frame.filename)
+        if filename.startswith(APP_FOLDER) and \
+            not filename.endswith('sqlprofiler.py'):
+            return '%s:%s (%s)' % (
+                os.path.relpath(filename, APP_FOLDER), frame.lineno,
+                frame.name)
+    return 'unknown'
+
+
+def _action_name():
+    """ Route rule of the current request (or its path) """
+    route = getattr(request, 'route', None)
+    rule = getattr(route, 'rule', None)
+    return '%s %s' % (request.method, rule or request.path)
+
+
+class SQLProfiler(Fixture):
+    """ Counts queries, database time and rows of the requests it is
+    used in
+    """
+
+    def __init__(self, *dbs, slow_ms=100, max_slow_queries=100):
+        self.slow_ms = slow_ms
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._actions = {}
+        self._slow_queries = deque(maxlen=max_slow_queries)
+        for db in {id(db): db for db in dbs}.values():
+            self._instrument(db)
+
+    def _instrument(self, db):
+        adapter = db._adapter
+        execute, parse = adapter.execute, adapter.parse
+        profiler = self
+
+        def profiled_execute(*args, **kwargs):
+            current = getattr(profiler._local, 'current', None)
+            if current is None:
+                return execute(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return execute(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                current['queries'] += 1
+                current['db_time'] += elapsed
+                if elapsed * 1000 >= profiler.slow_ms:
+                    profiler._slow_query(args[0] if args else '', elapsed)
+
+        def profiled_parse(rows, *args, **kwargs):
+            current = getattr(profiler._local, 'current', None)
+            if current is not None:
+                current['rows'] += len(rows)
+            return parse(rows, *args, **kwargs)
+
+        adapter.execute = profiled_execute
+        adapter.parse = profiled_parse
+
+    def _slow_query(self, sql, elapsed):
+        call_site = _call_site()
+        logger.warning('Slow query (%.1f ms) at %s: %s',
+                       elapsed * 1000, call_site, sql)
+        with self._lock:
+            self._slow_queries.appendleft({
+                'action': _action_name(),
+                'call_site': call_site,
+                'ms': round(elapsed * 1000, 2),
+                'sql': str(sql)[:1000],
+                'on': time.strftime('%Y-%m-%d %H:%M:%S')
+            })
+
+    # Fixture interface
+    def on_request(self, context=None):
+        self._local.current = {
+            'queries': 0, 'db_time': 0.0, 'rows': 0,
+            'started': time.perf_counter()
+        }
+
+    def on_success(self, context=None):
+        self._finish()
+
+    def on_error(self, context=None):
+        self._finish()
+
+    def _finish(self):
+        current = getattr(self._local, 'current', None)
+        self._local.current = None
+        if current is None:
+            return
+        elapsed = time.perf_counter() - current['started']
+        name = _action_name()
+        with self._lock:
+            stats = self._actions.setdefault(name, {
+                'action': name, 'requests': 0, 'queries': 0,
+                'db_time': 0.0, 'rows': 0, 'time': 0.0, 'max_queries': 0
+            })
+            stats['requests'] += 1
+            stats['queries'] += current['queries']
+            stats['db_time'] += current['db_time']
+            stats['rows'] += current['rows']
+            stats['time'] += elapsed
+            stats['max_queries'] = max(
+                stats['max_queries'], current['queries'])
+
+    def current(self):
+        """ Counters of the request in progress (or None) """
+        current = getattr(self._local, 'current', None)
+        return dict(current) if current else None
+
+    def stats(self):
+        """ Per action aggregates, most database time first """
+        with self._lock:
+            actions = [dict(stats) for stats in self._actions.values()]
+        for stats in actions:
+            requests = stats['requests'] or 1
+            stats['avg_queries'] = round(stats['queries'] / requests, 2)
+            stats['avg_rows'] = round(stats['rows'] / requests, 2)
+            stats['avg_db_ms'] = round(stats['db_time'] * 1000 / requests, 2)
+            stats['avg_ms'] = round(stats['time'] * 1000 / requests, 2)
+        return sorted(actions, key=lambda stats: stats['db_time'],
+                      reverse=True)
+
+    def slow_queries(self):
+        with self._lock:
+            return list(self._slow_queries)
+
+    def reset(self):
+        with self._lock:
+            self._actions.clear()
+            self._slow_queries.clear()
@@ -2,8 +2,14 @@
 const searchBox = document.getElementById('search-box');
 const clearSearchBox = document.getElementById('clear-search-box');
 
-// Get the results element
+// Get the results elements, channel listing (server rendered page) and
+// search results (fetched from the server side search endpoint)
 const results = document.getElementById('results');
+const searchResults = document.getElementById('search-results');
+const moreSearchResults = document.getElementById('more-search-results');
+
+let searchTimer = null;
+let searchPage = 1;
 
 clearSearchBox.addEventListener('click', () => {
   searchBox.value = '';
@@ -12,26 +18,82 @@ clearSearchBox.addEventListener('click', () => {
   return false;
 });
 
+let buildResult = hit => {
+  const card = document.createElement('div');
+  card.classList.add('card', 'my-4', 'result');
+  const header = document.createElement('h5');
+  header.classList.add('card-header');
+  const link = document.createElement('a');
+  link.classList.add('link-offset-2', 'link-underline', 'link-underline-opacity-0');
+  link.href = searchBox.dataset.channelUrl + '/' + encodeURIComponent(hit.tag) +
+    (hit.kind === 'topic' ? '/t/' + hit.id : '');
+  link.textContent = hit.kind === 'channel' ? '/c/' + hit.tag : hit.title;
+  header.appendChild(link);
+  const body = document.createElement('div');
+  body.classList.add('card-body');
+  if (hit.kind === 'topic') {
+    const channel = document.createElement('p');
+    channel.classList.add('text-muted');
+    channel.textContent = 'Topic in /c/' + hit.tag;
+    body.appendChild(channel);
+  } else {
+    const title = document.createElement('h5');
+    title.classList.add('card-title');
+    title.textContent = hit.title;
+    body.appendChild(title);
+  }
+  const snippet = document.createElement('p');
+  snippet.classList.add('card-text');
+  snippet.textContent = hit.snippet;
+  body.appendChild(snippet);
+  card.appendChild(header);
+  card.appendChild(body);
+  return card;
+};
+
+let runSearch = (query, page) => {
+  const url = searchBox.dataset.url + '?q=' + encodeURIComponent(query) + '&page=' + page;
+  fetch(url, {headers: {'Accept': 'application/json'}})
+    .then(res => res.json())
+    .then(data => {
+      // Ignore late responses for a query that is no longer in the box
+      if (searchBox.value.trim() !== query) {
+        return;
+      }
+      if (page === 1) {
+        searchResults.replaceChildren();
+        if (!data.results.length) {
+          const empty = document.createElement('p');
+          empty.classList.add('my-4', 'text-muted');
+          empty.textContent = 'No channels or topics found.';
+          searchResults.appendChild(empty);
+        }
+      }
+      data.results.forEach(hit => searchResults.appendChild(buildResult(hit)));
+      searchPage = data.page;
+      moreSearchResults.classList.toggle('d-none', !data.has_more);
+    });
+};
+
+moreSearchResults.addEventListener('click', () => {
+  runSearch(searchBox.value.trim(), searchPage + 1);
+  return false;
+});
+
 // Add an event listener to the search box
 searchBox.addEventListener('keyup', function () {
   // Get the search value
-  const searchValue = this.value.toLowerCase();
-
-  // Hide all the result divs
-  results.querySelectorAll('.result').forEach(result => {
-    result.style.display = 'none';
-  });
-
-  // Filter the result divs based on the search value
-  const filteredResults = Array.from(results.querySelectorAll('.result')).filter(result => {
-    const title = result.querySelector('h5').textContent.toLowerCase();
-    const content = result.querySelector('p').textContent.toLowerCase();
-
-    return title.includes(searchValue) || content.includes(searchValue);
-  });
-
-  // Show the filtered result divs
-  filteredResults.forEach(result => {
-    result.style.display = 'block';
-  });
-});
\ No newline at end of file
+  const searchValue = this.value.trim();
+  clearTimeout(searchTimer);
+
+  if (!searchValue) {
+    // Back to the channel listing
+    searchResults.replaceChildren();
+    moreSearchResults.classList.add('d-none');
+    results.style.display = 'block';
+    return;
+  }
+  results.style.display = 'none';
+  // Wait for the user to stop typing before asking the server
+  searchTimer = setTimeout(() => runSearch(searchValue, 1), 250);
+});
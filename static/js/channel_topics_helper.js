@@ -0,0 +1,65 @@
+// Lazy loads the next page of topics for a channel, the "Load More Topics"
+// button carries the JSON endpoint and the cursor of the next page, without
+// javascript the button falls back to a regular (paginated) link.
+const loadMoreTopics = document.getElementById('load-more-topics');
+const topicList = document.getElementById('topic-list');
+
+let buildTopicCard = topic => {
+  const card = document.createElement('div');
+  card.classList.add('card', 'w-100', 'mb-3');
+
+  const header = document.createElement('h4');
+  header.classList.add('card-header');
+  const title = document.createElement('a');
+  title.classList.add('text-decoration-none');
+  title.href = topic.url || '#';
+  title.textContent = topic.title || '';
+  header.appendChild(title);
+
+  const body = document.createElement('div');
+  body.classList.add('card-body');
+  const author = document.createElement('div');
+  const authorLink = document.createElement('a');
+  authorLink.classList.add('link-warning', 'link-underline-opacity-50');
+  authorLink.textContent = '/u/' + (topic.username || '');
+  author.appendChild(authorLink);
+  const content = document.createElement('p');
+  content.classList.add('card-text');
+  content.textContent = topic.teaser || '';
+  const activity = document.createElement('p');
+  activity.classList.add('card-text', 'text-muted', 'small');
+  activity.textContent = (topic.reply_count || 0) + ' replies' +
+    (topic.last_reply_on ? ' \u00b7 last reply ' + topic.last_reply_on : '');
+  body.appendChild(author);
+  body.appendChild(content);
+  body.appendChild(activity);
+
+  card.appendChild(header);
+  card.appendChild(body);
+  return card;
+};
+
+if (loadMoreTopics && topicList) {
+  loadMoreTopics.addEventListener('click', e => {
+    e.preventDefault();
+    const cursor = loadMoreTopics.dataset.cursor;
+    if (!cursor) {
+      return false;
+    }
+    loadMoreTopics.classList.add('disabled');
+    const url = loadMoreTopics.dataset.url + '?cursor=' + encodeURIComponent(cursor);
+    fetch(url, {headers: {'Accept': 'application/json'}})
+      .then(res => res.json())
+      .then(data => {
+        data.topics.forEach(topic => topicList.appendChild(buildTopicCard(topic)));
+        if (data.next_cursor) {
+          loadMoreTopics.dataset.cursor = data.next_cursor;
+          loadMoreTopics.classList.remove('disabled');
+        } else {
+          loadMoreTopics.remove();
+        }
+      })
+      .catch(() => loadMoreTopics.classList.remove('disabled'));
+    return false;
+  });
+}
@@ -0,0 +1,47 @@
+// Polls the status of a background image job (banner, topic images) and
+// reloads the page once it is processed, see controllers/image.py
+const imageJob = document.getElementById('image-job');
+// Gives up after this many polls (the server fails stale jobs earlier)
+const maxImageJobPolls = 300;
+let imageJobPolls = 0;
+
+let showImageJobProblem = message => {
+  imageJob.classList.replace('alert-info', 'alert-warning');
+  imageJob.textContent = message;
+};
+
+let retryImageJob = delay => {
+  imageJobPolls += 1;
+  if (imageJobPolls >= maxImageJobPolls) {
+    showImageJobProblem('The uploaded image(s) are still being processed, ' +
+      'please reload the page later.');
+  } else {
+    setTimeout(pollImageJob, delay);
+  }
+};
+
+let pollImageJob = () => {
+  fetch(imageJob.dataset.url, {headers: {'Accept': 'application/json'}})
+    .then(res => {
+      if (!res.ok) {
+        // Not found or not allowed, polling again will not change it
+        throw new Error(res.status);
+      }
+      return res.json().then(job => {
+        if (job.status === 'pending') {
+          retryImageJob(2000);
+        } else if (job.status === 'failed') {
+          showImageJobProblem('Unable to process the uploaded image(s), ' +
+            'only valid JPEG, PNG, GIF or WEBP images are allowed.');
+        } else {
+          window.location.replace(imageJob.dataset.doneUrl);
+        }
+      }, () => retryImageJob(5000));
+    }, () => retryImageJob(5000))
+    .catch(() => showImageJobProblem(
+      'Unable to check the status of the uploaded image(s).'));
+};
+
+if (imageJob) {
+  setTimeout(pollImageJob, 1000);
+}
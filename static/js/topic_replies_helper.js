@@ -0,0 +1,87 @@
+// Lazy loads the next page of responses for a topic, the "Load More
+// Responses" button carries the JSON endpoint and the cursor of the next
+// page, without javascript the button falls back to a regular link.
+const loadMoreReplies = document.getElementById('load-more-replies');
+const replyList = document.getElementById('reply-list');
+
+let buildReplyCard = reply => {
+  const card = document.createElement('div');
+  card.classList.add('card', 'w-100', 'mb-3');
+  const body = document.createElement('div');
+  body.classList.add('card-body');
+
+  const author = document.createElement('div');
+  author.classList.add('mb-2');
+  if (reply.author.avatar_url) {
+    const avatar = document.createElement('img');
+    avatar.classList.add('rounded-circle', 'me-1');
+    avatar.src = reply.author.avatar_url;
+    avatar.alt = '';
+    avatar.width = 24;
+    avatar.height = 24;
+    author.appendChild(avatar);
+  }
+  const authorLink = document.createElement('a');
+  authorLink.classList.add('link-warning', 'link-underline-opacity-50');
+  authorLink.title = reply.author.display_name || '';
+  authorLink.textContent = '/u/' + (reply.author.username || '');
+  author.appendChild(authorLink);
+  if (reply.author.rank) {
+    const rank = document.createElement('span');
+    rank.classList.add('badge', 'text-bg-secondary', 'ms-1');
+    rank.title = reply.author.postings + ' postings';
+    rank.textContent = reply.author.rank;
+    author.appendChild(rank);
+  }
+  const createdOn = document.createElement('span');
+  createdOn.classList.add('text-muted', 'small', 'ms-1');
+  createdOn.textContent = reply.created_on || '';
+  author.appendChild(createdOn);
+
+  // content_marked is rendered and sanitized server side
+  const content = document.createElement('div');
+  content.classList.add('card-text');
+  content.innerHTML = reply.content_marked;
+
+  body.appendChild(author);
+  body.appendChild(content);
+  (reply.images || []).forEach(image => {
+    const link = document.createElement('a');
+    link.href = image.url;
+    link.target = '_blank';
+    const thumbnail = document.createElement('img');
+    thumbnail.classList.add('img-thumbnail', 'me-2', 'mt-2');
+    thumbnail.src = image.thumbnail_url;
+    thumbnail.alt = image.filename || '';
+    thumbnail.loading = 'lazy';
+    link.appendChild(thumbnail);
+    body.appendChild(link);
+  });
+  card.appendChild(body);
+  return card;
+};
+
+if (loadMoreReplies && replyList) {
+  loadMoreReplies.addEventListener('click', e => {
+    e.preventDefault();
+    const cursor = loadMoreReplies.dataset.cursor;
+    if (!cursor) {
+      return false;
+    }
+    loadMoreReplies.classList.add('disabled');
+    const url = loadMoreReplies.dataset.url + '?cursor=' + encodeURIComponent(cursor);
+    fetch(url, {headers: {'Accept': 'application/json'}})
+      .then(res => res.json())
+      .then(data => {
+        data.replies.forEach(reply => replyList.appendChild(buildReplyCard(reply)));
+        if (data.next_cursor) {
+          loadMoreReplies.dataset.cursor = data.next_cursor;
+          loadMoreReplies.classList.remove('disabled');
+        } else {
+          loadMoreReplies.remove();
+        }
+      })
+      .catch(() => loadMoreReplies.classList.remove('disabled'));
+    return false;
+  });
+}
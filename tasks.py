@@ -10,6 +10,12 @@ To use celery tasks:
 
 """
 from .common import settings, scheduler, db, Field
+from .viewcounter import view_counter
+from .rankengine import rank_engine
+from .imagejobs import image_jobs
+from .trending import trending
+from .forumhelper import forumhelper as fh
+from .rendercache import render_cache
 
 # example of task that needs db access
 @scheduler.task
@@ -23,6 +29,71 @@ def my_task():
         # rollback on failure
         db.rollback()
 
+@scheduler.task
+def flush_view_counters():
+    """ Applies the spooled channel/topic views in batched UPDATEs """
+    # this task will be executed in its own thread, connect to db
+    db._adapter.reconnect()
+    # flush() commits, or rolls back and re-spools on failure
+    view_counter.flush()
+
+@scheduler.task
+def reconcile_channel_ranks():
+    """ Recomputes every channel rank, fixes any incremental drift """
+    try:
+        db._adapter.reconnect()
+        rank_engine.reconcile()
+    except:
+        db.rollback()
+
+@scheduler.task
+def compute_hot_scores():
+    """ Recomputes the decayed hot scores, see trending.py """
+    try:
+        db._adapter.reconnect()
+        trending.compute()
+    except:
+        db.rollback()
+
+@scheduler.task
+def recount_member_postings():
+    """ Recomputes the member post/reply counters (zfmp_posts and
+    zfmp_replies), fixes any incremental drift """
+    try:
+        db._adapter.reconnect()
+        fh.recount_member_postings()
+    except:
+        db.rollback()
+
+@scheduler.task
+def process_image_job(job_id):
+    """ Decodes/resizes the images of a job, see imagejobs.py """
+    try:
+        db._adapter.reconnect()
+        image_jobs.run(job_id)
+    except:
+        db.rollback()
+
+@scheduler.task
+def expire_image_jobs():
+    """ Fails the image jobs whose worker is gone, see imagejobs.py """
+    try:
+        db._adapter.reconnect()
+        image_jobs.expire()
+    except:
+        db.rollback()
+
+@scheduler.task
+def prune_render_cache():
+    """ Drops the markdown renders not used lately, see rendercache.py """
+    try:
+        db._adapter.reconnect()
+        if render_cache.persist:
+            render_cache.prune()
+        db.commit()
+    except:
+        db.rollback()
+
 
 # run my_task every 10 seconds
 scheduler.conf.beat_schedule = {
@@ -31,4 +102,34 @@ scheduler.conf.beat_schedule = {
         "schedule": 10.0,
         "args": (),
     },
+    "flush_view_counters": {
+        "task": "apps.%s.tasks.flush_view_counters" % settings.APP_NAME,
+        "schedule": settings.VIEW_COUNTER_INTERVAL,
+        "args": (),
+    },
+    "reconcile_channel_ranks": {
+        "task": "apps.%s.tasks.reconcile_channel_ranks" % settings.APP_NAME,
+        "schedule": 3600.0,
+        "args": (),
+    },
+    "compute_hot_scores": {
+        "task": "apps.%s.tasks.compute_hot_scores" % settings.APP_NAME,
+        "schedule": settings.TRENDING_INTERVAL,
+        "args": (),
+    },
+    "expire_image_jobs": {
+        "task": "apps.%s.tasks.expire_image_jobs" % settings.APP_NAME,
+        "schedule": float(settings.IMAGE_JOB_TIMEOUT),
+        "args": (),
+    },
+    "prune_render_cache": {
+        "task": "apps.%s.tasks.prune_render_cache" % settings.APP_NAME,
+        "schedule": 86400.0,
+        "args": (),
+    },
+    "recount_member_postings": {
+        "task": "apps.%s.tasks.recount_member_postings" % settings.APP_NAME,
+        "schedule": 86400.0,
+        "args": (),
+    },
 }
@@ -0,0 +1,72 @@
+"""
+Smoke tests, the public pages are requested thru the py4web WSGI
+application (in-process, see commands/benchmark.py Client).
+
+The app is copied into a temporary apps folder, so it is imported as
+apps.<app_name> with its routes and templates where py4web expects them,
+and runs against a fresh SQLite database there:
+
+    python -m unittest discover -s tests
+"""
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+APP_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_NAME = 'zforum'
+
+
+def load_app(apps_folder):
+    """ Imports the app copied into apps_folder, returns its WSGI app and
+    the benchmark Client class
+    """
+    shutil.copytree(APP_FOLDER, os.path.join(apps_folder, APP_NAME),
+                    ignore=shutil.ignore_patterns(
+                        '.git', 'databases', '__pycache__', '*.whl',
+                        '_assets', 'tests'))
+    open(os.path.join(apps_folder, '__init__.py'), 'w').close()
+    os.environ.update({
+        'PY4WEB_APPS_FOLDER': apps_folder,
+        'DB_URI': 'sqlite://smoke.db',
+        'DB_MIGRATE': 'true',
+    })
+    sys.path.insert(0, os.path.dirname(apps_folder))
+    from py4web.core import action, bottle
+    # As py4web's loader does, so the routes are mounted under /<app_name>
+    action.app_name = APP_NAME
+    importlib.import_module(f'apps.{APP_NAME}')
+    benchmark = importlib.import_module(f'apps.{APP_NAME}.commands.benchmark')
+    return bottle.default_app(), benchmark.Client
+
+
+class SmokeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.wsgi_app, cls.client_class = load_app(
+            os.path.join(cls.tmp_folder, 'apps'))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_folder, ignore_errors=True)
+
+    def setUp(self):
+        self.client = self.client_class(self.wsgi_app)
+
+    def test_index(self):
+        # Twice, the second one is served by the page cache
+        for _ in range(2):
+            status, body = self.client.request('index')
+            self.assertEqual(status, 200, body[:500])
+
+    def test_channels(self):
+        status, body = self.client.request('channel/all')
+        self.assertEqual(status, 200, body[:500])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,274 @@
+"""
+Trending (hot) topics.
+Views (as the view counter flushes them), responses and upvotes of each
+topic are counted in hourly buckets (topic_activity_bucket). compute() runs
+every TRENDING_INTERVAL seconds and scores every topic active within the
+last TRENDING_WINDOW_HOURS in one pass over a single aggregate query:
+
+    hot_score = sum over the buckets of
+        (views * VIEW_WEIGHT + replies * REPLY_WEIGHT +
+         upvotes * UPVOTE_WEIGHT) * 0.5 ** (bucket age / half life)
+
+The scores are stored in topic.hot_score (indexed, see dbindexes.py) so
+the hot listings, per channel and site-wide, are plain index scans, they
+are written in chunks of UPDATE_CHUNK topics per statement.
+topic.is_hot flags the topics whose decayed views reach the
+zfss_hot_topic_threshold system setting, channel.hot_version is bumped
+when the flags of its topics change (the validators of the channel pages
+include it, see conditional.py).
+compute() runs in the compute_hot_scores task (USE_CELERY) or else in a
+thread of the web process holding the 'trending' lease (see dbtools.py).
+"""
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from .common import db, db_read, logger
+from .dbtools import acquire_lease
+from .forumhelper import forumhelper as fh
+from .pagecache import page_cache
+from .viewcounter import view_counter
+from . import settings
+
+VIEW_WEIGHT = 1.0
+REPLY_WEIGHT = 5.0
+UPVOTE_WEIGHT = 3.0
+# Topics updated per UPDATE statement
+UPDATE_CHUNK = 500
+
+
+def utc_now():
+    """ Timestamps are stored in UTC (see models.now), naive once read """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def bucket_start(when):
+    """ Start of the hourly bucket of a (naive UTC) datetime """
+    return when.replace(minute=0, second=0, microsecond=0)
+
+
+class Trending:
+    """ Time bucketed topic activity and decayed hot scores """
+
+    def __init__(self, window_hours=168, half_life_hours=24.0,
+                 interval=300.0):
+        self.window_hours = window_hours
+        self.half_life_hours = half_life_hours
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._runner = None
+
+    def _add(self, counter, counts, when=None):
+        """ Adds {topic_id: count} to the counter (views, replies or
+        upvotes) of the current bucket of each topic
+        """
+        counts = {int(topic_id): count
+                  for topic_id, count in counts.items() if count}
+        if not counts:
+            return
+        bucket = db.topic_activity_bucket
+        start = bucket_start(when or utc_now())
+        in_bucket = bucket.bucket_start == start
+        # Topics sharing the same increment are updated together, one row
+        # per topic (concurrent writers may have added a second one)
+        by_count = defaultdict(list)
+        for topic_id, count in counts.items():
+            by_count[count].append(topic_id)
+        for count, topic_ids in by_count.items():
+            first_rows = db(in_bucket & bucket.topic_id.belongs(
+                topic_ids))._select(bucket.id.min(), groupby=bucket.topic_id)
+            db(bucket.id.belongs(first_rows)).update(
+                **{counter: bucket[counter].coalesce_zero() + count})
+        existing = {row.topic_id for row in db(
+            in_bucket & bucket.topic_id.belongs(list(counts))).select(
+                bucket.topic_id, distinct=True)}
+        missing = [topic_id for topic_id in counts
+                   if topic_id not in existing]
+        if missing:
+            channels = {row.id: row.channel_id for row in db(
+                db.topic.id.belongs(missing)).select(
+                    db.topic.id, db.topic.channel_id)}
+            for topic_id in missing:
+                if topic_id in channels:
+                    bucket.insert(
+                        topic_id=topic_id, channel_id=channels[topic_id],
+                        bucket_start=start,
+                        **{counter: counts[topic_id]})
+        self._ensure_runner()
+
+    def views_added(self, totals):
+        """ view_counter listener, receives {(tablename, id): views} """
+        self._add('views', {record_id: views
+                            for (tablename, record_id), views in totals.items()
+                            if tablename == 'topic'})
+
+    def reply_added(self, topic_id):
+        """ Call after inserting a response to the (parent) topic """
+        self._add('replies', {topic_id: 1})
+
+    def reply_removed(self, topic_id):
+        """ Call when deleting a response to the (parent) topic """
+        self._add('replies', {topic_id: -1})
+
+    def topic_removed(self, topic_id):
+        """ Call when deleting a (parent) topic, drops its activity """
+        db(db.topic_activity_bucket.topic_id == topic_id).delete()
+
+    def upvotes_added(self, topic_id, count=1):
+        """ Call after upvoting a topic """
+        self._add('upvotes', {topic_id: count})
+
+    def _hot_threshold(self):
+        try:
+            return int(fh.get_system_property(
+                'zfss_hot_topic_threshold', '300'))
+        except ValueError:
+            return 300
+
+    def compute(self, now=None):
+        """ Recomputes the hot score of every topic with activity in the
+        window (and clears those without), prunes the expired buckets.
+        Returns the number of topics updated.
+        """
+        now = now or utc_now()
+        since = bucket_start(now) - timedelta(hours=self.window_hours - 1)
+        bucket = db.topic_activity_bucket
+        views = bucket.views.sum()
+        replies = bucket.replies.sum()
+        upvotes = bucket.upvotes.sum()
+        rows = db(bucket.bucket_start >= since).select(
+            bucket.topic_id, bucket.bucket_start, views, replies, upvotes,
+            groupby=bucket.topic_id|bucket.bucket_start)
+        # The decay only depends on the bucket, computed once per hour
+        decay = {}
+        scores = defaultdict(float)
+        decayed_views = defaultdict(float)
+        for row in rows:
+            start = row.topic_activity_bucket.bucket_start
+            if start not in decay:
+                age = max((now - start).total_seconds(), 0) / 3600
+                decay[start] = 0.5 ** (age / self.half_life_hours)
+            topic_id = row.topic_activity_bucket.topic_id
+            scores[topic_id] += decay[start] * (
+                (row[views] or 0) * VIEW_WEIGHT +
+                (row[replies] or 0) * REPLY_WEIGHT +
+                (row[upvotes] or 0) * UPVOTE_WEIGHT)
+            decayed_views[topic_id] += decay[start] * (row[views] or 0)
+        threshold = self._hot_threshold()
+        current = {row.id: row for row in db(
+            (db.topic.hot_score > 0) | (db.topic.is_hot == True)).select(
+                db.topic.id, db.topic.channel_id, db.topic.hot_score,
+                db.topic.is_hot)}
+        missing = set(scores) - set(current)
+        if missing:
+            current.update({row.id: row for row in db(
+                db.topic.id.belongs(missing)).select(
+                    db.topic.id, db.topic.channel_id, db.topic.hot_score,
+                    db.topic.is_hot)})
+        changes = []
+        changed_channels = set()
+        flagged_channels = set()
+        for topic_id, topic in current.items():
+            hot_score = round(scores.get(topic_id, 0.0), 4)
+            is_hot = threshold > 0 and \
+                decayed_views.get(topic_id, 0.0) >= threshold
+            if hot_score == round(topic.hot_score or 0.0, 4) and \
+                    is_hot == bool(topic.is_hot):
+                continue
+            changes.append((topic_id, hot_score, is_hot))
+            changed_channels.add(topic.channel_id)
+            if is_hot != bool(topic.is_hot):
+                flagged_channels.add(topic.channel_id)
+        for offset in range(0, len(changes), UPDATE_CHUNK):
+            self._update_scores(changes[offset:offset + UPDATE_CHUNK])
+        if flagged_channels:
+            # The Hot badges of the channel pages changed
+            db(db.channel.id.belongs(flagged_channels)).update(
+                hot_version=db.channel.hot_version.coalesce_zero() + 1,
+                modified_on=db.channel.modified_on)
+        db(bucket.bucket_start < since).delete()
+        db.commit()
+        # Cached pages listing hot topics (see pagecache.py)
+        for channel_id in changed_channels:
+            page_cache.bump('channel', channel_id)
+        if changes:
+            page_cache.bump('hot')
+        return len(changes)
+
+    def _update_scores(self, changes):
+        """ Writes [(topic_id, hot_score, is_hot)] in a single UPDATE,
+        topic.modified_on (edits of the topic itself) is left as is.
+        The values are numbers and booleans, represented by the adapter.
+        """
+        topic = db.topic
+        represent = db._adapter.represent
+        topic_id = topic.id._rname
+        scores = ' '.join(
+            f'WHEN {int(row_id)} THEN {float(hot_score):.4f}'
+            for row_id, hot_score, _ in changes)
+        flags = ' '.join(
+            f'WHEN {int(row_id)} THEN {represent(is_hot, "boolean")}'
+            for row_id, _, is_hot in changes)
+        ids = ', '.join(str(int(row_id)) for row_id, _, _ in changes)
+        db.executesql(
+            f'UPDATE {topic._rname} SET '
+            f'{topic.hot_score._rname} = CASE {topic_id} {scores} END, '
+            f'{topic.is_hot._rname} = CASE {topic_id} {flags} END '
+            f'WHERE {topic_id} IN ({ids});')
+
+    def hot_topics(self, channel_id=None, limit=10):
+        """ The hottest visible topics of a channel, or site-wide (public
+        channels only) when channel_id is None, hottest first
+        """
+        self._ensure_runner()
+        topic, channel = db_read.topic, db_read.channel
+        qry = (topic.is_parent == True) & (topic.is_visible == True) & \
+            (topic.hot_score > 0) & (channel.id == topic.channel_id)
+        if channel_id is None:
+            qry &= (channel.is_private == False) & \
+                (channel.requires_membership == False)
+        else:
+            qry &= topic.channel_id == channel_id
+        return db_read(qry).select(
+            topic.id, topic.title, topic.teaser, topic.hot_score,
+            topic.is_hot, topic.reply_count, channel.tag,
+            orderby=~topic.hot_score|~topic.id,
+            limitby=(0, limit))
+
+    def _ensure_runner(self):
+        """ Starts the daemon thread computing the scores when this process
+        holds the lease, unless the compute_hot_scores task does
+        (USE_CELERY)
+        """
+        if self._runner is not None or settings.USE_CELERY:
+            return
+        with self._lock:
+            if self._runner is not None:
+                return
+            self._runner = threading.Thread(
+                target=self._compute_forever, name='zforum-trending',
+                daemon=True)
+        self._runner.start()
+
+    def _compute_forever(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                # this thread needs its own db connection
+                db._adapter.reconnect()
+                # Only one process computes, for a bit over an interval
+                if not acquire_lease(db, 'trending', self.interval * 1.5):
+                    continue
+                self.compute()
+            except Exception as exc:
+                db.rollback()
+                logger.error('Unable to compute the hot scores: %s', exc)
+
+
+# Expose a single instance
+trending = Trending(
+    window_hours=settings.TRENDING_WINDOW_HOURS,
+    half_life_hours=settings.TRENDING_HALF_LIFE_HOURS,
+    interval=settings.TRENDING_INTERVAL)
+# Flushed topic views feed the buckets
+view_counter.listeners.append(trending.views_added)
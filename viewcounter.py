@@ -0,0 +1,159 @@
+"""
+Buffered (write-behind) view counters for channels and topics.
+Page views are accumulated in memory and periodically spooled to small
+files in settings.VIEW_COUNTER_SPOOL, shared by every process of the app.
+flush() collects the spooled views and applies them to the database with
+one UPDATE per distinct increment, so a page view is never a write.
+"""
+import glob
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from .common import db, logger
+from . import settings
+
+# Tables with a 'view' counter column that can be buffered
+COUNTED_TABLES = ('channel', 'topic')
+
+
+class ViewCounter:
+    """ In-memory accumulator of views, spooled to disk and flushed in
+    batches to the database
+    """
+
+    def __init__(self, spool_folder, interval=10.0):
+        self.spool_folder = spool_folder
+        self.interval = interval
+        # Callables receiving the flushed {(tablename, id): views} totals,
+        # called inside the flush transaction.
+        self.listeners = []
+        self._pending = defaultdict(int)
+        self._lock = threading.Lock()
+        self._last_spool = time.monotonic()
+        self._flusher = None
+
+    def hit(self, tablename, record_id, count=1):
+        """ Records count views of a channel/topic """
+        if tablename not in COUNTED_TABLES:
+            raise ValueError(f'{tablename} does not have a view counter')
+        with self._lock:
+            self._pending[(tablename, int(record_id))] += count
+            due = time.monotonic() - self._last_spool >= self.interval
+        if due:
+            self.spool()
+        self._ensure_flusher()
+
+    def pending(self, tablename, record_id):
+        """ Views recorded by this process and not yet spooled """
+        with self._lock:
+            return self._pending.get((tablename, int(record_id)), 0)
+
+    def spool(self):
+        """ Moves the views buffered in memory to a spool file """
+        with self._lock:
+            pending = self._pending
+            self._pending = defaultdict(int)
+            self._last_spool = time.monotonic()
+        if not pending:
+            return
+        payload = [[tablename, record_id, count]
+                   for (tablename, record_id), count in pending.items()]
+        fname = os.path.join(
+            self.spool_folder, f'{os.getpid()}-{time.time_ns()}.json')
+        # Write to a temporary name first, flush() only picks up *.json
+        with open(fname + '.tmp', 'w', encoding='utf-8') as spool_file:
+            json.dump(payload, spool_file)
+        os.replace(fname + '.tmp', fname)
+
+    def _claim_spool_files(self):
+        """ Renames the spool files so concurrent flushes never apply the
+        same views twice, returns (original, claimed) file name tuples
+        """
+        claimed = []
+        suffix = f'.{os.getpid()}-{threading.get_ident()}.claimed'
+        for fname in sorted(glob.glob(
+                os.path.join(self.spool_folder, '*.json'))):
+            try:
+                os.rename(fname, fname + suffix)
+                claimed.append((fname, fname + suffix))
+            except OSError:
+                # Claimed by someone else in the meantime
+                continue
+        return claimed
+
+    def flush(self):
+        """ Applies every spooled view to the database, returns the
+        {(tablename, id): views} totals that were applied.
+        """
+        self.spool()
+        claimed = self._claim_spool_files()
+        totals = defaultdict(int)
+        for _, fname in claimed:
+            try:
+                with open(fname, encoding='utf-8') as spool_file:
+                    for tablename, record_id, count in json.load(spool_file):
+                        totals[(tablename, record_id)] += count
+            except (OSError, ValueError) as exc:
+                logger.warning('Skipping view spool %s: %s', fname, exc)
+        if not totals:
+            for _, fname in claimed:
+                os.unlink(fname)
+            return {}
+        # Rows sharing the same increment are updated together
+        by_increment = defaultdict(list)
+        for (tablename, record_id), count in totals.items():
+            by_increment[(tablename, count)].append(record_id)
+        try:
+            for (tablename, count), record_ids in by_increment.items():
+                table = db[tablename]
+                # modified_on reflects edits/activity, not views, keep it
+                db(table.id.belongs(record_ids)).update(
+                    view=table.view + count,
+                    modified_on=table.modified_on)
+            for listener in self.listeners:
+                listener(dict(totals))
+            db.commit()
+        except Exception:
+            db.rollback()
+            # Give the views back to the spool so they are not lost
+            for original, fname in claimed:
+                os.replace(fname, original)
+            raise
+        for _, fname in claimed:
+            os.unlink(fname)
+        return dict(totals)
+
+    def _ensure_flusher(self):
+        """ Starts the daemon thread of this process, it spools the views
+        left in memory and, without celery, also flushes the spool
+        """
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(
+                target=self._flush_forever, name='zforum-view-counter',
+                daemon=True)
+        self._flusher.start()
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                if settings.USE_CELERY:
+                    # tasks.flush_view_counters applies the spool
+                    self.spool()
+                    continue
+                # this thread needs its own db connection
+                db._adapter.reconnect()
+                self.flush()
+            except Exception as exc:
+                logger.error('Unable to flush view counters: %s', exc)
+
+
+# Expose a single instance
+view_counter = ViewCounter(
+    settings.VIEW_COUNTER_SPOOL, settings.VIEW_COUNTER_INTERVAL)